@@ -1,12 +1,14 @@
 from django.contrib.auth.models import User
 
-from stockandflow.models import Facet
+from stockandflow.models import Facet, GROUPED
 
 from profiles.models import Ramp, Source, PayState
 
+# There are many coaches so count them all in one query
 coach = Facet(slug="coach", name="Coach", field_lookup="coach__username",
               values=User.objects.filter(groups__name="coach")
-                         .values_list("username", flat=True))
+                         .values_list("username", flat=True),
+              count_mode=GROUPED)
 
 ramp = Facet(slug="ramp", name="Ramp", field_lookup="ramp__name",
               values=Ramp.objects.all().values_list("name", flat=True))
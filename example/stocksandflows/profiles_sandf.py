@@ -1,6 +1,6 @@
 from datetime import date
 
-from stockandflow.models import Stock, Flow
+from stockandflow.models import Stock, Flow, snapshot_stocks
 from stockandflow.tracker import ModelTracker
 from stockandflow import periodic
 from processes.models import ProfileFlowEvent
@@ -101,7 +101,8 @@ profile_tracker = ModelTracker(
 
 # Add to the periodic schedule
 def record_profile_stocks():
-    map(lambda s: s.save_count(), stocks)
+    records = snapshot_stocks(stocks)
+    return "Recorded %s profile stocks." % len(records)
 
 # An automation example
 def mark_needs_coach_when_next_contact_is_due():
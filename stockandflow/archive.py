@@ -0,0 +1,165 @@
+"""
+Archive the flow events that are older than the retention of their flow to
+compressed files and delete them from the database.
+"""
+import csv
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+from django.db import connections, router
+from django.db.models import Max
+
+from stockandflow.compat import atomic
+from stockandflow.export import csv_value, FORMATS
+from stockandflow.models import FlowRecord, FlowRollupMark
+from stockandflow.rollups import model_label
+from stockandflow.sql import count_clauses, truncate_datetime_sql, parse_truncated
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def check_rolled_up(flow, before, using, periods=None):
+    """
+    Raise ArchiveError unless all the events of the flow before the datetime
+    have been rolled up into the FlowRecords of every period, so that
+    deleting them keeps the flow rates.
+
+    The periods default to all the periods that the flow event model has
+    been rolled up to.
+    """
+    last_id = flow.queryset.using(using).filter(timestamp__lt=before) \
+                                        .aggregate(last_id=Max("pk"))["last_id"]
+    if last_id is None:
+        return
+    marks = FlowRollupMark.objects.using(using).filter(model=model_label(flow.flow_event_model))
+    if periods:
+        marks = marks.filter(period__in=periods)
+    rolled_up = dict(marks.values_list("period", "last_id"))
+    lagging = [period for period in (periods or rolled_up) or ["hour"]
+               if rolled_up.get(period, 0) < last_id]
+    if lagging:
+        raise ArchiveError("The events of %s before %s have not all been rolled up to the "
+                           "%s records. Run rollup_flow_events first." %
+                           (flow.slug, before, ", ".join(sorted(lagging))))
+    for period in sorted(periods or rolled_up):
+        missing = unrolled_events(flow, before, period, using)
+        if missing:
+            raise ArchiveError("%s events of %s before %s are missing from the %s records. "
+                               "They were committed after a rollup had passed their ids." %
+                               (missing, flow.slug, before, period))
+
+
+def unrolled_events(flow, before, period, using):
+    """
+    Return the number of events of the flow before the datetime that are
+    below the rollup mark but missing from the FlowRecords of the period,
+    because their transactions committed after a rollup had passed their ids.
+
+    The events are counted per source, sink and period with one GROUP BY
+    query and compared with the FlowRecords. A period that an earlier archive
+    has already emptied in part can hide missing events.
+    """
+    events = flow.queryset.using(using).filter(timestamp__lt=before)
+    using, from_sql, from_params, where, where_params = count_clauses(events)
+    if where is None:
+        return 0
+    qn = connections[using].ops.quote_name
+    table = qn(flow.flow_event_model._meta.db_table)
+    source, sink, timestamp = ["%s.%s" % (table, qn(c)) for c in ("source", "sink", "timestamp")]
+    bucket = truncate_datetime_sql(using, timestamp, period)
+    sql = "SELECT %s, %s, %s, COUNT(*) FROM %s" % (source, sink, bucket, from_sql)
+    if where:
+        sql += " WHERE %s" % where
+    sql += " GROUP BY %s, %s, %s" % (source, sink, bucket)
+    cursor = connections[using].cursor()
+    cursor.execute(sql, list(from_params) + list(where_params))
+    recorded = dict(((source, sink, start), count) for source, sink, start, count in
+                    FlowRecord.objects.using(using).filter(flow=flow.slug, period=period,
+                                                           start__lt=before)
+                              .values_list("source", "sink", "start", "count"))
+    return sum(max(count - recorded.get((source, sink, parse_truncated(start)), 0), 0)
+               for source, sink, start, count in cursor.fetchall())
+
+
+def archive_flow_events(flow, directory, now=None, chunk_size=1000, format="csv",
+                        periods=None):
+    """
+    Move the events of the flow that are older than its retention_days to a
+    gzipped CSV or NDJSON file in the directory. Returns a tuple of the
+    number of events archived and the path of the file, which is None when
+    there was nothing to archive.
+
+    All the events are written to a temporary file, which is renamed once it
+    is complete. Only then are the events from the first to the last primary
+    key written deleted, in chunks of chunk_size by primary key, each delete
+    in its own short transaction. Only the chunk in hand is kept in memory.
+    An ArchiveError is raised if the events have not been rolled up to the
+    periods (see check_rolled_up).
+    """
+    if not flow.retention_days:
+        raise ArchiveError("The flow %s has no retention_days." % flow.slug)
+    if format not in FORMATS:
+        raise ValueError("The format must be one of %s, not '%s'." % (", ".join(FORMATS), format))
+    now = now or datetime.now()
+    before = now - timedelta(days=flow.retention_days)
+    model = flow.flow_event_model
+    using = router.db_for_write(model)
+    check_rolled_up(flow, before, using, periods)
+    columns = [f.attname for f in model._meta.fields]
+    pk_index = columns.index(model._meta.pk.attname)
+    events = flow.queryset.using(using).filter(timestamp__lt=before).order_by("pk")
+    path = os.path.join(directory, "%s-%s.%s.gz" % (flow.slug, now.strftime("%Y%m%d%H%M%S"),
+                                                    format))
+    partial_path = path + ".partial"
+    archived = 0
+    first_pk = last_pk = None
+    out = None
+    try:
+        while True:
+            chunk = events
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            rows = list(chunk.values_list(*columns)[:chunk_size])
+            if not rows:
+                break
+            if out is None:
+                out = gzip.open(partial_path, "wb")
+                if format == "csv":
+                    writer = csv.writer(out)
+                    writer.writerow(columns)
+            for row in rows:
+                if format == "csv":
+                    writer.writerow([csv_value(v) for v in row])
+                else:
+                    out.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+            if first_pk is None:
+                first_pk = rows[0][pk_index]
+            last_pk = rows[-1][pk_index]
+            archived += len(rows)
+        if out is not None:
+            out.close()
+            out = None
+            os.rename(partial_path, path)
+    finally:
+        if out is not None:
+            out.close()
+            os.remove(partial_path)
+    if not archived:
+        return 0, None
+    written = events.filter(pk__gte=first_pk, pk__lte=last_pk)
+    deleted_pk = None
+    while True:
+        chunk = written
+        if deleted_pk is not None:
+            chunk = chunk.filter(pk__gt=deleted_pk)
+        pks = list(chunk.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            break
+        with atomic(using=using):
+            model._default_manager.using(using).filter(pk__in=pks).delete()
+        deleted_pk = pks[-1]
+    return archived, path
@@ -0,0 +1,72 @@
+"""
+Check that the changes in the exact counts of each stock match its flow
+events.
+
+Between two stock records the count should change by the inflow minus the
+outflow events of the stock. A change that creates no flow events, such as a
+QuerySet.update or raw SQL, shows up as drift in the interval where it
+happened.
+"""
+from stockandflow.counting import EXACT
+from stockandflow.models import StockRecord, Stock, flows_by_slug, reading_queryset
+from stockandflow.replay import StockReplay
+
+
+def registered_stocks():
+    """
+    Return a list of the stocks that are a source or a sink of a registered
+    flow, in slug order.
+    """
+    stocks = {}
+    for flow in flows_by_slug.values():
+        for stock in list(flow.sources) + list(flow.sinks):
+            if isinstance(stock, Stock):
+                stocks[stock.slug] = stock
+    return [stocks[slug] for slug in sorted(stocks)]
+
+
+def audit_stock(stock, start=None, end=None, tolerance=0):
+    """
+    Return a list of (interval start, interval end, count change, net flow,
+    drift) tuples for the intervals between consecutive exact records of
+    the stock where the drift is larger than the tolerance.
+
+    The events are counted in the intervals between the exact timestamps of
+    the records, from a record up to the next one. This reads the record
+    counts and one interval count per direction for every 400 intervals.
+    """
+    records = reading_queryset(StockRecord.objects.filter(stock=stock.slug, strategy=EXACT),
+                               stock.using)
+    if start:
+        records = records.filter(timestamp__gte=start)
+    if end:
+        records = records.filter(timestamp__lt=end)
+    records = list(records.order_by("timestamp").values_list("timestamp", "count"))
+    if len(records) < 2:
+        return []
+    nets = StockReplay(stock).net_flows_between([ts for ts, count in records])
+    drifts = []
+    for (previous_ts, previous_count), (ts, count), net in zip(records, records[1:], nets):
+        change = count - previous_count
+        if abs(change - net) > tolerance:
+            drifts.append((previous_ts, ts, change, net, change - net))
+    return drifts
+
+
+def audit_stocks(stocks, start=None, end=None, tolerance=0):
+    """
+    Audit the stocks and return a report of the drift of each stock and of
+    each interval that drifted.
+    """
+    lines = []
+    for stock in stocks:
+        drifts = audit_stock(stock, start, end, tolerance)
+        if not drifts:
+            lines.append("%s: no drift." % stock.slug)
+            continue
+        lines.append("%s: %s intervals drifted by %s in total." %
+                     (stock.slug, len(drifts), sum(d[4] for d in drifts)))
+        for interval_start, interval_end, change, net, drift in drifts:
+            lines.append("  %s to %s: count changed by %s, net flow %s, drift %s." %
+                         (interval_start, interval_end, change, net, drift))
+    return "\n".join(lines)
@@ -0,0 +1,100 @@
+"""
+Compact the stock records of frequently counted stocks. Recent records are
+kept at full resolution and older records are thinned out to one record per
+hour and then one per day.
+"""
+from datetime import datetime, timedelta
+
+from django.db import router
+
+from stockandflow.compat import atomic
+from stockandflow.models import (StockRecord, StockFacetRecord, StockCrossTabRecord,
+                                 StockMembershipRecord)
+from stockandflow.sql import bucketed_latest
+
+
+class CompactionPolicy(object):
+    """
+    How long the records of a stock are kept at each resolution. All the
+    records of the last full_days are kept. Older records are reduced to the
+    last record of each hour, and records older than hourly_days to the last
+    record of each day. Without hourly_days the records are kept hourly.
+
+    The records of each counting strategy are compacted separately.
+    """
+    def __init__(self, full_days=7, hourly_days=90):
+        if hourly_days is not None and hourly_days < full_days:
+            raise ValueError("The hourly_days must not be less than the full_days.")
+        self.full_days = full_days
+        self.hourly_days = hourly_days
+
+    def tiers(self, now):
+        """
+        Return a list of (resolution, start, end) tuples of the time ranges to
+        compact. A start of None is unbounded.
+        """
+        full_start = now - timedelta(days=self.full_days)
+        if self.hourly_days is None:
+            return [("hour", None, full_start)]
+        hourly_start = now - timedelta(days=self.hourly_days)
+        return [("hour", hourly_start, full_start), ("day", None, hourly_start)]
+
+
+def compact_stock(stock, now=None, chunk_size=1000):
+    """
+    Delete the records of the stock that its compaction policy does not keep,
+    along with their facet, cross tab and membership records. Returns the number of stock
+    records deleted.
+
+    The records are deleted in chunks of chunk_size, each in its own short
+    transaction.
+    """
+    if stock.compaction is None:
+        return 0
+    now = now or datetime.now()
+    using = router.db_for_write(StockRecord)
+    records = StockRecord.objects.using(using).filter(stock=stock.slug)
+    deleted = 0
+    for resolution, start, end in stock.compaction.tiers(now):
+        tier = records.filter(timestamp__lt=end)
+        if start is not None:
+            tier = tier.filter(timestamp__gte=start)
+        for strategy in list(tier.order_by().values_list("strategy", flat=True).distinct()):
+            in_strategy = tier.filter(strategy=strategy)
+            keep = set(i for b, i in bucketed_latest(in_strategy, "timestamp", resolution))
+            last_id = 0
+            while True:
+                ids = list(in_strategy.filter(id__gt=last_id).order_by("id")
+                                      .values_list("id", flat=True)[:chunk_size])
+                if not ids:
+                    break
+                last_id = ids[-1]
+                to_delete = [i for i in ids if i not in keep]
+                if to_delete:
+                    with atomic(using=using):
+                        StockFacetRecord.objects.using(using) \
+                                        .filter(stock_record__in=to_delete).delete()
+                        StockCrossTabRecord.objects.using(using) \
+                                           .filter(stock_record__in=to_delete).delete()
+                        StockMembershipRecord.objects.using(using) \
+                                             .filter(stock_record__in=to_delete).delete()
+                        StockRecord.objects.using(using).filter(id__in=to_delete).delete()
+                    deleted += len(to_delete)
+    return deleted
+
+
+def compact_stock_records(stocks, chunk_size=1000):
+    """
+    Compact the records of the stocks that have a compaction policy. Register
+    this as a periodic schedule entry with the stocks as an argument. It
+    returns a message that reports the deleted records.
+    """
+    lines = []
+    for stock in stocks:
+        if stock.compaction is None:
+            continue
+        deleted = compact_stock(stock, chunk_size=chunk_size)
+        lines.append("Compacted %s by deleting %s records." % (stock.slug, deleted))
+    if not lines:
+        return "There are no stocks to compact."
+    return "\n".join(lines)
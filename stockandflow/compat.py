@@ -0,0 +1,39 @@
+"""
+Helpers that paper over the differences between the supported Django
+versions.
+"""
+from django.db import transaction
+
+
+# The transaction context manager and decorator
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    atomic = transaction.commit_on_success
+
+
+def bulk_insert(model, objs, batch_size=1000):
+    """
+    Insert the unsaved model instances in batches. This uses bulk_create when
+    it is available (Django 1.4+), otherwise each instance is saved in turn.
+
+    Note that bulk_create does not set the primary keys of the instances on
+    most databases.
+    """
+    objs = list(objs)
+    manager = model._default_manager
+    if not hasattr(manager, "bulk_create"):
+        for obj in objs:
+            obj.save(force_insert=True)
+        return objs
+    for start in range(0, len(objs), batch_size):
+        manager.bulk_create(objs[start:start + batch_size])
+    return objs
+
+
+# A response that streams an iterator. Before Django 1.5 a plain HttpResponse
+# streams an iterator as long as no middleware reads the content.
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    from django.http import HttpResponse as StreamingHttpResponse
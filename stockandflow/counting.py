@@ -0,0 +1,182 @@
+"""
+Ways of counting a stock: exact and estimated counting strategies, and live
+counters that avoid running a COUNT query on every request.
+"""
+import math
+import random
+import re
+from collections import namedtuple
+
+from django.db import connections
+from django.db.models import Min, Max
+
+
+# Counting strategy names, as recorded in StockRecord.strategy
+EXACT = "exact"
+PLANNER = "planner"
+SAMPLED = "sampled"
+# Records reconstructed from the flow events by stockandflow.replay
+REPLAYED = "replayed"
+
+
+class CountResult(namedtuple("CountResult", "value error strategy")):
+    """
+    A count of a stock. The error is the bound on the absolute error of the
+    value (zero for an exact count) and the strategy is the name of the
+    strategy that produced it.
+    """
+    pass
+
+
+class ExactCount(object):
+    """
+    Count the queryset with COUNT(*). This is the default strategy.
+    """
+    name = EXACT
+
+    def measure(self, queryset):
+        return CountResult(queryset.count(), 0, self.name)
+
+
+class SampledEstimate(object):
+    """
+    Estimate the count by testing the stock membership of a random sample of
+    primary keys between the smallest and the largest primary key of the
+    model. This takes three small queries whatever the size of the table, but
+    it requires an integer primary key.
+
+    The error is the confidence interval of the estimate for the given z
+    score (1.96 is a 95% confidence level). When none or all of the sample
+    are members that interval is empty, so the rule of three bound of
+    3 / sample_size of the keys is reported instead. Tables with fewer
+    possible keys than the sample size are simply counted exactly.
+    """
+    name = SAMPLED
+
+    def __init__(self, sample_size=500, z=1.96):
+        self.sample_size = sample_size
+        self.z = z
+
+    def measure(self, queryset):
+        pk_name = queryset.model._meta.pk.name
+        bounds = queryset.model._default_manager.using(queryset.db).aggregate(
+                low=Min(pk_name), high=Max(pk_name))
+        low, high = bounds["low"], bounds["high"]
+        if low is None:
+            return CountResult(0, 0, EXACT)
+        span = high - low + 1
+        if span <= self.sample_size:
+            return ExactCount().measure(queryset)
+        sample = set()
+        while len(sample) < self.sample_size:
+            sample.add(random.randint(low, high))
+        hits = queryset.filter(**{pk_name + "__in": list(sample)}).count()
+        p = hits / float(self.sample_size)
+        value = int(round(p * span))
+        if hits in (0, self.sample_size):
+            error = int(math.ceil(3.0 * span / self.sample_size))
+        else:
+            error = int(math.ceil(self.z * math.sqrt(p * (1 - p) / self.sample_size) * span))
+        return CountResult(value, error, self.name)
+
+
+class PlannerEstimate(object):
+    """
+    Use the row estimate of the PostgreSQL query planner, which costs a single
+    EXPLAIN. Planner estimates have no statistical bound so the error is
+    reported as the given relative_error of the estimate.
+
+    On other databases this falls back to the fallback strategy, which is a
+    SampledEstimate by default.
+    """
+    name = PLANNER
+    rows_re = re.compile(r"rows=(\d+)")
+
+    def __init__(self, relative_error=0.1, fallback=None):
+        self.relative_error = relative_error
+        self.fallback = fallback or SampledEstimate()
+
+    def measure(self, queryset):
+        connection = connections[queryset.db]
+        if getattr(connection, "vendor", None) != "postgresql":
+            return self.fallback.measure(queryset)
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        match = self.rows_re.search(cursor.fetchone()[0])
+        if not match:
+            return self.fallback.measure(queryset)
+        value = int(match.group(1))
+        return CountResult(value, int(math.ceil(value * self.relative_error)), self.name)
+
+
+class CacheCounterStore(object):
+    """
+    Keep a live count of stocks in a Django cache.
+
+    A stock with a live counter has its count adjusted by every flow event
+    that has the stock as a source or a sink, so Stock.count() becomes a
+    single cache lookup. The counter is seeded from the queryset on the first
+    read and whenever the cache has dropped the key.
+
+    Changes that do not generate flow events (deletes, QuerySet.update, raw
+    SQL) make the live count drift. Schedule reconcile_live_counts to measure
+    and correct the drift.
+    """
+    def __init__(self, cache=None, key_prefix="stockandflow_live_", timeout=None):
+        if cache is None:
+            from django.core.cache import cache
+        self.cache = cache
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+
+    def key(self, stock):
+        return self.key_prefix + stock.slug
+
+    def get(self, stock):
+        """
+        Return the live count or None if it is not in the cache.
+        """
+        return self.cache.get(self.key(stock))
+
+    def set(self, stock, count):
+        if self.timeout is None:
+            self.cache.set(self.key(stock), count)
+        else:
+            self.cache.set(self.key(stock), count, self.timeout)
+
+    def adjust(self, stock, delta):
+        """
+        Add the delta to the live count. A missing count is left missing so
+        that it is seeded from the queryset on the next read.
+        """
+        try:
+            if delta >= 0:
+                self.cache.incr(self.key(stock), delta)
+            else:
+                self.cache.decr(self.key(stock), -delta)
+        except ValueError:
+            pass
+
+
+def reconcile_live_counts(stocks):
+    """
+    Compare the live count of each stock that has a live counter with the
+    count of its queryset and reset the live count to the actual value.
+
+    Returns a message that reports the drift, so this can be registered as a
+    periodic schedule entry.
+    """
+    lines = []
+    for stock in stocks:
+        if stock.live_counter is None:
+            continue
+        live, actual = stock.reconcile_live_count()
+        if live is None:
+            lines.append("%s: seeded live count with %s." % (stock.slug, actual))
+        else:
+            lines.append("%s: live %s, actual %s, drift %s." % (stock.slug, live, actual,
+                                                             live - actual))
+    if not lines:
+        return "There are no live counts to reconcile."
+    return "\n".join(lines)
@@ -0,0 +1,101 @@
+"""
+Buffering of flow events so that they are written in bulk.
+"""
+import threading
+from contextlib import contextmanager
+
+from stockandflow.compat import atomic, bulk_insert
+
+
+_local = threading.local()
+
+
+class FlowEventBuffer(object):
+    """
+    Collect unsaved flow events and write them with one bulk insert per flow
+    event model.
+
+    Each event can have a callback, such as the live count adjustment and the
+    event callables of its flow, that only runs once the events have been
+    committed.
+    """
+    def __init__(self):
+        self.events = []
+        self.callbacks = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, flow_event, callback=None, args=()):
+        self.events.append(flow_event)
+        if callback is not None:
+            self.callbacks.append((callback, args))
+
+    def flush(self):
+        """
+        Write and forget the buffered events.
+        """
+        by_model = {}
+        model_order = []
+        for fe in self.events:
+            model = fe.__class__
+            if model not in by_model:
+                by_model[model] = []
+                model_order.append(model)
+            by_model[model].append(fe)
+        for model in model_order:
+            bulk_insert(model, by_model[model])
+        self.events = []
+
+    def run_callbacks(self):
+        """
+        Run and forget the callbacks of the events.
+        """
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            callback(*args)
+
+
+def current_buffer():
+    """
+    Return the innermost active FlowEventBuffer of this thread or None.
+    """
+    buffers = getattr(_local, "buffers", None)
+    if buffers:
+        return buffers[-1]
+    return None
+
+
+@contextmanager
+def buffered_flow_events(using=None):
+    """
+    Run a block in a transaction and buffer the flow events that it creates.
+
+    The events are written with one bulk insert per flow event model just
+    before the transaction commits. The live counts of their stocks are
+    adjusted and their event callables are run after it commits. If the block
+    raises an exception the events are discarded along with the rest of the
+    transaction, and the live counts and callables are left alone.
+
+    A block nested in another buffered_flow_events block hands its live count
+    adjustments and callables to the enclosing block, so they only run once
+    the outermost block has committed.
+
+    Inside the block Flow.add_event returns the unsaved event. Pass sync=True
+    to add_event to save an event immediately instead.
+    """
+    buffer = FlowEventBuffer()
+    if not hasattr(_local, "buffers"):
+        _local.buffers = []
+    _local.buffers.append(buffer)
+    try:
+        with atomic(using=using):
+            yield buffer
+            buffer.flush()
+    finally:
+        _local.buffers.pop()
+    outer = current_buffer()
+    if outer is not None:
+        outer.callbacks.extend(buffer.callbacks)
+    else:
+        buffer.run_callbacks()
@@ -0,0 +1,212 @@
+"""
+Execution policies for the event callables of a flow.
+
+By default a flow runs its event callables inline, inside the save that
+created the flow event. A slow callable, like one that sends an email, then
+adds its latency to the request. These executors run the callables off the
+request instead:
+
+ - ThreadPoolExecutor runs them on a pool of threads in the same process.
+ - QueuedExecutor stores them in the QueuedFlowCall table to be run by the
+   ``run_flow_calls`` management command. Each worker claims the calls that
+   it runs, so several workers can drain the queue.
+
+The timeout and retries of an executor are defaults that can be overridden
+for each callable by giving the flow a (callable, options) tuple.
+"""
+import logging
+import signal
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.db.models import Q
+
+from stockandflow.compat import bulk_insert
+from stockandflow.models import QueuedFlowCall, flows_by_slug
+from stockandflow.parallel import close_connections
+
+
+logger = logging.getLogger("stockandflow")
+
+
+class CallTimeout(Exception):
+    pass
+
+
+@contextmanager
+def time_limit(seconds):
+    """
+    Raise CallTimeout if the block runs for longer than the seconds. This uses
+    SIGALRM, so it only limits the main thread on unix. Elsewhere, or without
+    seconds, the block is not limited.
+    """
+    if not seconds or not hasattr(signal, "SIGALRM"):
+        yield
+        return
+    def alarm(signum, frame):
+        raise CallTimeout("The call took longer than %s seconds." % seconds)
+    try:
+        previous = signal.signal(signal.SIGALRM, alarm)
+    except ValueError: # Not the main thread
+        yield
+        return
+    signal.alarm(int(max(1, seconds)))
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def call_with_retries(func, args, retries=0, timeout=None):
+    """
+    Call the function, retrying up to retries times if it raises. The last
+    exception is raised when all the attempts fail.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        start = time.time()
+        try:
+            with time_limit(timeout):
+                return func(*args)
+        except Exception:
+            if attempt > retries:
+                raise
+            logger.warning("Retrying %s after attempt %s failed.", func, attempt,
+                           exc_info=True)
+        finally:
+            elapsed = time.time() - start
+            if timeout and elapsed > timeout:
+                logger.warning("%s took %.1f seconds, more than its %s second timeout.",
+                               func, elapsed, timeout)
+
+
+class ThreadPoolExecutor(object):
+    """
+    Run the event callables on a bounded pool of threads.
+
+    A thread can not be interrupted, so a callable that runs past its timeout
+    is logged rather than stopped. Use the QueuedExecutor when the timeout
+    must be enforced.
+    """
+    def __init__(self, workers=2, timeout=None, retries=0):
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self._pool = None
+        self._pending = []
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def _run(self, func, args, retries, timeout):
+        try:
+            call_with_retries(func, args, retries, timeout)
+        except Exception:
+            logger.exception("Event callable %s failed.", func)
+        finally:
+            close_connections()
+
+    def submit(self, flow, flowed_obj, source, sink):
+        self._pending = [r for r in self._pending if not r.ready()]
+        for func, options in flow.callable_specs:
+            self._pending.append(self.pool.apply_async(self._run, (func,
+                    (flowed_obj, source, sink), options.get("retries", self.retries),
+                    options.get("timeout", self.timeout))))
+
+    def wait(self):
+        """
+        Wait for the submitted callables to finish.
+        """
+        pending, self._pending = self._pending, []
+        for result in pending:
+            result.wait()
+
+
+class QueuedExecutor(object):
+    """
+    Queue the event callables in the QueuedFlowCall table. They are written in
+    the same transaction as the flow event and run later by the
+    ``run_flow_calls`` management command, which enforces the timeouts and
+    retries the failed calls with an exponential backoff.
+
+    The flowed object is loaded again by the worker, so the callables receive
+    the object as it is when they run.
+    """
+    def __init__(self, timeout=None, retries=0):
+        self.timeout = timeout
+        self.retries = retries
+
+    def submit(self, flow, flowed_obj, source, sink):
+        calls = []
+        for i, spec in enumerate(flow.callable_specs):
+            calls.append(QueuedFlowCall(flow=flow.slug, callable_index=i,
+                                        subject_id=str(flowed_obj.pk),
+                                        source_index=list(flow.sources).index(source),
+                                        sink_index=list(flow.sinks).index(sink)))
+        bulk_insert(QueuedFlowCall, calls)
+
+
+def claim_queued_calls(limit=100, now=None, claim_timeout=600):
+    """
+    Claim up to limit of the queued flow calls that are due and return them.
+
+    A call is claimed with a conditional UPDATE that sets a token unique to
+    this claim, so two workers never claim the same call. A claim that is
+    older than claim_timeout seconds, from a worker that died, is claimed
+    again.
+    """
+    now = now or datetime.now()
+    stale = now - timedelta(seconds=claim_timeout)
+    unclaimed = Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale)
+    due = QueuedFlowCall.objects.filter(unclaimed, failed=False, next_attempt_at__lte=now)
+    ids = list(due.values_list("id", flat=True)[:limit])
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    due.filter(id__in=ids).update(claim=token, claimed_at=now)
+    return list(QueuedFlowCall.objects.filter(claim=token))
+
+
+def run_queued_calls(limit=100, now=None, backoff=60, claim_timeout=600):
+    """
+    Claim and run up to limit queued flow calls and return a tuple of the
+    number that succeeded and the number that failed.
+
+    A failed call is retried until it has used up its retries, after
+    backoff seconds and then twice as long after each further failure.
+    """
+    now = now or datetime.now()
+    succeeded = failed = 0
+    for call in claim_queued_calls(limit, now, claim_timeout):
+        call.attempts += 1
+        retries = 0
+        try:
+            flow = flows_by_slug[call.flow]
+            func, options = flow.callable_specs[call.callable_index]
+            executor = flow.executor
+            timeout = options.get("timeout", getattr(executor, "timeout", None))
+            retries = options.get("retries", getattr(executor, "retries", 0))
+            obj = flow.subject_model._default_manager.get(pk=call.subject_id)
+            with time_limit(timeout):
+                func(obj, flow.sources[call.source_index], flow.sinks[call.sink_index])
+        except Exception as e:
+            logger.warning("Queued %s failed.", call, exc_info=True)
+            call.last_error = repr(e)
+            call.failed = call.attempts > retries
+            call.next_attempt_at = now + timedelta(seconds=backoff * 2 ** (call.attempts - 1))
+            call.claim = ""
+            call.claimed_at = None
+            call.save()
+            failed += 1
+        else:
+            call.delete()
+            succeeded += 1
+    return succeeded, failed
@@ -0,0 +1,133 @@
+"""
+Export the stock records, stock facet records and flow events as CSV or
+NDJSON without loading whole querysets.
+
+The rows are read as tuples in chunks of primary keys, so the memory used
+does not grow with the size of the export, and an interrupted export can be
+resumed after the last primary key that it wrote.
+"""
+import csv
+import json
+from datetime import datetime
+
+from stockandflow.models import StockRecord, StockFacetRecord, flows_by_slug, reading_queryset
+
+
+FORMATS = ("csv", "ndjson")
+KINDS = ("stock_records", "facet_records", "flow_events")
+
+_FACET_RECORD_COLUMNS = ["id", "stock_record", "stock_record__stock",
+                         "stock_record__timestamp", "facet", "value", "count"]
+
+
+class _Echo(object):
+    """
+    A file-like object for the csv writer that returns the line rather than
+    writing it.
+    """
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    if isinstance(value, bytes):
+        return value
+    return (u"%s" % value).encode("utf-8")
+
+
+def parse_datetime(value):
+    """
+    Parse a date or datetime given as YYYY-MM-DD, YYYY-MM-DD HH:MM or
+    YYYY-MM-DD HH:MM:SS. Raises ValueError if it is none of those.
+    """
+    value = value.replace("T", " ")
+    for format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("'%s' is not a date or datetime." % value)
+
+
+def export_queryset(kind, slug=None, start=None, end=None, using=None):
+    """
+    Return a tuple of the queryset and the columns to export for the kind of
+    rows, filtered by the stock or flow slug and the time range from start up
+    to end. A slug is required for flow events because each flow can have
+    its own flow event model.
+
+    The queryset reads from the using alias, otherwise the read database of
+    the flow or the STOCKANDFLOW_READ_DATABASE setting (see reading_queryset).
+    """
+    if kind == "stock_records":
+        qs, columns, timestamp = StockRecord.objects.all(), None, "timestamp"
+        if slug:
+            qs = qs.filter(stock=slug)
+    elif kind == "facet_records":
+        qs, columns, timestamp = (StockFacetRecord.objects.all(), _FACET_RECORD_COLUMNS,
+                                  "stock_record__timestamp")
+        if slug:
+            qs = qs.filter(stock_record__stock=slug)
+    elif kind == "flow_events":
+        if slug not in flows_by_slug:
+            raise ValueError("Give the slug of a flow to export its events.")
+        flow = flows_by_slug[slug]
+        qs, columns, timestamp = flow.queryset, None, "timestamp"
+        using = using or flow.using
+    else:
+        raise ValueError("The kind must be one of %s, not '%s'." % (", ".join(KINDS), kind))
+    if columns is None:
+        columns = [f.attname for f in qs.model._meta.fields]
+    if start:
+        qs = qs.filter(**{timestamp + "__gte": start})
+    if end:
+        qs = qs.filter(**{timestamp + "__lt": end})
+    return reading_queryset(qs, using), columns
+
+
+def export_rows(queryset, columns, after=None, chunk_size=1000):
+    """
+    Yield the rows of the queryset as tuples of the columns in primary key
+    order, starting after the primary key given by after. The first column
+    must be the primary key.
+    """
+    while True:
+        chunk = queryset.order_by("pk")
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        rows = list(chunk.values_list(*columns)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1][0]
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([csv_value(v) for v in row])
+
+
+def ndjson_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=str) + "\n"
+
+
+def export_lines(kind, format="csv", slug=None, start=None, end=None, after=None,
+                 chunk_size=1000, using=None):
+    """
+    Return a generator of the lines of an export.
+    """
+    if format not in FORMATS:
+        raise ValueError("The format must be one of %s, not '%s'." % (", ".join(FORMATS), format))
+    queryset, columns = export_queryset(kind, slug, start, end, using)
+    rows = export_rows(queryset, columns, after, chunk_size)
+    if format == "csv":
+        return csv_lines(columns, rows)
+    return ndjson_lines(columns, rows)
@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import *
+
+
+urlpatterns = patterns("",
+    url(r"^(?P<kind>stock_records|facet_records|flow_events)/$", "stockandflow.views.export", name="stockandflow_export"),
+)
@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stockandflow.archive import archive_flow_events, ArchiveError, FORMATS
+from stockandflow.models import flows_by_slug
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--directory", dest="directory",
+                    help="The directory to write the archive files to."),
+        make_option("--chunk-size", type="int", dest="chunk_size", default=1000,
+                    help="The number of events to delete in each transaction."),
+        make_option("--format", dest="format", default="csv", choices=FORMATS,
+                    help="The format of the archive files: %s." % ", ".join(FORMATS)),
+        make_option("--period", action="append", dest="periods",
+                    help="A rollup period that the events must have been rolled up to. "
+                         "Defaults to every period that they have been rolled up to."),
+    )
+    args = "[flow_slug ...]"
+    help = ("Archive the flow events that are older than the retention_days of their "
+            "flow to gzipped files and delete them. All the flows with a retention are "
+            "archived unless flow slugs are given. The events must have been rolled up.")
+
+    def handle(self, *args, **options):
+        if not options["directory"]:
+            raise CommandError("Give the directory for the archive files with --directory.")
+        if args:
+            try:
+                flows = [flows_by_slug[slug] for slug in args]
+            except KeyError as e:
+                raise CommandError("There is no flow %s." % e)
+        else:
+            flows = [f for f in flows_by_slug.values() if f.retention_days]
+        for flow in flows:
+            try:
+                archived, path = archive_flow_events(flow, options["directory"],
+                                                     chunk_size=options["chunk_size"],
+                                                     format=options["format"],
+                                                     periods=options["periods"])
+            except ArchiveError as e:
+                self.stderr.write("%s\n" % e)
+                continue
+            if archived:
+                self.stdout.write("Archived %s events of %s to %s.\n" % (archived, flow.slug, path))
+            else:
+                self.stdout.write("There are no events of %s to archive.\n" % flow.slug)
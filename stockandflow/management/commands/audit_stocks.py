@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stockandflow.audit import audit_stocks, registered_stocks
+from stockandflow.export import parse_datetime
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--start", dest="start",
+                    help="Only audit from this date or datetime, YYYY-MM-DD HH:MM:SS."),
+        make_option("--end", dest="end",
+                    help="Only audit up to this date or datetime."),
+        make_option("--tolerance", type="int", dest="tolerance", default=0,
+                    help="The drift of an interval that is not reported."),
+    )
+    args = "[stock_slug ...]"
+    help = ("Compare the change in the exact count of each stock between its records "
+            "with the net flow events and report the drift. All the stocks of the "
+            "registered flows are audited unless stock slugs are given.")
+
+    def handle(self, *args, **options):
+        stocks = registered_stocks()
+        if args:
+            by_slug = dict((s.slug, s) for s in stocks)
+            try:
+                stocks = [by_slug[slug] for slug in args]
+            except KeyError as e:
+                raise CommandError("There is no stock %s in a registered flow." % e)
+        try:
+            start, end = [parse_datetime(options[k]) if options[k] else None
+                          for k in ("start", "end")]
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(audit_stocks(stocks, start, end, options["tolerance"]) + "\n")
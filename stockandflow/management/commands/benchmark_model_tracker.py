@@ -0,0 +1,62 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from stockandflow.tracker import ModelTracker, suspended
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--rows", type="int", dest="rows", default=100000,
+                    help="The number of instances to create in each run."),
+        make_option("--fields", dest="fields", default="",
+                    help="A comma separated list of fields to track with a benchmark "
+                         "tracker, for models that have no tracker registered."),
+    )
+    args = "<app_label.ModelName>"
+    help = ("Measure the time that the model trackers add to creating instances of a "
+            "model, as happens for every row that a queryset loads.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or "." not in args[0]:
+            raise CommandError("Give the model as app_label.ModelName.")
+        model = get_model(*args[0].split("."))
+        if model is None:
+            raise CommandError("There is no model %s." % args[0])
+        if options["fields"]:
+            # Keep a reference, as the model only holds a weak reference to it
+            tracker = ModelTracker(options["fields"].split(","),
+                                   lambda previous, current: ((), ()),
+                                   flows=[_BenchmarkFlow(model)])
+        # Instantiate from one row the way a queryset does, without the database
+        obj = model._default_manager.all()[:1]
+        obj = obj[0] if obj else model()
+        row = [getattr(obj, f.attname) for f in model._meta.fields]
+        rows = options["rows"]
+
+        tracked = self.time_instances(model, row, rows)
+        with suspended():
+            untracked = self.time_instances(model, row, rows)
+        self.stdout.write("Created %s %s instances.\n" % (rows, model.__name__))
+        self.stdout.write("Tracked:   %.2f seconds, %.2f us per instance.\n" %
+                          (tracked, tracked * 1e6 / rows))
+        self.stdout.write("Untracked: %.2f seconds, %.2f us per instance.\n" %
+                          (untracked, untracked * 1e6 / rows))
+        self.stdout.write("Tracking overhead: %.2f us per instance.\n" %
+                          ((tracked - untracked) * 1e6 / rows))
+
+    def time_instances(self, model, row, rows):
+        start = time.time()
+        for i in range(rows):
+            model(*row)
+        return time.time() - start
+
+
+class _BenchmarkFlow(object):
+    """
+    Stands in for a flow so that a benchmark tracker can find the model.
+    """
+    def __init__(self, model):
+        self.subject_model = model
@@ -0,0 +1,65 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stockandflow.export import (export_queryset, export_rows, csv_lines, ndjson_lines,
+                                 parse_datetime, FORMATS, KINDS)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--format", dest="format", default="csv", choices=FORMATS,
+                    help="The format of the export: %s." % ", ".join(FORMATS)),
+        make_option("--slug", dest="slug",
+                    help="Only export the records of this stock or the events of this flow."),
+        make_option("--start", dest="start",
+                    help="Only export from this date or datetime, YYYY-MM-DD HH:MM:SS."),
+        make_option("--end", dest="end",
+                    help="Only export up to this date or datetime."),
+        make_option("--after", type="int", dest="after",
+                    help="Resume the export after this primary key."),
+        make_option("--chunk-size", type="int", dest="chunk_size", default=1000,
+                    help="The number of rows to read in each query."),
+        make_option("--output", dest="output",
+                    help="The file to write to instead of stdout."),
+    )
+    args = "<%s>" % "|".join(KINDS)
+    help = ("Export the stock records, stock facet records or the events of a flow as "
+            "CSV or NDJSON. The last primary key is reported so that an interrupted "
+            "export can be resumed with --after.")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give one of %s to export." % ", ".join(KINDS))
+        try:
+            start, end = [parse_datetime(options[k]) if options[k] else None
+                          for k in ("start", "end")]
+            queryset, columns = export_queryset(args[0], options["slug"], start, end)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.exported = 0
+        self.last_pk = None
+        rows = self.track(export_rows(queryset, columns, options["after"],
+                                      options["chunk_size"]))
+        if options["format"] == "csv":
+            lines = csv_lines(columns, rows)
+        else:
+            lines = ndjson_lines(columns, rows)
+        out = open(options["output"], "wb") if options["output"] else self.stdout
+        try:
+            for line in lines:
+                out.write(line)
+        finally:
+            if options["output"]:
+                out.close()
+        self.stderr.write("Exported %s rows up to primary key %s.\n" % (self.exported,
+                                                                       self.last_pk))
+
+    def track(self, rows):
+        """
+        Count the rows and remember the last primary key as they go past.
+        """
+        for row in rows:
+            self.exported += 1
+            self.last_pk = row[0]
+            yield row
@@ -0,0 +1,31 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from stockandflow.executors import run_queued_calls
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option("--limit", type="int", dest="limit", default=100,
+                    help="The number of queued calls to run in each batch."),
+        make_option("--forever", action="store_true", dest="forever", default=False,
+                    help="Keep polling the queue instead of stopping when it is empty."),
+        make_option("--sleep", type="float", dest="sleep", default=5,
+                    help="The seconds to wait between polls of an empty queue."),
+        make_option("--backoff", type="float", dest="backoff", default=60,
+                    help="The seconds to wait before the first retry of a failed call. "
+                         "The wait doubles after each further failure."),
+    )
+    help = "Run the flow event callables that were queued by a QueuedExecutor."
+
+    def handle_noargs(self, *args, **options):
+        while True:
+            succeeded, failed = run_queued_calls(options["limit"], backoff=options["backoff"])
+            if succeeded or failed:
+                self.stdout.write("Ran %s queued calls, %s failed.\n" % (succeeded + failed, failed))
+            if succeeded + failed < options["limit"]:
+                if not options["forever"]:
+                    break
+                time.sleep(options["sleep"])
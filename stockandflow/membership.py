@@ -0,0 +1,120 @@
+"""
+Compact snapshots of the members of a stock.
+
+The primary keys of the members are sorted and stored as the deltas between
+consecutive keys, each as a varint, and the result is zlib compressed. The
+keys of a stock are usually dense, so most deltas fit in a single byte that
+compresses further, and a million members take well under a megabyte.
+"""
+import base64
+import zlib
+
+
+def encode_members(pks):
+    """
+    Return the integer primary keys, in ascending order as from
+    order_by("pk"), as a compact ASCII string. The keys can be any iterable,
+    such as a queryset iterator, and are encoded and compressed as they come
+    so they are never all held in memory. Repeated keys are stored once.
+    """
+    compressor = zlib.compressobj(9)
+    compressed = []
+    out = bytearray()
+    previous = None
+    for pk in pks:
+        if not isinstance(pk, (int, long)) or pk < 0:
+            raise ValueError("Membership snapshots need non-negative integer primary keys, "
+                             "not %r." % (pk,))
+        if previous is not None and pk <= previous:
+            if pk == previous:
+                continue
+            raise ValueError("The primary keys must be in ascending order, %r came after %r."
+                             % (pk, previous))
+        delta = pk - (previous or 0)
+        previous = pk
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+        if len(out) >= 65536:
+            compressed.append(compressor.compress(bytes(out)))
+            out = bytearray()
+    compressed.append(compressor.compress(bytes(out)))
+    compressed.append(compressor.flush())
+    return base64.b64encode(b"".join(compressed)).decode("ascii")
+
+
+def has_integer_pk(model):
+    """
+    Return True if the primary keys of the model are integers, following a
+    primary key that is a relation, as in multi-table inheritance, to the key
+    it refers to.
+    """
+    from django.db import models
+    pk = model._meta.pk
+    while getattr(pk, "rel", None) is not None:
+        pk = pk.rel.get_related_field()
+    return isinstance(pk, (models.AutoField, models.IntegerField))
+
+
+def decode_members(data):
+    """
+    Return the sorted list of primary keys of a string from encode_members.
+    """
+    raw = bytearray(zlib.decompress(base64.b64decode(data)))
+    pks = []
+    pk = 0
+    delta = 0
+    shift = 0
+    for byte in raw:
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            pk += delta
+            pks.append(pk)
+            delta = 0
+            shift = 0
+    return pks
+
+
+class MembershipSnapshot(object):
+    """
+    The set of the primary keys of the members of a stock at a point in time.
+
+    Snapshots support the set operations with each other, as methods or as the
+    -, & and | operators, which return new snapshots. For example the members
+    that left the stock between two snapshots are ``before - after``.
+    """
+    def __init__(self, pks=(), timestamp=None):
+        self.members = frozenset(pks)
+        self.timestamp = timestamp
+
+    @classmethod
+    def decode(cls, data, timestamp=None):
+        return cls(decode_members(data), timestamp)
+
+    def encode(self):
+        return encode_members(sorted(self.members))
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, pk):
+        return pk in self.members
+
+    def __iter__(self):
+        return iter(sorted(self.members))
+
+    def difference(self, other):
+        return MembershipSnapshot(self.members - other.members)
+
+    def intersection(self, other):
+        return MembershipSnapshot(self.members & other.members)
+
+    def union(self, other):
+        return MembershipSnapshot(self.members | other.members)
+
+    __sub__ = difference
+    __and__ = intersection
+    __or__ = union
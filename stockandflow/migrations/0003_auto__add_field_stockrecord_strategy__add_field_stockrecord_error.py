@@ -0,0 +1,54 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'StockRecord.strategy'
+        db.add_column('stockandflow_stockrecord', 'strategy', self.gf('django.db.models.fields.SlugField')(default='exact', max_length=50, db_index=True), keep_default=False)
+
+        # Adding field 'StockRecord.error'
+        db.add_column('stockandflow_stockrecord', 'error', self.gf('django.db.models.fields.PositiveIntegerField')(default=0), keep_default=False)
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'StockRecord.strategy'
+        db.delete_column('stockandflow_stockrecord', 'strategy')
+
+        # Deleting field 'StockRecord.error'
+        db.delete_column('stockandflow_stockrecord', 'error')
+
+
+    models = {
+        'stockandflow.periodicschedule': {
+            'Meta': {'object_name': 'PeriodicSchedule'},
+            'call_count': ('django.db.models.fields.IntegerField', [], {'default': '0', 'null': 'True'}),
+            'frequency': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_run_timestamp': ('django.db.models.fields.DateTimeField', [], {'null': 'True'})
+        },
+        'stockandflow.stockfacetrecord': {
+            'Meta': {'object_name': 'StockFacetRecord'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'facet': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock_record': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['stockandflow.StockRecord']"}),
+            'value': ('django.db.models.fields.CharField', [], {'max_length': '200', 'db_index': 'True'})
+        },
+        'stockandflow.stockrecord': {
+            'Meta': {'ordering': "['-timestamp']", 'object_name': 'StockRecord'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'error': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'strategy': ('django.db.models.fields.SlugField', [], {'default': "'exact'", 'max_length': '50', 'db_index': 'True'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'})
+        }
+    }
+
+    complete_apps = ['stockandflow']
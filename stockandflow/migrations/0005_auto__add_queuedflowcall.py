@@ -0,0 +1,80 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'QueuedFlowCall'
+        db.create_table('stockandflow_queuedflowcall', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('flow', self.gf('django.db.models.fields.SlugField')(max_length=50, db_index=True)),
+            ('callable_index', self.gf('django.db.models.fields.PositiveIntegerField')()),
+            ('subject_id', self.gf('django.db.models.fields.CharField')(max_length=100)),
+            ('source_index', self.gf('django.db.models.fields.PositiveIntegerField')()),
+            ('sink_index', self.gf('django.db.models.fields.PositiveIntegerField')()),
+            ('created', self.gf('django.db.models.fields.DateTimeField')(default=datetime.datetime.now)),
+            ('attempts', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('failed', self.gf('django.db.models.fields.BooleanField')(default=False, db_index=True)),
+            ('last_error', self.gf('django.db.models.fields.TextField')(blank=True)),
+        ))
+        db.send_create_signal('stockandflow', ['QueuedFlowCall'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'QueuedFlowCall'
+        db.delete_table('stockandflow_queuedflowcall')
+
+
+    models = {
+        'stockandflow.periodicschedule': {
+            'Meta': {'object_name': 'PeriodicSchedule'},
+            'call_count': ('django.db.models.fields.IntegerField', [], {'default': '0', 'null': 'True'}),
+            'frequency': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_run_timestamp': ('django.db.models.fields.DateTimeField', [], {'null': 'True'})
+        },
+        'stockandflow.queuedflowcall': {
+            'Meta': {'ordering': "['id']", 'object_name': 'QueuedFlowCall'},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'callable_index': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'failed': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'db_index': 'True'}),
+            'flow': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'sink_index': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'source_index': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'subject_id': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'stockandflow.stockcrosstabrecord': {
+            'Meta': {'object_name': 'StockCrossTabRecord'},
+            'cells': ('django.db.models.fields.TextField', [], {}),
+            'facets': ('django.db.models.fields.CharField', [], {'max_length': '200', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock_record': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['stockandflow.StockRecord']"})
+        },
+        'stockandflow.stockfacetrecord': {
+            'Meta': {'object_name': 'StockFacetRecord'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'facet': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock_record': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['stockandflow.StockRecord']"}),
+            'value': ('django.db.models.fields.CharField', [], {'max_length': '200', 'db_index': 'True'})
+        },
+        'stockandflow.stockrecord': {
+            'Meta': {'ordering': "['-timestamp']", 'object_name': 'StockRecord'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'error': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'strategy': ('django.db.models.fields.SlugField', [], {'default': "'exact'", 'max_length': '50', 'db_index': 'True'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'})
+        }
+    }
+
+    complete_apps = ['stockandflow']
@@ -0,0 +1,85 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding index on 'StockRecord', fields ['stock', 'timestamp']
+        db.create_index('stockandflow_stockrecord', ['stock', 'timestamp'])
+
+
+    def backwards(self, orm):
+        
+        # Removing index on 'StockRecord', fields ['stock', 'timestamp']
+        db.delete_index('stockandflow_stockrecord', ['stock', 'timestamp'])
+
+
+    models = {
+        'stockandflow.flowrecord': {
+            'Meta': {'ordering': "['start']", 'object_name': 'FlowRecord'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'flow': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'period': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'sink': ('django.db.models.fields.SlugField', [], {'db_index': 'True', 'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'source': ('django.db.models.fields.SlugField', [], {'db_index': 'True', 'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'})
+        },
+        'stockandflow.flowrollupmark': {
+            'Meta': {'unique_together': "(('model', 'period'),)", 'object_name': 'FlowRollupMark'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_id': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'period': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'})
+        },
+        'stockandflow.periodicschedule': {
+            'Meta': {'object_name': 'PeriodicSchedule'},
+            'call_count': ('django.db.models.fields.IntegerField', [], {'default': '0', 'null': 'True'}),
+            'frequency': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_run_timestamp': ('django.db.models.fields.DateTimeField', [], {'null': 'True'})
+        },
+        'stockandflow.queuedflowcall': {
+            'Meta': {'ordering': "['id']", 'object_name': 'QueuedFlowCall'},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'callable_index': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'failed': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'db_index': 'True'}),
+            'flow': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'sink_index': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'source_index': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'subject_id': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'stockandflow.stockcrosstabrecord': {
+            'Meta': {'object_name': 'StockCrossTabRecord'},
+            'cells': ('django.db.models.fields.TextField', [], {}),
+            'facets': ('django.db.models.fields.CharField', [], {'max_length': '200', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock_record': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['stockandflow.StockRecord']"})
+        },
+        'stockandflow.stockfacetrecord': {
+            'Meta': {'object_name': 'StockFacetRecord'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'facet': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock_record': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['stockandflow.StockRecord']"}),
+            'value': ('django.db.models.fields.CharField', [], {'max_length': '200', 'db_index': 'True'})
+        },
+        'stockandflow.stockrecord': {
+            'Meta': {'ordering': "['-timestamp']", 'object_name': 'StockRecord'},
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'error': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stock': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'strategy': ('django.db.models.fields.SlugField', [], {'default': "'exact'", 'max_length': '50', 'db_index': 'True'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'})
+        }
+    }
+
+    complete_apps = ['stockandflow']
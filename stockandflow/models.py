@@ -1,9 +1,43 @@
-from django.db import models
+import json
+import time
+from datetime import datetime
+
+from django import VERSION
+from django.conf import settings
+from django.db import models, router
+from django.db.models import Sum
 from django.db.models.query import QuerySet
 from django.contrib import admin
 
 from model_utils.fields import AutoCreatedField
 
+from stockandflow.sql import count_clauses, merged_counts, bucketed_counts, bucketed_aggregate, \
+        bucketed_latest, UnmergeableQuery, PERIODS, PERIOD_SECONDS
+from stockandflow.compat import atomic, bulk_insert
+from stockandflow.counting import CountResult, ExactCount, EXACT
+from stockandflow.events import current_buffer
+from stockandflow.membership import MembershipSnapshot, encode_members, has_integer_pk
+
+
+# Facet counting modes
+PER_VALUE = "per_value"
+GROUPED = "grouped"
+
+# The value recorded for rows that do not match any of the facet values
+OTHER_FACET_VALUE = "__other__"
+
+
+def reading_queryset(queryset, using=None):
+    """
+    Return the queryset on the database alias for read only counting and
+    reporting queries. The alias is the given one, otherwise the
+    STOCKANDFLOW_READ_DATABASE setting, otherwise the queryset is unchanged.
+    """
+    alias = using or getattr(settings, "STOCKANDFLOW_READ_DATABASE", None)
+    if alias:
+        return queryset.using(alias)
+    return queryset
+
 
 class Stock(object):
     """
@@ -26,14 +60,51 @@ class Stock(object):
     Profile and a facet on the Profile object like "yada"="true" then a User
     stock would use the field_prefix "profile" so that the field lookup in the facet becomes
     "profile__yada"=True.
+
+    The optional live_counter is a counter store, like
+    stockandflow.counting.CacheCounterStore, that is kept up to date by the
+    flow events in and out of the stock so that count() does not need to query
+    the database.
+
+    The counting strategy defaults to an exact count. For very large stocks an
+    estimating strategy from stockandflow.counting can be used instead. The
+    strategy that produced each count is recorded in the StockRecord.
+
+    The facet_combinations list holds tuples of facet slugs, such as
+    ("ramp", "source"). Each combination is counted as a cross tab with one
+    multi-column GROUP BY query and saved in a StockCrossTabRecord.
+
+    The counting and reporting queries go to the database alias given by
+    using, such as a read replica, or the STOCKANDFLOW_READ_DATABASE setting.
+    The records are always written with the normal database routing, and
+    all() and faceted_qs() stay on the normal database so that the objects
+    they load are saved there.
+
+    The compaction is a stockandflow.compaction.CompactionPolicy that thins
+    out the old records of a frequently counted stock. The records are kept
+    forever by default.
+
+    If membership is True each snapshot also stores the primary keys of the
+    members of the stock in a StockMembershipRecord, so the members at two
+    points in time can be compared. The model must have integer primary keys.
     """
 
-    def __init__(self, slug, name, queryset, facets=[], description=""):
+    def __init__(self, slug, name, queryset, facets=[], description="",
+                 live_counter=None, counting=None, facet_combinations=[], using=None,
+                 compaction=None, membership=False):
         self.name = name
         self.slug = slug
         self.queryset = queryset # defined but not executed at import time
+        self.using = using
         self._facet_lookup = {}
         self.description = description
+        self.live_counter = live_counter
+        self.counting = counting or ExactCount()
+        self.compaction = compaction
+        self.membership = membership
+        if membership and not has_integer_pk(queryset.model):
+            raise ValueError("The %s can not store its membership because %s does not have "
+                             "integer primary keys." % (self, queryset.model._meta.object_name))
         for f in facets:
             if isinstance(f, tuple):
                 facet, field_prefix = f
@@ -41,6 +112,12 @@ class Stock(object):
                 facet = f
                 field_prefix = ""
             self._facet_lookup[facet.slug] = (facet, field_prefix)
+        for combination in facet_combinations:
+            for facet_slug in combination:
+                if facet_slug not in self._facet_lookup:
+                    raise ValueError("The combination %s uses the facet '%s' which is "
+                                     "not a facet of %s." % (combination, facet_slug, self))
+        self.facet_combinations = [tuple(c) for c in facet_combinations]
         self.inflows = []
         self.outflows = []
 
@@ -52,6 +129,13 @@ class Stock(object):
     def subject_model(self):
         return self.queryset.model
 
+    @property
+    def read_queryset(self):
+        """
+        The queryset on the database alias for counting and reporting.
+        """
+        return reading_queryset(self.queryset, self.using)
+
     @property
     def definition(self):
         """
@@ -75,19 +159,79 @@ class Stock(object):
         self.outflows.append(flow)
 
     def most_recent_record(self):
-        return StockRecord.objects.filter(stock=self.slug)[0]
+        return reading_queryset(StockRecord.objects.filter(stock=self.slug), self.using)[0]
+
+    def history(self, start, end, resolution=None, agg="last", strategy=None, max_points=500):
+        """
+        Return a list of (bucket start, count) tuples of the records of this
+        stock from start up to end, with one point per bucket of the
+        resolution, which is "minute", "hour", "day" or "month". The buckets
+        are downsampled in the database with the agg, which is "last", "min",
+        "max" or "avg". The buckets without records are left out.
+
+        Without a resolution the finest one that gives at most max_points
+        points is used. The strategy limits the history to the records of one
+        counting strategy.
+        """
+        if resolution is None:
+            span = (end - start).days * 86400 + (end - start).seconds
+            for resolution in PERIODS:
+                if span <= PERIOD_SECONDS[resolution] * max_points:
+                    break
+        qs = reading_queryset(StockRecord.objects.all(), self.using)
+        qs = qs.filter(stock=self.slug, timestamp__gte=start, timestamp__lt=end)
+        if strategy:
+            qs = qs.filter(strategy=strategy)
+        if agg in ("min", "max", "avg"):
+            return bucketed_aggregate(qs, "timestamp", resolution, agg.upper(), "count")
+        if agg != "last":
+            raise ValueError("The agg must be last, min, max or avg, not '%s'." % agg)
+        return bucketed_latest(qs, "timestamp", resolution, "count")
 
     def all(self):
         """
-        A shortcut for the queryset
+        A shortcut for the queryset. This stays on the normal database, so
+        the objects that it loads are saved there.
         """
         return self.queryset
 
     def count(self):
         """
-        A shortcut for a count of the queryset
+        A shortcut for a count of the queryset using the counting strategy. If
+        the stock has a live counter then the live count is returned instead.
         """
-        return self.queryset.count()
+        if self.live_counter is None:
+            return self.measure().value
+        live = self.live_counter.get(self)
+        if live is None:
+            live = self.read_queryset.count()
+            self.live_counter.set(self, live)
+        return live
+
+    def measure(self):
+        """
+        Count the queryset with the counting strategy and return a
+        CountResult of the value, its error bound and the strategy name.
+        """
+        return self.counting.measure(self.read_queryset)
+
+    def adjust_live_count(self, delta):
+        """
+        Adjust the live count, if there is a live counter, by the delta.
+        """
+        if self.live_counter is not None:
+            self.live_counter.adjust(self, delta)
+
+    def reconcile_live_count(self):
+        """
+        Reset the live count to the count of the queryset. Returns a tuple of
+        the (live, actual) counts from before the reset. The live count is None
+        if it was missing.
+        """
+        live = self.live_counter.get(self)
+        actual = self.read_queryset.count()
+        self.live_counter.set(self, actual)
+        return live, actual
 
     def flows_into(self):
         """
@@ -125,7 +269,7 @@ class Stock(object):
             return self.queryset
         if not facet_slug or not value:
             return self.queryset
-        if value in facet.values:
+        if facet.has_value(value):
             q_obj = facet.get_Q(value, field_prefix)
             return self.queryset.filter(q_obj)
         else:
@@ -137,17 +281,153 @@ class Stock(object):
         except KeyError:
             return None
 
-    def save_count(self):
+    def facet_counts(self):
+        """
+        A list of (facet_slug, value, count) tuples for all the facets of this
+        stock. The number of queries depends on each facet's count_mode.
+        """
+        rv = []
+        for facet, field_prefix in self.facet_tuples:
+            for value, cnt in facet.count_in(self.read_queryset, field_prefix):
+                rv.append((facet.slug, value, cnt))
+        return rv
+
+    def cross_tab_counts(self):
         """
-        Save a record of the current count for the stock and any facets.
+        A list of (facet_slugs, cells) tuples, one for each facet combination,
+        where the cells dict maps a tuple of values to a count. Each
+        combination takes one query. As with a GROUPED facet count, the values
+        that are not in a facet's values are counted as OTHER_FACET_VALUE.
+        """
+        rv = []
+        pk_name = self.queryset.model._meta.pk.name if self.facet_combinations else None
+        for facet_slugs in self.facet_combinations:
+            field_strs = []
+            value_sets = []
+            for facet_slug in facet_slugs:
+                facet, field_prefix = self._facet_lookup[facet_slug]
+                field_strs.append(facet.field_path(field_prefix))
+                value_sets.append(facet.value_set)
+            rows = self.read_queryset.order_by().values(*field_strs).annotate(
+                    facet_count=models.Count(pk_name))
+            cells = {}
+            for row in rows:
+                key = []
+                for field_str, value_set in zip(field_strs, value_sets):
+                    value = row[field_str]
+                    key.append(value if value in value_set else OTHER_FACET_VALUE)
+                key = tuple(key)
+                cells[key] = cells.get(key, 0) + row["facet_count"]
+            rv.append((facet_slugs, cells))
+        return rv
+
+    def most_recent_cross_tab(self, *facet_slugs):
+        """
+        Return the most recent StockCrossTabRecord for the combination of
+        facets.
+        """
+        return StockCrossTabRecord.objects.filter(stock_record__stock=self.slug,
+                facets=",".join(facet_slugs)).order_by("-stock_record__timestamp")[0]
+
+    def save_count(self, count=None):
+        """
+        Save and return a record of the current count for the stock and any
+        facets. The count (an int or a CountResult) can be given if it has
+        already been measured, for example by measure_stocks.
+        """
+        snapshot = StockSnapshot()
+        self.add_to_snapshot(snapshot, count)
+        return snapshot.write()[0]
+
+    def add_to_snapshot(self, snapshot, count=None):
         """
-        sr = StockRecord.objects.create(stock=self.slug, count=self.queryset.count())
-        for facet_tuple in self.facet_tuples:
-            facet, field_prefix = facet_tuple
-            for value, q in facet.to_count(field_prefix):
-                cnt = self.queryset.filter(q).count()
-                srf = StockFacetRecord.objects.create(stock_record=sr, facet=facet.slug,
-                                                      value=value, count=cnt)
+        Measure the stock and its facets and add them to a StockSnapshot
+        without writing anything.
+        """
+        if count is None:
+            count = self.measure()
+        snapshot.add(self, count, self.facet_counts(), self.cross_tab_counts(),
+                     self.member_pks() if self.membership else None)
+
+    def member_pks(self):
+        """
+        Return an iterator over the primary keys of the members of the stock in
+        ascending order, which StockSnapshot.add encodes as they are read.
+        """
+        return self.read_queryset.order_by("pk").values_list("pk", flat=True).iterator()
+
+    def membership_at(self, timestamp=None):
+        """
+        Return a MembershipSnapshot of the members in the most recent
+        membership record at or before the timestamp, or the latest one.
+        """
+        qs = reading_queryset(StockMembershipRecord.objects.all(), self.using) \
+                .filter(stock_record__stock=self.slug).select_related("stock_record")
+        if timestamp is not None:
+            qs = qs.filter(stock_record__timestamp__lte=timestamp)
+        record = qs.order_by("-stock_record__timestamp", "-id")[0]
+        return record.as_snapshot()
+
+
+def measure_stocks(stocks):
+    """
+    Return a dict mapping each stock to a CountResult of its current count.
+
+    The exactly counted stocks that query the same model through the same
+    joins are counted together in one scan of the table with a conditional
+    aggregate for each stock. A stock whose queryset can not be merged (for
+    example because it is sliced or distinct) or that has an estimating
+    counting strategy is measured on its own.
+    """
+    counts = {}
+    groups = {}
+    group_order = []
+    for stock in stocks:
+        if stock.counting.name != EXACT:
+            counts[stock] = stock.measure()
+            continue
+        try:
+            using, from_sql, from_params, where, where_params = count_clauses(stock.read_queryset)
+        except UnmergeableQuery:
+            counts[stock] = stock.measure()
+            continue
+        key = (using, from_sql, tuple(from_params))
+        if key not in groups:
+            groups[key] = []
+            group_order.append(key)
+        groups[key].append((stock, (where, where_params)))
+    for key in group_order:
+        members = groups[key]
+        if len(members) == 1:
+            stock = members[0][0]
+            counts[stock] = stock.measure()
+            continue
+        using, from_sql, from_params = key
+        results = merged_counts(using, from_sql, from_params, [m[1] for m in members])
+        for (stock, where), cnt in zip(members, results):
+            counts[stock] = CountResult(cnt, 0, EXACT)
+    return counts
+
+
+def count_stocks(stocks):
+    """
+    Return a dict mapping each stock to its current count. See measure_stocks.
+    """
+    return dict((stock, result.value) for stock, result in measure_stocks(stocks).items())
+
+
+def snapshot_stocks(stocks):
+    """
+    Save a record of the current count of each stock, and its facets, using
+    measure_stocks to scan each model once. Returns the list of StockRecords.
+
+    This can be registered directly as a periodic schedule entry.
+    """
+    counts = measure_stocks(stocks)
+    snapshot = StockSnapshot()
+    for stock in stocks:
+        stock.add_to_snapshot(snapshot, counts[stock])
+    return snapshot.write()
 
 
 class Facet(object):
@@ -157,24 +437,97 @@ class Facet(object):
      - The name is used to refer to the facet.
      - The field lookup is the same as the left side of a kwarg in a filter function.
      - Values can either be a list or a ValuesQuerySet with flat=True. If it is a
-       ValuesQuerySet then it will be re-evaluated at every use.
+       ValuesQuerySet then it will be re-evaluated at every use, unless there
+       is a cache_ttl.
+     - The count_mode is either PER_VALUE, which runs a COUNT query for each
+       value, or GROUPED, which counts all the values in a single GROUP BY
+       query and adds an OTHER_FACET_VALUE bucket for the rows that do not
+       match any of the values. GROUPED is the better choice for facets with
+       many values.
+     - The cache_ttl is the number of seconds to keep the evaluated values of
+       a ValuesQuerySet. It defaults to the STOCKANDFLOW_FACET_VALUES_TTL
+       setting, or zero for no caching. The cache is cleared whenever an
+       object of the values' model is saved or deleted in this process.
     """
-    def __init__(self, slug, name, field_lookup, values):
+    def __init__(self, slug, name, field_lookup, values, count_mode=PER_VALUE,
+                 cache_ttl=None):
         self.slug = slug
         self.name = name
         self.field_lookup = field_lookup
         self._given_values = values
+        if count_mode not in (PER_VALUE, GROUPED):
+            raise ValueError("The count mode must be PER_VALUE or GROUPED.")
+        self.count_mode = count_mode
+        self._cache_ttl = cache_ttl
+        self._cached_values = None
+        self._cached_value_set = None
+        self._cached_at = 0
+        self._is_queryset = isinstance(values, models.query.ValuesQuerySet)
+        if self._is_queryset:
+            uid = "stockandflow_facet_%s" % id(self)
+            models.signals.post_save.connect(self.invalidate, sender=values.model,
+                                             weak=False, dispatch_uid=uid)
+            models.signals.post_delete.connect(self.invalidate, sender=values.model,
+                                               weak=False, dispatch_uid=uid)
+
+    @property
+    def cache_ttl(self):
+        if self._cache_ttl is not None:
+            return self._cache_ttl
+        return getattr(settings, "STOCKANDFLOW_FACET_VALUES_TTL", 0)
 
     @property
     def values(self):
-        if isinstance(self._given_values, models.query.ValuesQuerySet):
+        if not self._is_queryset:
+            return self._given_values
+        if not self.cache_ttl:
             return self._given_values.iterator()
-        return self._given_values
+        return self._refresh_cache()[0]
+
+    @property
+    def value_set(self):
+        """
+        The values as a set for fast membership checks.
+        """
+        if self._is_queryset and self.cache_ttl:
+            return self._refresh_cache()[1]
+        if self._is_queryset:
+            return set(self.values)
+        if self._cached_value_set is None:
+            self._cached_value_set = set(self._given_values)
+        return self._cached_value_set
+
+    def has_value(self, value):
+        return value in self.value_set
+
+    def _refresh_cache(self):
+        """
+        Return a tuple of the cached values and value set, evaluating them
+        again if they have expired. The tuple is returned rather than read
+        back from the cache because a signal can invalidate it at any time.
+        """
+        now = time.time()
+        values, value_set = self._cached_values, self._cached_value_set
+        if values is None or value_set is None or now - self._cached_at > self.cache_ttl:
+            values = list(self._given_values.iterator())
+            value_set = set(values)
+            self._cached_value_set = value_set
+            self._cached_values = values
+            self._cached_at = now
+        return values, value_set
+
+    def invalidate(self, sender=None, **kwargs):
+        """
+        Clear the cached values. This receives the post_save and post_delete
+        signals of the values' model.
+        """
+        self._cached_values = None
+        self._cached_value_set = None
 
     @property
     def choices(self):
         rv = ["", "Not selected"]
-        for v in self.values():
+        for v in self.values:
             rv.append((v,v))
         return rv
 
@@ -185,11 +538,15 @@ class Facet(object):
         The field_prefix string allows the field lookup to apply to related
         models by supplying the lookup path to the expected field.
         """
+        return models.Q(**{self.field_path(field_prefix): value})
+
+    def field_path(self, field_prefix=""):
+        """
+        The field lookup with the (optional) field_prefix prepended.
+        """
         if field_prefix:
-            field_str = field_prefix + "__" + self.field_lookup
-        else:
-            field_str = self.field_lookup
-        return models.Q(**{field_str: value})
+            return field_prefix + "__" + self.field_lookup
+        return self.field_lookup
 
     def to_count(self, field_prefix=""):
         """
@@ -201,6 +558,39 @@ class Facet(object):
         """
         return ((v, self.get_Q(v, field_prefix)) for v in self.values)
 
+    def count_in(self, queryset, field_prefix=""):
+        """
+        Return a list of (value, count) tuples for this facet within the
+        queryset using the facet's count_mode.
+        """
+        if self.count_mode == GROUPED:
+            return self.grouped_count(queryset, field_prefix)
+        return [(v, queryset.filter(q).count()) for v, q in self.to_count(field_prefix)]
+
+    def grouped_count(self, queryset, field_prefix=""):
+        """
+        Count every value of this facet within the queryset using one
+        aggregate query. Values without any rows get a count of zero and the
+        rows whose value is not in the facet values are counted in a final
+        OTHER_FACET_VALUE bucket.
+        """
+        field_str = self.field_path(field_prefix)
+        values = list(self.values)
+        counts = dict((v, 0) for v in values)
+        other = 0
+        # Clear the ordering because ordering fields are added to the GROUP BY
+        rows = queryset.order_by().values(field_str).annotate(
+                facet_count=models.Count(queryset.model._meta.pk.name))
+        for row in rows:
+            value = row[field_str]
+            if value in counts:
+                counts[value] += row["facet_count"]
+            else:
+                other += row["facet_count"]
+        rv = [(v, counts[v]) for v in values]
+        rv.append((OTHER_FACET_VALUE, other))
+        return rv
+
 
 class StockFacetQuerySet(QuerySet):
     def __init__(self, stock=None, facet_slug="", facet_value="", *args, **kwargs):
@@ -218,6 +608,10 @@ class StockFacetQuerySet(QuerySet):
             super(StockFacetQuerySet, self).__init__(*args, **kwargs)
 
 
+# All the flows by slug, used to find a flow from a stored record
+flows_by_slug = {}
+
+
 class Flow(object):
     """
     A named relationship between stocks representing the transition of an
@@ -238,16 +632,42 @@ class Flow(object):
     The optional event_callables list is called whenever an flow event is created for
     this flow. It receives the flowed_obj, source and sink. An example use
     would be to send an email each time an activating flow occurs.
+
+    As with a Stock, the reporting queries go to the database alias given by
+    using or the STOCKANDFLOW_READ_DATABASE setting while the flow events are
+    written with the normal database routing.
+
+    An event callable can also be given as a tuple of (callable, options) where
+    the options dict may set the "timeout" and "retries" for that callable.
+    The executor decides how the callables are run. The default runs them
+    inline, the others are in stockandflow.executors.
+
+    The events older than retention_days are moved to files by the
+    archive_flow_events management command. They are kept forever by default.
     """
     def __init__(self, slug, name, flow_event_model, sources=[], sinks=[],
-                 event_callables=[], description=""):
+                 event_callables=[], description="", using=None, executor=None,
+                 retention_days=None):
         self.slug = slug
+        self.using = using
         self.name = name
         self.flow_event_model = flow_event_model
         self.sources = sources
         self.sinks = sinks
+        # sets for the membership test of every flow event
+        self._source_set = frozenset(sources)
+        self._sink_set = frozenset(sinks)
         self.event_callables = event_callables
+        self.callable_specs = []
+        for c in event_callables:
+            if isinstance(c, tuple):
+                self.callable_specs.append(c)
+            else:
+                self.callable_specs.append((c, {}))
+        self.executor = executor
+        self.retention_days = retention_days
         self.description = description
+        flows_by_slug[slug] = self
         self.queryset = flow_event_model.objects.filter(flow=self.slug)
         # If a flow connects stocks they must track the same class
         stock_cls = None
@@ -268,6 +688,7 @@ class Flow(object):
             if s and isinstance(s, Stock): s.register_outflow(self)
         for s in sinks:
             if s and isinstance(s, Stock): s.register_inflow(self)
+        flow_router.add(self)
 
     def __str__(self):
         return "flow '%s'" % self.slug
@@ -283,28 +704,131 @@ class Flow(object):
         """
         str(self.queryset.query).split(" WHERE ")[1][1:-2]
 
-    def add_event(self, flowed_obj, source=None, sink=None):
+    def connects(self, source, sink):
         """
-        Record and return a flow event involving the (optional) object.
-        If the flow does not connect the source and sink then return None.
+        Return True if this flow records the transition from source to sink.
         """
-        if source is sink or source not in self.sources or sink not in self.sinks:
-            return None
-        args = { "flow": self.slug, "subject": flowed_obj }
+        return source is not sink and source in self._source_set and sink in self._sink_set
+
+    def build_event(self, flowed_obj, source, sink):
+        """
+        Return an unsaved flow event. The flowed_obj can also be given as the
+        primary key of the object.
+        """
+        args = { "flow": self.slug }
+        if isinstance(flowed_obj, models.Model):
+            args["subject"] = flowed_obj
+        else:
+            args["subject_id"] = flowed_obj
         # If the source or sink is not a Stock instance then treat it as external
         args["source"] = source.slug if isinstance(source, Stock) else None
         args["sink"] = sink.slug if isinstance(sink, Stock) else None
-        fe = self.flow_event_model(**args)
-        fe.save()
-        for c in self.event_callables:
-            c(flowed_obj, source, sink)
+        return self.flow_event_model(**args)
+
+    def add_event(self, flowed_obj, source=None, sink=None, sync=False):
+        """
+        Record and return a flow event involving the (optional) object.
+        If the flow does not connect the source and sink then return None.
+
+        Inside a stockandflow.events.buffered_flow_events block the event is
+        buffered and returned unsaved, unless sync is True. The live counts
+        and the event callables of a buffered event wait until the block
+        commits.
+        """
+        if not self.connects(source, sink):
+            return None
+        fe = self.build_event(flowed_obj, source, sink)
+        buffer = None if sync else current_buffer()
+        if buffer is None:
+            fe.save()
+            self.event_recorded(flowed_obj, source, sink)
+        else:
+            buffer.add(fe, self.event_recorded, (flowed_obj, source, sink))
         return fe
 
+    def event_recorded(self, flowed_obj, source, sink):
+        """
+        Adjust the live counts of the stocks and run the event callables once
+        an event has been recorded.
+        """
+        if isinstance(source, Stock):
+            source.adjust_live_count(-1)
+        if isinstance(sink, Stock):
+            sink.adjust_live_count(1)
+        self.run_callables(flowed_obj, source, sink)
+
+    def add_events(self, transitions, run_callables=False, chunk_size=1000,
+                   transactional=True):
+        """
+        Record the flow events for an iterable of (flowed_obj, source, sink)
+        tuples, for example to backfill the events after a data migration. The
+        flowed_obj can also be the primary key of the object.
+
+        The transitions that this flow does not connect are skipped. The events
+        are written with one bulk insert per chunk, each in its own
+        transaction, so the transitions can be a generator over any number of
+        rows. Pass transactional=False to write the chunks in the caller's
+        transaction instead, because before Django 1.6 a nested transaction
+        commits the outer one.
+
+        The event callables only run if run_callables is True. They are given
+        the objects, so the primary keys of each chunk are loaded with one
+        query, and the objects that no longer exist are skipped.
+
+        Returns the number of events recorded.
+        """
+        recorded = 0
+        deltas = {}
+        chunk = []
+        for flowed_obj, source, sink in transitions:
+            if not self.connects(source, sink):
+                continue
+            chunk.append((flowed_obj, source, sink))
+            for stock, delta in ((source, -1), (sink, 1)):
+                if isinstance(stock, Stock):
+                    deltas[stock] = deltas.get(stock, 0) + delta
+            if len(chunk) >= chunk_size:
+                recorded += self._write_chunk(chunk, run_callables, transactional)
+                chunk = []
+        if chunk:
+            recorded += self._write_chunk(chunk, run_callables, transactional)
+        for stock, delta in deltas.items():
+            stock.adjust_live_count(delta)
+        return recorded
+
+    def _write_chunk(self, chunk, run_callables, transactional=True):
+        events = [self.build_event(*transition) for transition in chunk]
+        if transactional:
+            with atomic():
+                bulk_insert(self.flow_event_model, events)
+        else:
+            bulk_insert(self.flow_event_model, events)
+        if run_callables:
+            pks = [obj for obj, source, sink in chunk if not isinstance(obj, models.Model)]
+            objs = self.subject_model._default_manager.in_bulk(pks) if pks else {}
+            for flowed_obj, source, sink in chunk:
+                if not isinstance(flowed_obj, models.Model):
+                    flowed_obj = objs.get(flowed_obj)
+                    if flowed_obj is None: # Deleted since
+                        continue
+                self.run_callables(flowed_obj, source, sink)
+        return len(chunk)
+
+    def run_callables(self, flowed_obj, source, sink):
+        """
+        Run the event callables for a transition with the flow's executor.
+        """
+        if self.executor is not None:
+            self.executor.submit(self, flowed_obj, source, sink)
+            return
+        for c, options in self.callable_specs:
+            c(flowed_obj, source, sink)
+
     def all(self, source=None, sink=None):
         """
         Return a queryset of all the events associated with this flow
         """
-        qs = self.queryset
+        qs = reading_queryset(self.queryset, self.using)
         if source:
             qs = qs.filter(source=source.slug)
         if sink:
@@ -317,17 +841,121 @@ class Flow(object):
         """
         return self.all(source, sink).count()
 
+    def rate(self, start, end, bucket="hour", source=None, sink=None):
+        """
+        Return a list of (bucket start, count) tuples of the events of this flow
+        from start up to end, counted from the flow events with one GROUP BY
+        query. The bucket is one of "minute", "hour", "day" or "month" and the
+        buckets without any events are left out.
+
+        Use recorded_rate to read the rates from the rollups instead.
+        """
+        qs = self.all(source, sink).filter(timestamp__gte=start, timestamp__lt=end)
+        return bucketed_counts(qs, "timestamp", bucket)
+
+    def recorded_rate(self, start, end, period="hour", source=None, sink=None):
+        """
+        Return a list of (period start, count) tuples of the events of this flow
+        in the periods that start from start up to end, read from the
+        FlowRecords that rollup_flow_events writes instead of the events.
+
+        The periods without any events are left out. Events that have not been
+        rolled up yet are not counted.
+        """
+        qs = reading_queryset(FlowRecord.objects.all(), self.using)
+        qs = qs.filter(flow=self.slug, period=period, start__gte=start, start__lt=end)
+        if source:
+            qs = qs.filter(source=source.slug)
+        if sink:
+            qs = qs.filter(sink=sink.slug)
+        rows = qs.values("start").annotate(total=Sum("count")).order_by("start")
+        return [(row["start"], row["total"]) for row in rows]
+
+
+class FlowRouter(object):
+    """
+    An index of the flows that record each (source, sink) transition.
+
+    Every flow is added to the flow_router registry when it is created, so
+    routing a transition is a single dict lookup. A flow replaces the flow
+    with the same slug. When more than one flow connects the same pair the
+    flows are listed in the order that they were added. Flows of unrelated
+    models can share a pair, such as two flows from None, so each model
+    tracker checks its own flows for ambiguous pairs.
+    """
+    def __init__(self, flows=()):
+        self.flows = {}
+        self.routes = {}
+        for flow in flows:
+            self.add(flow)
+
+    def add(self, flow):
+        previous = self.flows.get(flow.slug)
+        if previous is not None:
+            self.remove(previous)
+        self.flows[flow.slug] = flow
+        for source in flow.sources:
+            for sink in flow.sinks:
+                if source is sink:
+                    continue
+                self.routes.setdefault((source, sink), []).append(flow)
+
+    def remove(self, flow):
+        if self.flows.get(flow.slug) is flow:
+            del self.flows[flow.slug]
+        for pair, routed in list(self.routes.items()):
+            if flow in routed:
+                routed.remove(flow)
+                if not routed:
+                    del self.routes[pair]
+
+    def flows_for(self, source, sink):
+        """
+        Return the list of the flows that connect the source and sink, in the
+        order that they were added.
+        """
+        return self.routes.get((source, sink), [])
+
+    def route(self, source, sink):
+        """
+        Return the flow that records the transition from source to sink, or
+        None.
+        """
+        routed = self.routes.get((source, sink))
+        return routed[0] if routed else None
+
+    def unroutable_pairs(self, stocks):
+        """
+        Return a list of the (source, sink) pairs of the stocks, including the
+        None stock outside of the system, that no flow records.
+        """
+        stocks = [None] + list(stocks)
+        return [(source, sink) for source in stocks for sink in stocks
+                if source is not sink and (source, sink) not in self.routes]
+
+
+# The index of all the flows by the transitions that they record
+flow_router = FlowRouter()
+
 
 class StockRecord(models.Model):
     """
     A record of the count of a given stock at a point in time
     """
     stock = models.SlugField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=datetime.now)
     count = models.PositiveIntegerField()
+    # The counting strategy that produced the count and its error bound
+    strategy = models.SlugField(default=EXACT)
+    error = models.PositiveIntegerField(default=0)
 
     class Meta:
         ordering = ["-timestamp"]
+        if VERSION >= (1, 5):
+            index_together = (("stock", "timestamp"),)
+
+    def __str__(self):
+        return "%s count of %s at %s" % (self.stock, self.count, self.timestamp)
 
 class StockFacetRecord(models.Model):
     """
@@ -338,9 +966,236 @@ class StockFacetRecord(models.Model):
     value = models.CharField(max_length=200, db_index=True)
     count = models.PositiveIntegerField()
 
+
+class StockCrossTabRecord(models.Model):
+    """
+    A record of the counts of a combination of facets for a given stock at a
+    point in time.
+
+    The cross tab is stored compactly in a single row. The cells are a JSON
+    list with one [value, value, ..., count] list for each combination of
+    values that has a count.
+    """
+    stock_record = models.ForeignKey(StockRecord, db_index=True)
+    facets = models.CharField(max_length=200, db_index=True) # comma separated slugs
+    cells = models.TextField()
+
+    @classmethod
+    def from_cells(cls, stock_record_id, facet_slugs, cells):
+        """
+        Create an unsaved record from a dict that maps tuples of values to counts.
+        """
+        data = [list(values) + [cnt] for values, cnt in sorted(cells.items())]
+        return cls(stock_record_id=stock_record_id, facets=",".join(facet_slugs),
+                   cells=json.dumps(data, default=lambda v: "%s" % v))
+
+    @property
+    def facet_slugs(self):
+        return tuple(self.facets.split(","))
+
+    def as_dict(self):
+        """
+        Return a dict that maps each tuple of values to its count.
+        """
+        return dict((tuple(cell[:-1]), cell[-1]) for cell in json.loads(self.cells))
+
+    def as_matrix(self):
+        """
+        Return a (row_values, column_values, rows) tuple for a combination of
+        two facets, where rows is a list of lists of counts with zero for the
+        missing cells.
+        """
+        if len(self.facet_slugs) != 2:
+            raise ValueError("Only a combination of two facets can be a matrix.")
+        cells = self.as_dict()
+        row_values = sorted(set(k[0] for k in cells))
+        column_values = sorted(set(k[1] for k in cells))
+        rows = [[cells.get((r, c), 0) for c in column_values] for r in row_values]
+        return row_values, column_values, rows
+
+
+class StockMembershipRecord(models.Model):
+    """
+    The primary keys of the members of a stock at the time of a stock record,
+    encoded by stockandflow.membership.encode_members.
+    """
+    stock_record = models.ForeignKey(StockRecord)
+    members = models.TextField()
+
+    def as_snapshot(self):
+        return MembershipSnapshot.decode(self.members, self.stock_record.timestamp)
+
+
+class StockSnapshot(object):
+    """
+    Collect the stock and facet records of a snapshot run and write them
+    together.
+
+    All the records of a snapshot share one timestamp. They are written with a
+    constant number of bulk inserts inside a single transaction, so a failed
+    run does not leave partial records behind.
+    """
+    def __init__(self, timestamp=None):
+        self.timestamp = timestamp or datetime.now()
+        self._entries = []
+        self._slugs = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, stock, count, facet_counts=(), cross_tabs=(), members=None):
+        """
+        Add the count of a stock, either an int for an exact count or a
+        CountResult, a list of (facet_slug, value, count) tuples for its
+        facets, a list of (facet_slugs, cells) tuples for its facet
+        combinations and optionally the primary keys of its members, in
+        ascending order or already encoded by encode_members.
+        """
+        if stock.slug in self._slugs:
+            raise ValueError("The %s is already in this snapshot." % stock)
+        if not isinstance(count, CountResult):
+            count = CountResult(count, 0, EXACT)
+        if members is not None and not isinstance(members, basestring):
+            members = encode_members(members)
+        self._slugs.add(stock.slug)
+        self._entries.append((stock.slug, count, list(facet_counts), list(cross_tabs),
+                              members))
+
+    def write(self):
+        """
+        Write all the records and return the StockRecords in the order that
+        the stocks were added.
+        """
+        records = [StockRecord(stock=slug, count=count.value, strategy=count.strategy,
+                               error=count.error, timestamp=self.timestamp)
+                   for slug, count, facet_counts, cross_tabs, members in self._entries]
+        with atomic():
+            bulk_insert(StockRecord, records)
+            self._set_record_ids(records)
+            facet_records = []
+            cross_tab_records = []
+            membership_records = []
+            for sr, (slug, count, facet_counts, cross_tabs, members) in zip(records,
+                                                                          self._entries):
+                for facet_slug, value, cnt in facet_counts:
+                    facet_records.append(StockFacetRecord(stock_record_id=sr.id,
+                                         facet=facet_slug, value=value, count=cnt))
+                for facet_slugs, cells in cross_tabs:
+                    cross_tab_records.append(StockCrossTabRecord.from_cells(
+                            sr.id, facet_slugs, cells))
+                if members is not None:
+                    membership_records.append(StockMembershipRecord(stock_record_id=sr.id,
+                                                                    members=members))
+            bulk_insert(StockFacetRecord, facet_records)
+            bulk_insert(StockCrossTabRecord, cross_tab_records)
+            bulk_insert(StockMembershipRecord, membership_records)
+        return records
+
+    def _set_record_ids(self, records):
+        """
+        Most databases do not return the ids of bulk inserted rows, so read
+        them back with one query using the shared timestamp.
+        """
+        if all(sr.id for sr in records):
+            return
+        # Read from the database that was written to, not from a lagging replica
+        ids = StockRecord.objects.using(router.db_for_write(StockRecord)) \
+                                 .filter(timestamp=self.timestamp,
+                                         stock__in=list(self._slugs)) \
+                                 .order_by("id").values_list("stock", "id")
+        # The ordering means that the newest record wins on a collision
+        id_lookup = dict(ids)
+        for sr in records:
+            sr.id = id_lookup[sr.stock]
+
+
+class QueuedFlowCall(models.Model):
+    """
+    A flow event callable waiting to be run by the run_flow_calls command.
+
+    The flow is stored by slug and the callable, source and sink by their
+    position in the flow, so they are found again in the worker process.
+
+    A worker claims a call by setting its claim token and claimed_at. A call
+    is not run before its next_attempt_at, which is pushed back after each
+    failed attempt.
+    """
+    flow = models.SlugField()
+    callable_index = models.PositiveIntegerField()
+    subject_id = models.CharField(max_length=100)
+    source_index = models.PositiveIntegerField()
+    sink_index = models.PositiveIntegerField()
+    created = models.DateTimeField(default=datetime.now)
+    attempts = models.PositiveIntegerField(default=0)
+    failed = models.BooleanField(default=False, db_index=True)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=datetime.now, db_index=True)
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return "call %s of %s for %s" % (self.callable_index, self.flow, self.subject_id)
+
+
+class FlowRecord(models.Model):
+    """
+    The count of the flow events of a flow from a source to a sink in the
+    period that begins at start. These are written by rollup_flow_events.
+    """
+    flow = models.SlugField()
+    source = models.SlugField(null=True, blank=True)
+    sink = models.SlugField(null=True, blank=True)
+    period = models.SlugField()
+    start = models.DateTimeField(db_index=True)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ["start"]
+        if VERSION >= (1, 5):
+            index_together = (("flow", "period", "start"),)
+
+    def __str__(self):
+        return "%s from %s to %s in the %s at %s: %s" % (self.flow, self.source, self.sink,
+                                                       self.period, self.start, self.count)
+
+
+class FlowRollupMark(models.Model):
+    """
+    The id of the last flow event of a flow event model that has been rolled up
+    into FlowRecords for a period. The model is stored by its app_label.Model
+    label.
+    """
+    model = models.CharField(max_length=100)
+    period = models.SlugField()
+    last_id = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("model", "period")
+
+    def __str__(self):
+        return "%s by %s up to %s" % (self.model, self.period, self.last_id)
+
+
 class StockRecordAdmin(admin.ModelAdmin):
-    list_display=["timestamp", "stock", "count"]
-    list_filter=["stock", "timestamp"]
+    list_display=["timestamp", "stock", "count", "strategy", "error"]
+    list_filter=["stock", "strategy", "timestamp"]
+
+
+# The composite indexes of a flow event table, for the flow rate queries
+FLOW_EVENT_INDEXES = (("flow", "timestamp"), ("flow", "source", "sink", "timestamp"))
+
+
+def create_flow_event_indexes(db, table):
+    """
+    Create the FLOW_EVENT_INDEXES on a flow event table with the South db
+    API. Call this from a South migration of the app that has the flow event
+    model, because Django before 1.5 can not declare composite indexes.
+    """
+    for columns in FLOW_EVENT_INDEXES:
+        db.create_index(table, list(columns))
 
 
 class FlowEventModel(models.Model):
@@ -352,7 +1207,9 @@ class FlowEventModel(models.Model):
     interval of time. Therefore a flow would be measured per unit of time (say a
     year). Flow is roughly analogous to rate or speed in this sense.
 
-    Subclasses must have a "subject" foreign key field.
+    Subclasses must have a "subject" foreign key field. A subclass that
+    declares its own Meta should inherit FlowEventModel.Meta to keep the
+    indexes.
     """
     flow = models.SlugField()
     timestamp = AutoCreatedField()
@@ -361,6 +1218,8 @@ class FlowEventModel(models.Model):
 
     class Meta:
         abstract = True
+        if VERSION >= (1, 5):
+            index_together = FLOW_EVENT_INDEXES
 
     def __str__(self):
         return "%s (%s) at %s" % (self.flow, self.id, self.timestamp)
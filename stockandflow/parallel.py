@@ -0,0 +1,124 @@
+"""
+Count independent stocks concurrently on a bounded pool of workers.
+
+snapshot_stocks is the better choice for stocks that share a table because it
+counts them in one scan. The parallel snapshot suits stocks on different
+tables, or with expensive facets, when the database has cores to spare.
+"""
+import time
+from multiprocessing.pool import Pool, ThreadPool
+
+from django import VERSION
+from django.db import connections
+
+from stockandflow.membership import encode_members
+from stockandflow.models import StockSnapshot
+
+
+# The stocks of the current process pool run. Forked worker processes inherit
+# this list, so only the index of a stock needs to be sent to a worker.
+_process_stocks = []
+
+
+# Before Django 1.4 the database connections are shared by all the threads of
+# a process rather than kept per thread.
+CONNECTIONS_PER_THREAD = VERSION >= (1, 4)
+
+
+def close_connections(thread=True):
+    """
+    Close the database connections of a worker thread, or of a worker process
+    if thread is False. Before Django 1.4 a thread leaves them open because
+    the other threads are still using them.
+    """
+    if thread and not CONNECTIONS_PER_THREAD:
+        return
+    for conn in connections.all():
+        conn.close()
+
+
+def measure_stock(stock, thread=True):
+    """
+    Measure the count, facets, facet combinations and, if the stock keeps its
+    membership, the encoded member primary keys of a stock. Returns a tuple of
+    (count, facet_counts, cross_tabs, members, seconds).
+
+    The database connections of the worker are closed once the stock has been
+    measured, except in a thread before Django 1.4 (see close_connections).
+    """
+    start = time.time()
+    try:
+        measured = (stock.measure(), stock.facet_counts(), stock.cross_tab_counts(),
+                    encode_members(stock.member_pks()) if stock.membership else None)
+    finally:
+        close_connections(thread)
+    return measured + (time.time() - start,)
+
+
+def _measure_stock_at(index):
+    return measure_stock(_process_stocks[index], thread=False)
+
+
+class ParallelSnapshot(object):
+    """
+    Measure stocks concurrently and write them as one StockSnapshot.
+
+    The workers are threads by default. Set processes to True to use worker
+    processes instead, which sidesteps the GIL for stocks with a lot of Python
+    work such as large grouped facets. Worker processes are forked, so the
+    stocks do not need to be picklable, but the results do.
+    """
+    def __init__(self, workers=4, processes=False):
+        self.workers = workers
+        self.processes = processes
+
+    def measure(self, stocks):
+        """
+        Return a list of (count, facet_counts, cross_tabs, members, seconds)
+        tuples in the order of the stocks.
+        """
+        global _process_stocks
+        if self.processes:
+            # The forked workers must not share the connections of this process
+            close_connections(thread=False)
+            _process_stocks = list(stocks)
+            pool = Pool(self.workers)
+            try:
+                return pool.map(_measure_stock_at, range(len(_process_stocks)))
+            finally:
+                pool.close()
+                pool.join()
+                _process_stocks = []
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(measure_stock, stocks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def run(self, stocks):
+        """
+        Measure the stocks, write the snapshot and return a tuple of the list
+        of StockRecords and a list of (stock, seconds) timings.
+        """
+        snapshot = StockSnapshot()
+        timings = []
+        for stock, (count, facet_counts, cross_tabs, members, seconds) in zip(
+                stocks, self.measure(stocks)):
+            snapshot.add(stock, count, facet_counts, cross_tabs, members)
+            timings.append((stock, seconds))
+        return snapshot.write(), timings
+
+
+def parallel_snapshot(stocks, workers=4, processes=False):
+    """
+    Run a ParallelSnapshot and return a timing report for each stock. This can
+    be registered as a periodic schedule entry with the stocks as an argument.
+    """
+    start = time.time()
+    records, timings = ParallelSnapshot(workers, processes).run(stocks)
+    lines = ["Counted %s in %.2f seconds." % (stock.slug, seconds)
+             for stock, seconds in timings]
+    lines.append("Recorded %s stocks with %s workers in %.2f seconds." %
+                 (len(records), workers, time.time() - start))
+    return "\n".join(lines)
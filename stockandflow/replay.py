@@ -0,0 +1,188 @@
+"""
+Reconstruct the count of a stock at any time from an exact stock record and
+the flow events in and out of the stock since then.
+
+Only the flows registered with the stock are replayed, so changes that create
+no flow events make the replayed counts drift. The audit_stocks management
+command reports that drift.
+"""
+from datetime import timedelta
+
+from django.db import router
+
+from stockandflow.compat import atomic, bulk_insert
+from stockandflow.counting import EXACT, REPLAYED
+from stockandflow.models import StockRecord, reading_queryset
+from stockandflow.sql import bucketed_counts, interval_counts, PERIODS
+
+
+def truncate_datetime(dt, period):
+    """
+    Return the start of the period that the datetime is in, the same as
+    truncate_datetime_sql does in the database.
+    """
+    if period not in PERIODS:
+        raise ValueError("The period must be one of %s, not '%s'." % (", ".join(PERIODS), period))
+    dt = dt.replace(second=0, microsecond=0)
+    if period in ("hour", "day", "month"):
+        dt = dt.replace(minute=0)
+    if period in ("day", "month"):
+        dt = dt.replace(hour=0)
+    if period == "month":
+        dt = dt.replace(day=1)
+    return dt
+
+
+def next_period(dt, period):
+    """
+    Return the start of the period after the period that starts at dt.
+    """
+    if period == "month":
+        if dt.month == 12:
+            return dt.replace(year=dt.year + 1, month=1)
+        return dt.replace(month=dt.month + 1)
+    return dt + timedelta(seconds={"minute": 60, "hour": 3600, "day": 86400}[period])
+
+
+class StockReplay(object):
+    """
+    Replay the flow events of a stock from an anchor StockRecord.
+
+    The count at a time is the count of the anchor plus the inflow events
+    minus the outflow events from the anchor up to that time, or the reverse
+    for a time before the anchor. Without an anchor the closest exact record
+    before the time is used, or failing that the first one after it. The
+    events are counted with one aggregate query for each direction and flow
+    event model.
+
+    The records and events are read from the using alias, otherwise from the
+    read database of the stock (see reading_queryset).
+    """
+    def __init__(self, stock, anchor=None, using=None):
+        self.stock = stock
+        self.anchor = anchor
+        self.using = using or stock.using
+
+    def _direction_querysets(self, flows, field):
+        """
+        Return a list of querysets of the events of the flows that have the
+        stock as the field, "source" or "sink", one for each flow event model.
+        """
+        slugs_by_model = {}
+        for flow in flows:
+            slugs_by_model.setdefault(flow.flow_event_model, []).append(flow.slug)
+        return [reading_queryset(model._default_manager.filter(
+                        **{"flow__in": slugs, field: self.stock.slug}), self.using)
+                for model, slugs in slugs_by_model.items()]
+
+    def inflow_querysets(self):
+        return self._direction_querysets(self.stock.inflows, "sink")
+
+    def outflow_querysets(self):
+        return self._direction_querysets(self.stock.outflows, "source")
+
+    def net_flow(self, start, end):
+        """
+        Return the inflow minus the outflow of the stock from start up to end.
+        """
+        net = 0
+        for sign, querysets in ((1, self.inflow_querysets()), (-1, self.outflow_querysets())):
+            for qs in querysets:
+                net += sign * qs.filter(timestamp__gte=start, timestamp__lt=end).count()
+        return net
+
+    def net_flow_series(self, start, end, resolution="minute"):
+        """
+        Return a list of (bucket start, inflow minus outflow) tuples for the
+        buckets of the resolution from start up to end that have events.
+        """
+        nets = {}
+        for sign, querysets in ((1, self.inflow_querysets()), (-1, self.outflow_querysets())):
+            for qs in querysets:
+                qs = qs.filter(timestamp__gte=start, timestamp__lt=end)
+                for bucket, count in bucketed_counts(qs, "timestamp", resolution):
+                    nets[bucket] = nets.get(bucket, 0) + sign * count
+        return sorted(nets.items())
+
+    def net_flows_between(self, bounds):
+        """
+        Return a list of the inflow minus the outflow of the stock in each
+        interval between consecutive datetimes of the sorted bounds. This
+        takes one query per direction and flow event model for every 400
+        intervals.
+        """
+        nets = [0] * max(len(bounds) - 1, 0)
+        for sign, querysets in ((1, self.inflow_querysets()), (-1, self.outflow_querysets())):
+            for qs in querysets:
+                for first in range(0, len(nets), 400):
+                    for i, count in interval_counts(qs, "timestamp", bounds[first:first + 401]):
+                        nets[first + i] += sign * count
+        return nets
+
+    def anchor_for(self, timestamp):
+        if self.anchor is not None:
+            return self.anchor
+        records = reading_queryset(StockRecord.objects.filter(stock=self.stock.slug,
+                                                              strategy=EXACT), self.using)
+        for record in records.filter(timestamp__lte=timestamp).order_by("-timestamp")[:1]:
+            return record
+        for record in records.filter(timestamp__gt=timestamp).order_by("timestamp")[:1]:
+            return record
+        raise ValueError("There is no exact record of %s to replay from." % self.stock.slug)
+
+    def count_at(self, timestamp):
+        """
+        Return the count of the stock at the timestamp.
+        """
+        anchor = self.anchor_for(timestamp)
+        if anchor.timestamp <= timestamp:
+            return anchor.count + self.net_flow(anchor.timestamp, timestamp)
+        return anchor.count - self.net_flow(timestamp, anchor.timestamp)
+
+    def series(self, start, end, resolution="minute"):
+        """
+        Return a list of (bucket start, count) tuples with the count at the
+        start of every bucket of the resolution from start up to end. This
+        takes one anchored count and the net flow series, however many
+        buckets there are.
+        """
+        bucket = truncate_datetime(start, resolution)
+        count = self.count_at(bucket)
+        nets = dict(self.net_flow_series(bucket, end, resolution))
+        points = []
+        while bucket < end:
+            points.append((bucket, count))
+            count += nets.get(bucket, 0)
+            bucket = next_period(bucket, resolution)
+        return points
+
+    def fill_gaps(self, start, end, resolution="hour"):
+        """
+        Write a StockRecord with the replayed count at the start of every
+        bucket of the resolution from start up to end that has no record of
+        the stock. The records have the "replayed" strategy. Returns the list
+        of the new records.
+
+        The gaps and the replayed counts are read from the database that the
+        records are written to, in one transaction that first locks the
+        latest record of the stock with select_for_update, so concurrent runs
+        for the stock wait for each other rather than fill a bucket twice.
+        Before Django 1.4, which has no select_for_update, they are not kept
+        apart. A negative count is written as it is because it shows that the
+        stock has changed without flow events.
+        """
+        using = router.db_for_write(StockRecord)
+        replay = StockReplay(self.stock, self.anchor, using)
+        with atomic(using=using):
+            stock_records = StockRecord.objects.using(using).filter(stock=self.stock.slug)
+            if hasattr(stock_records, "select_for_update"):
+                list(stock_records.select_for_update().order_by("-timestamp", "-id")[:1])
+            recorded = stock_records.filter(timestamp__gte=start, timestamp__lt=end)
+            filled = set(bucket for bucket, count in
+                         bucketed_counts(recorded, "timestamp", resolution))
+            records = [StockRecord(stock=self.stock.slug, timestamp=bucket, count=count,
+                                   strategy=REPLAYED)
+                       for bucket, count in replay.series(start, end, resolution)
+                       if bucket >= start and bucket not in filled]
+            bulk_insert(StockRecord, records)
+        return records
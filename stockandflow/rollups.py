@@ -0,0 +1,81 @@
+"""
+Roll up the flow events into FlowRecords, the count of the events of each
+flow, source and sink per period, so that flow rates can be read without
+scanning the flow event tables.
+"""
+from django.db import connections, router
+from django.db.models import F
+
+from stockandflow.compat import atomic
+from stockandflow.models import FlowRecord, FlowRollupMark
+from stockandflow.sql import truncate_datetime_sql, parse_truncated
+
+
+def model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+
+def rollup_event_model(model, period="hour"):
+    """
+    Add the events of a flow event model since the last rollup to the
+    FlowRecords of the period, with one GROUP BY query. Returns a tuple of the
+    number of events and the number of FlowRecords that they were added to.
+
+    The FlowRecords and the high-water mark are written to the database of
+    the events in the same transaction, so an interrupted rollup is simply
+    run again. An event whose transaction commits after a rollup has passed
+    its id is missed, and archive_flow_events refuses to archive it.
+    """
+    using = router.db_for_write(model)
+    qn = connections[using].ops.quote_name
+    label = model_label(model)
+    with atomic(using=using):
+        marks = FlowRollupMark.objects.using(using)
+        marks.get_or_create(model=label, period=period)
+        if hasattr(marks, "select_for_update"): # Keep concurrent rollups apart
+            marks = marks.select_for_update()
+        mark = marks.get(model=label, period=period)
+        bucket = truncate_datetime_sql(using, qn("timestamp"), period)
+        sql = ("SELECT %(flow)s, %(source)s, %(sink)s, %(bucket)s, COUNT(*), MAX(%(id)s) "
+               "FROM %(table)s WHERE %(id)s > %%s "
+               "GROUP BY %(flow)s, %(source)s, %(sink)s, %(bucket)s" % {
+                   "flow": qn("flow"), "source": qn("source"), "sink": qn("sink"),
+                   "bucket": bucket, "id": qn(model._meta.pk.column),
+                   "table": qn(model._meta.db_table)})
+        cursor = connections[using].cursor()
+        cursor.execute(sql, [mark.last_id])
+        events = 0
+        rows = cursor.fetchall()
+        for flow, source, sink, start, count, last_id in rows:
+            start = parse_truncated(start)
+            records = FlowRecord.objects.using(using).filter(flow=flow, source=source,
+                                                             sink=sink, period=period,
+                                                             start=start)
+            if not records.update(count=F("count") + count):
+                FlowRecord.objects.using(using).create(flow=flow, source=source, sink=sink,
+                                                       period=period, start=start,
+                                                       count=count)
+            events += count
+            mark.last_id = max(mark.last_id, last_id)
+        mark.save()
+    return events, len(rows)
+
+
+def rollup_flow_events(flows, period="hour"):
+    """
+    Roll up the events of the flow event models of the flows. All the events
+    of each model are rolled up, including those of other flows, because the
+    high-water mark is kept per model.
+
+    Returns a message so this can be registered as a periodic schedule entry.
+    """
+    event_models = []
+    for flow in flows:
+        if flow.flow_event_model not in event_models:
+            event_models.append(flow.flow_event_model)
+    lines = []
+    for model in event_models:
+        events, records = rollup_event_model(model, period)
+        lines.append("Rolled up %s %s events into %s %s records." %
+                     (events, model_label(model), records, period))
+    return "\n".join(lines)
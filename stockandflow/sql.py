@@ -0,0 +1,256 @@
+"""
+Low level SQL helpers for the queries that the ORM can not express directly.
+
+These work with the compiler of a queryset rather than with the SQL string so
+that the quoting and the parameters are handled by the database backend.
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connections
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+# Time zone support was added in Django 1.4
+try:
+    from django.utils.timezone import utc
+except ImportError:
+    utc = None
+
+
+class UnmergeableQuery(Exception):
+    """
+    Raised when a queryset can not be combined with other querysets into a
+    single statement.
+    """
+    pass
+
+
+def count_clauses(queryset):
+    """
+    Split a queryset into the parts needed to count it as one column of a
+    combined query. Returns a tuple of (using, from_sql, from_params,
+    where_sql, where_params).
+
+    The where_sql is an empty string when the queryset is not filtered and it
+    is None when the queryset can not match any rows.
+
+    Raises UnmergeableQuery if the queryset is limited, distinct or grouped
+    because those can not be counted with a conditional aggregate.
+    """
+    query = queryset.query
+    if (query.distinct or query.low_mark or query.high_mark is not None or
+            query.group_by is not None or getattr(query, "aggregates", None) or
+            getattr(query, "annotations", None) or
+            getattr(getattr(query, "having", None), "children", None)):
+        raise UnmergeableQuery("%s can not be merged" % query)
+    query = query.clone()
+    query.clear_ordering(True)
+    try:
+        query.get_initial_alias()
+        compiler = query.get_compiler(using=queryset.db)
+        from_, from_params = compiler.get_from_clause()
+        try:
+            if hasattr(compiler, "compile"):
+                where, where_params = compiler.compile(query.where)
+            else:
+                where, where_params = query.where.as_sql(
+                        qn=compiler.quote_name_unless_alias,
+                        connection=compiler.connection)
+        except EmptyResultSet:
+            where, where_params = None, []
+    except (AttributeError, TypeError) as e:
+        # The compiler internals differ between Django versions
+        raise UnmergeableQuery("%s can not be merged: %s" % (query, e))
+    return (queryset.db, " ".join(from_), list(from_params), where, list(where_params))
+
+
+def merged_counts(using, from_sql, from_params, wheres):
+    """
+    Count several WHERE clauses over the same FROM clause in a single scan
+    using conditional aggregates. The wheres is a list of (where_sql,
+    where_params) tuples as returned by count_clauses. Returns a list of
+    counts in the same order.
+    """
+    columns = []
+    params = []
+    for where, where_params in wheres:
+        if where is None:
+            columns.append("0")
+        elif where:
+            columns.append("SUM(CASE WHEN %s THEN 1 ELSE 0 END)" % where)
+            params.extend(where_params)
+        else:
+            columns.append("COUNT(*)")
+    sql = "SELECT %s FROM %s" % (", ".join(columns), from_sql)
+    cursor = connections[using].cursor()
+    cursor.execute(sql, params + list(from_params))
+    row = cursor.fetchone()
+    # SUM returns NULL when there are no rows at all
+    return [int(v or 0) for v in row]
+
+
+# The periods that datetimes can be truncated to
+PERIODS = ("minute", "hour", "day", "month")
+
+# The approximate length of each period in seconds
+PERIOD_SECONDS = {"minute": 60, "hour": 3600, "day": 86400, "month": 86400 * 30}
+
+# Formats that truncate a datetime to the start of a period as a string. The
+# percent signs are doubled because the SQL is run with parameters.
+_TRUNC_FORMATS = {
+    "sqlite": {
+        "minute": "%%Y-%%m-%%d %%H:%%M:00",
+        "hour": "%%Y-%%m-%%d %%H:00:00",
+        "day": "%%Y-%%m-%%d 00:00:00",
+        "month": "%%Y-%%m-01 00:00:00",
+    },
+    "mysql": {
+        "minute": "%%Y-%%m-%%d %%H:%%i:00",
+        "hour": "%%Y-%%m-%%d %%H:00:00",
+        "day": "%%Y-%%m-%%d 00:00:00",
+        "month": "%%Y-%%m-01 00:00:00",
+    },
+}
+_ORACLE_TRUNC_UNITS = {"minute": "MI", "hour": "HH24", "day": "DD", "month": "MM"}
+
+
+def truncate_datetime_sql(using, column, period):
+    """
+    Return the SQL that truncates the datetime column to the start of the
+    period for the database given by using. The column must already be
+    quoted. Use parse_truncated to read the result back as a datetime.
+    """
+    if period not in PERIODS:
+        raise ValueError("The period must be one of %s, not '%s'." % (", ".join(PERIODS), period))
+    vendor = getattr(connections[using], "vendor", None)
+    if vendor == "postgresql":
+        return "date_trunc('%s', %s)" % (period, column)
+    if vendor == "sqlite":
+        return "strftime('%s', %s)" % (_TRUNC_FORMATS[vendor][period], column)
+    if vendor == "mysql":
+        return "DATE_FORMAT(%s, '%s')" % (column, _TRUNC_FORMATS[vendor][period])
+    if vendor == "oracle":
+        return "TRUNC(%s, '%s')" % (column, _ORACLE_TRUNC_UNITS[period])
+    raise ValueError("Truncating datetimes is not supported on %s." % vendor)
+
+
+def parse_truncated(value):
+    """
+    Return a truncated datetime from truncate_datetime_sql as a datetime. Some
+    databases return it as a string.
+    """
+    if isinstance(value, datetime) or value is None:
+        return value
+    return datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S")
+
+
+def stored_datetime(field, value):
+    """
+    Return a datetime read from a raw cursor, such as a string on some
+    databases, in the form the ORM loads it. With USE_TZ the database stores
+    datetimes in UTC, so a naive one is made aware.
+    """
+    value = field.to_python(value)
+    if (value is not None and value.tzinfo is None and utc is not None and
+            getattr(settings, "USE_TZ", False)):
+        value = value.replace(tzinfo=utc)
+    return value
+
+
+def bucketed_aggregate(queryset, column, period, aggregate="COUNT", value_column=None):
+    """
+    Aggregate the rows of a queryset per period of a datetime column with one
+    GROUP BY query. The aggregate is the name of an SQL aggregate function,
+    such as COUNT, MIN, MAX or AVG, of the value_column, or of all the rows if
+    there is no value_column. Returns a list of (period start, value) tuples
+    in time order. The periods without any rows are left out.
+    """
+    using, from_sql, from_params, where, where_params = count_clauses(queryset)
+    if where is None:
+        return []
+    qn = connections[using].ops.quote_name
+    table = qn(queryset.model._meta.db_table)
+    bucket = truncate_datetime_sql(using, "%s.%s" % (table, qn(column)), period)
+    if value_column is None:
+        value = "*"
+    else:
+        value = "%s.%s" % (table, qn(value_column))
+    sql = "SELECT %s, %s(%s) FROM %s" % (bucket, aggregate, value, from_sql)
+    if where:
+        sql += " WHERE %s" % where
+    sql += " GROUP BY %s ORDER BY %s" % (bucket, bucket)
+    cursor = connections[using].cursor()
+    cursor.execute(sql, list(from_params) + list(where_params))
+    return [(parse_truncated(start), value) for start, value in cursor.fetchall()]
+
+
+def bucketed_counts(queryset, column, period):
+    """
+    Count the rows of a queryset per period of a datetime column. Returns a
+    list of (period start, count) tuples as bucketed_aggregate does.
+    """
+    return bucketed_aggregate(queryset, column, period)
+
+
+def interval_counts(queryset, column, bounds):
+    """
+    Count the rows of a queryset in each interval between consecutive
+    datetimes of the sorted bounds, from the first up to the last, with one
+    GROUP BY query. Returns a list of (interval index, count) tuples for the
+    intervals that have rows. Keep the bounds to a few hundred because each
+    one is a parameter of the query.
+    """
+    if len(bounds) < 2:
+        return []
+    queryset = queryset.filter(**{column + "__gte": bounds[0], column + "__lt": bounds[-1]})
+    using, from_sql, from_params, where, where_params = count_clauses(queryset)
+    if where is None:
+        return []
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    field = queryset.model._meta.get_field(column)
+    value = "%s.%s" % (qn(queryset.model._meta.db_table), qn(column))
+    whens = ["WHEN %s < %%s THEN %s" % (value, i) for i in range(len(bounds) - 2)]
+    case_params = [field.get_db_prep_value(b, connection=connection) for b in bounds[1:-1]]
+    if whens:
+        interval = "CASE %s ELSE %s END" % (" ".join(whens), len(bounds) - 2)
+    else:
+        interval = "0"
+    sql = "SELECT %s AS interval_index FROM %s" % (interval, from_sql)
+    if where:
+        sql += " WHERE %s" % where
+    sql = ("SELECT interval_index, COUNT(*) FROM (%s) intervals "
+           "GROUP BY interval_index ORDER BY interval_index" % sql)
+    cursor = connection.cursor()
+    cursor.execute(sql, case_params + list(from_params) + list(where_params))
+    return [(int(i), count) for i, count in cursor.fetchall()]
+
+
+def bucketed_latest(queryset, column, period, value_column=None):
+    """
+    Return the value_column, or the primary key, of the latest row of each
+    period of a datetime column as a list of (period start, value) tuples in
+    time order. The latest row is the one with the highest datetime, and of
+    those the one with the highest primary key. This takes one GROUP BY query
+    and one query for the latest rows per 500 periods.
+
+    The latest datetimes of the GROUP BY query and of the rows are matched up
+    in the same form (see stored_datetime).
+    """
+    field = queryset.model._meta.get_field(column)
+    pk_name = queryset.model._meta.pk.attname
+    latest = dict((stored_datetime(field, last), start) for start, last in
+                  bucketed_aggregate(queryset, column, period, "MAX", column))
+    datetimes = list(latest)
+    rows = {}
+    for i in range(0, len(datetimes), 500):
+        chunk = queryset.filter(**{"%s__in" % column: datetimes[i:i + 500]}).order_by()
+        for dt, pk, value in chunk.values_list(column, pk_name, value_column or pk_name):
+            start = latest[stored_datetime(field, dt)]
+            if start not in rows or pk > rows[start][0]:
+                rows[start] = (pk, value)
+    return [(start, rows[start][1]) for start in sorted(rows)]
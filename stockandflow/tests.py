@@ -1,16 +1,62 @@
 from datetime import datetime, timedelta
+import csv
+import gzip
+import json
+import os
+import pickle
+import shutil
+import tempfile
 import time
+import warnings
 from mock import Mock, MagicMock, patch
 
 from django.core import management
-from django.test import TestCase
+from django.db import models
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User
 
-from stockandflow.models import Stock, StockRecord, StockFacetRecord, Flow
-from stockandflow.tracker import ModelTracker
+from stockandflow.models import Stock, StockRecord, StockFacetRecord, Flow, FlowRouter, \
+        FlowRecord, FlowRollupMark, StockSnapshot, FlowEventModel
+from stockandflow.compaction import CompactionPolicy, compact_stock, compact_stock_records
+from stockandflow.export import export_queryset, export_rows, export_lines, parse_datetime
+from stockandflow.membership import MembershipSnapshot, encode_members, decode_members
+from stockandflow.replay import StockReplay, truncate_datetime, next_period
+from stockandflow.audit import audit_stock, audit_stocks
+from stockandflow.archive import archive_flow_events, check_rolled_up, ArchiveError
+from stockandflow.sql import truncate_datetime_sql, parse_truncated, bucketed_counts
+from stockandflow.tracker import ModelTracker, NOT_LOADED, untracked, tracking_suspended
 from stockandflow import periodic
 
 
+# The test models are given the label of the auth app, which has no South
+# migrations, so syncdb creates their tables in the test database whether or
+# not South migrates the apps for the tests. This module is imported before
+# the test database is created, and never outside the tests.
+
+class MemberUser(User):
+    """
+    A proxy of User with a property to track.
+    """
+    class Meta:
+        proxy = True
+        app_label = "auth"
+
+    @property
+    def is_member(self):
+        return self.is_active and not self.is_staff
+
+
+class UserFlowEvent(FlowEventModel):
+    """
+    A flow event model for the tests that need real flow events.
+    """
+    subject = models.ForeignKey(User, related_name="stockandflow_test_events")
+
+    class Meta(FlowEventModel.Meta):
+        app_label = "auth"
+        db_table = "stockandflow_test_userflowevent"
+
+
 class StockTest(TestCase):
 
     def register_flows(self, stock):
@@ -52,20 +98,18 @@ class StockTest(TestCase):
         s.save_count()
         self.assertTrue(self.mock_qs.count.called)
 
-    @patch.object(StockRecord, 'save')
-    def testSaveCountShouldCreateStockRecord(self, mock_save):
+    def testSaveCountShouldCreateStockRecord(self):
         s = Stock(*self.stock_args)
-        s.save_count()
-        self.assertTrue(mock_save.called)
+        sr = s.save_count()
+        self.assertEqual(StockRecord.objects.get(pk=sr.pk).count, 999)
 
-    @patch.object(StockFacetRecord, 'save')
-    def testSaveCountShouldCreateStockFacetRecord(self, mock_save):
+    def testSaveCountShouldCreateStockFacetRecord(self):
         from stockandflow.models import Facet
         f = Facet("test_slug", "test name", "test_field", [1,2])
+        self.mock_qs.filter.return_value.count.return_value = 5
         s = Stock("test stock name", "test_stock_slug", self.mock_qs, facets=[f])
-        s.facets = [f]
-        s.save_count()
-        self.assertEqual(mock_save.call_count, 2)
+        sr = s.save_count()
+        self.assertEqual(StockFacetRecord.objects.filter(stock_record=sr).count(), 2)
 
     @patch.object(StockFacetRecord, 'save')
     def testSaveCountShouldPassThroughFieldPrefix(self, mock_save):
@@ -126,6 +170,681 @@ class StockTest(TestCase):
         self.assertEqual(rv, f)
 
 
+class CountStocksShould(TestCase):
+    def setUp(self):
+        User.objects.create(username="staff", is_staff=True, is_active=True)
+        User.objects.create(username="active", is_staff=False, is_active=True)
+        User.objects.create(username="inactive", is_staff=False, is_active=False)
+        self.stocks = [
+            Stock("staff", "Staff", User.objects.filter(is_staff=True)),
+            Stock("active", "Active", User.objects.filter(is_staff=False, is_active=True)),
+            Stock("everyone", "Everyone", User.objects.all()),
+            Stock("nobody", "Nobody", User.objects.filter(pk__in=[])),
+        ]
+
+    def testCountStocksOfTheSameModelInOneQuery(self):
+        from stockandflow.models import count_stocks
+        with self.assertNumQueries(1):
+            counts = count_stocks(self.stocks)
+        self.assertEqual([counts[s] for s in self.stocks], [1, 1, 3, 0])
+
+    def testCountAnUnmergeableStockWithItsOwnQuery(self):
+        from stockandflow.models import count_stocks
+        sliced = Stock("first", "First", User.objects.all()[:1])
+        counts = count_stocks(self.stocks + [sliced])
+        self.assertEqual(counts[sliced], 1)
+        self.assertEqual(counts[self.stocks[2]], 3)
+
+    def testSaveARecordForEachStock(self):
+        from stockandflow.models import snapshot_stocks
+        records = snapshot_stocks(self.stocks)
+        self.assertEqual([r.stock for r in records], ["staff", "active", "everyone", "nobody"])
+        self.assertEqual(StockRecord.objects.get(stock="everyone").count, 3)
+
+
+class StockSnapshotShould(TransactionTestCase):
+    def setUp(self):
+        from stockandflow.models import Facet
+        self.facet = Facet("test_facet", "test facet", "test_field", [1,2])
+        self.mock_qs = Mock()
+        self.mock_qs.count.return_value = 10
+        self.mock_qs.filter.return_value.count.return_value = 5
+        self.stocks = [Stock("one", "One", self.mock_qs, facets=[self.facet]),
+                       Stock("two", "Two", self.mock_qs, facets=[self.facet])]
+
+    def testWriteAllRecordsWithOneTimestamp(self):
+        from stockandflow.models import StockSnapshot
+        snapshot = StockSnapshot()
+        for s in self.stocks:
+            s.add_to_snapshot(snapshot)
+        records = snapshot.write()
+        self.assertEqual([r.stock for r in records], ["one", "two"])
+        self.assertEqual(StockRecord.objects.filter(timestamp=snapshot.timestamp).count(), 2)
+        for r in records:
+            self.assertEqual(StockFacetRecord.objects.filter(stock_record=r).count(), 2)
+
+    def testNotLeavePartialRecordsWhenTheWriteFails(self):
+        from stockandflow.models import StockSnapshot
+        snapshot = StockSnapshot()
+        snapshot.add(self.stocks[0], 10, [("test_facet", 1, 5)])
+        with patch("stockandflow.models.StockSnapshot._set_record_ids") as ids_mock:
+            ids_mock.side_effect = RuntimeError
+            self.assertRaises(RuntimeError, snapshot.write)
+        self.assertEqual(StockRecord.objects.count(), 0)
+
+    def testRejectAStockThatIsAddedTwice(self):
+        from stockandflow.models import StockSnapshot
+        snapshot = StockSnapshot()
+        snapshot.add(self.stocks[0], 10)
+        self.assertRaises(ValueError, snapshot.add, self.stocks[0], 11)
+
+
+class FakeCache(object):
+    """
+    A minimal stand-in for a Django cache backend.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+
+    def incr(self, key, delta=1):
+        if key not in self.data:
+            raise ValueError("Key '%s' not found" % key)
+        self.data[key] += delta
+        return self.data[key]
+
+    def decr(self, key, delta=1):
+        return self.incr(key, -delta)
+
+
+class LiveCountShould(TestCase):
+    def setUp(self):
+        from stockandflow.counting import CacheCounterStore
+        self.store = CacheCounterStore(cache=FakeCache())
+        self.mock_qs = Mock()
+        self.mock_qs.count.return_value = 10
+        self.source = Stock("source", "Source", self.mock_qs, live_counter=self.store)
+        self.sink = Stock("sink", "Sink", self.mock_qs, live_counter=self.store)
+        self.flow = Flow("moving", "Moving", Mock(), sources=[self.source], sinks=[self.sink])
+
+    def testSeedTheLiveCountFromTheQuerysetOnce(self):
+        self.assertEqual(self.source.count(), 10)
+        self.assertEqual(self.source.count(), 10)
+        self.assertEqual(self.mock_qs.count.call_count, 1)
+
+    def testFollowFlowEvents(self):
+        self.source.count()
+        self.sink.count()
+        self.flow.add_event(Mock(), self.source, self.sink)
+        self.assertEqual(self.source.count(), 9)
+        self.assertEqual(self.sink.count(), 11)
+
+    def testReportAndResetTheDrift(self):
+        from stockandflow.counting import reconcile_live_counts
+        self.source.count()
+        self.store.adjust(self.source, 3)
+        message = reconcile_live_counts([self.source])
+        self.assertEqual(message, "source: live 13, actual 10, drift 3.")
+        self.assertEqual(self.source.count(), 10)
+
+
+class CountingStrategyShould(TestCase):
+    def sampled_qs(self, hits):
+        qs = Mock()
+        qs.model._meta.pk.name = "id"
+        qs.model._default_manager.using.return_value.aggregate.return_value = {
+            "low": 1, "high": 10000}
+        qs.filter.return_value.count.return_value = hits
+        return qs
+
+    def testEstimateFromARandomSampleOfPrimaryKeys(self):
+        from stockandflow.counting import SampledEstimate, SAMPLED
+        qs = self.sampled_qs(250)
+        rv = SampledEstimate(sample_size=500).measure(qs)
+        self.assertEqual(rv, (5000, 439, SAMPLED))
+        self.assertEqual(len(qs.filter.call_args[1]["id__in"]), 500)
+        self.assertFalse(qs.count.called)
+
+    def testBoundTheErrorOfAnEmptyOrAFullSample(self):
+        from stockandflow.counting import SampledEstimate, SAMPLED
+        self.assertEqual(SampledEstimate(sample_size=500).measure(self.sampled_qs(0)),
+                         (0, 60, SAMPLED))
+        self.assertEqual(SampledEstimate(sample_size=500).measure(self.sampled_qs(500)),
+                         (10000, 60, SAMPLED))
+
+    def testCountExactlyWhenTheTableIsSmallerThanTheSample(self):
+        from stockandflow.counting import SampledEstimate, EXACT
+        qs = self.sampled_qs(0)
+        qs.model._default_manager.using.return_value.aggregate.return_value = {
+            "low": 1, "high": 20}
+        qs.count.return_value = 12
+        self.assertEqual(SampledEstimate(sample_size=500).measure(qs), (12, 0, EXACT))
+
+    def testRecordTheStrategyWithTheCount(self):
+        from stockandflow.counting import SampledEstimate, SAMPLED
+        s = Stock("big", "Big", self.sampled_qs(250),
+                  counting=SampledEstimate(sample_size=500))
+        sr = StockRecord.objects.get(pk=s.save_count().pk)
+        self.assertEqual((sr.count, sr.error, sr.strategy), (5000, 439, SAMPLED))
+
+    def testDefaultToAnExactCount(self):
+        from stockandflow.counting import EXACT
+        qs = Mock()
+        qs.count.return_value = 3
+        self.assertEqual(Stock("small", "Small", qs).measure(), (3, 0, EXACT))
+
+
+class CrossTabShould(TestCase):
+    def setUp(self):
+        from stockandflow.models import Facet
+        self.ramp = Facet("ramp", "Ramp", "ramp__name", ["fast", "slow"])
+        self.source = Facet("source", "Source", "source__name", ["web", "ad"])
+        self.mock_qs = Mock()
+        self.mock_qs.count.return_value = 6
+        self.mock_qs.filter.return_value.count.return_value = 0
+        self.mock_qs.order_by.return_value.values.return_value.annotate.return_value = [
+            {"ramp__name": "fast", "source__name": "web", "facet_count": 3},
+            {"ramp__name": "slow", "source__name": "ad", "facet_count": 2},
+            {"ramp__name": "slow", "source__name": "tv", "facet_count": 1},
+        ]
+        self.stock = Stock("members", "Members", self.mock_qs,
+                           facets=[self.ramp, self.source],
+                           facet_combinations=[("ramp", "source")])
+
+    def testCountACombinationInOneGroupedQuery(self):
+        from stockandflow.models import OTHER_FACET_VALUE
+        rv = self.stock.cross_tab_counts()
+        self.assertEqual(rv, [(("ramp", "source"), {("fast", "web"): 3, ("slow", "ad"): 2,
+                                                    ("slow", OTHER_FACET_VALUE): 1})])
+        self.mock_qs.order_by.return_value.values.assert_called_with("ramp__name",
+                                                                     "source__name")
+
+    def testRejectACombinationOfUnknownFacets(self):
+        self.assertRaises(ValueError, Stock, "members", "Members", self.mock_qs,
+                          facets=[self.ramp], facet_combinations=[("ramp", "source")])
+
+    def testReadTheSavedCrossTabAsADictAndAMatrix(self):
+        from stockandflow.models import OTHER_FACET_VALUE
+        self.stock.save_count()
+        record = self.stock.most_recent_cross_tab("ramp", "source")
+        self.assertEqual(record.as_dict()[("fast", "web")], 3)
+        rows, columns, matrix = record.as_matrix()
+        self.assertEqual(rows, ["fast", "slow"])
+        self.assertEqual(columns, [OTHER_FACET_VALUE, "ad", "web"])
+        self.assertEqual(matrix, [[0, 0, 3], [1, 2, 0]])
+
+
+class ParallelSnapshotShould(TestCase):
+    def setUp(self):
+        self.stocks = []
+        for i in range(5):
+            qs = Mock()
+            qs.count.return_value = i
+            self.stocks.append(Stock("stock_%s" % i, "Stock %s" % i, qs))
+
+    @patch("stockandflow.parallel.close_connections")
+    def testRecordEveryStockInOrder(self, close_mock):
+        from stockandflow.parallel import ParallelSnapshot
+        records, timings = ParallelSnapshot(workers=2).run(self.stocks)
+        self.assertEqual([(r.stock, r.count) for r in records],
+                         [("stock_%s" % i, i) for i in range(5)])
+        self.assertEqual([t[0] for t in timings], self.stocks)
+        self.assertEqual(close_mock.call_args_list, [((True,), {})] * 5)
+
+    @patch("stockandflow.parallel.close_connections")
+    def testEncodeTheMembersInTheWorkers(self, close_mock):
+        from stockandflow.parallel import ParallelSnapshot
+        self.stocks[0].queryset.model = User
+        stock = Stock("members", "Members", self.stocks[0].queryset, membership=True)
+        stock.member_pks = Mock(return_value=iter([1, 2, 5]))
+        records, timings = ParallelSnapshot(workers=2).run([stock])
+        self.assertEqual(list(stock.membership_at()), [1, 2, 5])
+
+    @patch("stockandflow.parallel.connections")
+    def testOnlyCloseTheConnectionsOfAThreadWhenTheyAreItsOwn(self, connections_mock):
+        from stockandflow.parallel import close_connections
+        conn = Mock()
+        connections_mock.all.return_value = [conn]
+        with patch("stockandflow.parallel.CONNECTIONS_PER_THREAD", False):
+            close_connections()
+            self.assertFalse(conn.close.called)
+            close_connections(thread=False)
+            self.assertEqual(conn.close.call_count, 1)
+        with patch("stockandflow.parallel.CONNECTIONS_PER_THREAD", True):
+            close_connections()
+            self.assertEqual(conn.close.call_count, 2)
+
+    @patch("stockandflow.parallel.close_connections")
+    def testReportTheTimingOfEachStock(self, close_mock):
+        from stockandflow.parallel import parallel_snapshot
+        message = parallel_snapshot(self.stocks, workers=3)
+        self.assertTrue("Counted stock_4 in" in message)
+        self.assertTrue("Recorded 5 stocks with 3 workers" in message)
+
+
+class ReadDatabaseShould(TestCase):
+    def testCountAStockOnItsReadDatabase(self):
+        qs = Mock()
+        qs.using.return_value.count.return_value = 42
+        s = Stock("test_slug", "test name", qs, using="replica")
+        self.assertEqual(s.count(), 42)
+        qs.using.assert_called_with("replica")
+        self.assertFalse(qs.count.called)
+
+    def testLeaveTheQuerysetAloneWithoutAReadDatabase(self):
+        qs = Mock()
+        qs.count.return_value = 7
+        s = Stock("test_slug", "test name", qs)
+        self.assertEqual(s.count(), 7)
+        self.assertFalse(qs.using.called)
+
+    def testKeepTheObjectQuerysetsOnTheNormalDatabase(self):
+        from stockandflow.models import Facet
+        qs = Mock()
+        f = Facet("test_slug", "test name", "test_field", [1,2])
+        s = Stock("test_slug", "test name", qs, facets=[f], using="replica")
+        self.assertEqual(s.all(), qs)
+        self.assertEqual(s.faceted_qs("test_slug", 1), qs.filter.return_value)
+        self.assertFalse(qs.using.called)
+
+    def testQueryFlowEventsOnTheReadDatabase(self):
+        f = Flow("test_flow_slug", "test flow name", Mock(), using="replica")
+        self.assertEqual(f.all(), f.queryset.using.return_value)
+        f.queryset.using.assert_called_with("replica")
+
+
+class StockHistoryShould(TestCase):
+    def setUp(self):
+        self.stock = Stock("hist", "History", User.objects.all())
+        for day, hour, count in [(1, 1, 5), (1, 2, 9), (1, 3, 7), (2, 1, 4)]:
+            StockRecord.objects.create(stock="hist", count=count,
+                                       timestamp=datetime(2011, 7, day, hour))
+        StockRecord.objects.create(stock="other", count=1, timestamp=datetime(2011, 7, 1, 4))
+
+    def testReturnTheLastRecordOfEachBucket(self):
+        history = self.stock.history(datetime(2011, 7, 1), datetime(2011, 7, 3), "day")
+        self.assertEqual(history, [(datetime(2011, 7, 1), 7), (datetime(2011, 7, 2), 4)])
+
+    def testTakeTheLastRecordByTimeNotByInsertOrder(self):
+        StockRecord.objects.create(stock="hist", count=99, timestamp=datetime(2011, 7, 1, 2, 30))
+        start, end = datetime(2011, 7, 1), datetime(2011, 7, 3)
+        self.assertEqual(self.stock.history(start, end, "day"),
+                         [(datetime(2011, 7, 1), 7), (datetime(2011, 7, 2), 4)])
+        StockRecord.objects.create(stock="hist", count=8, timestamp=datetime(2011, 7, 2, 1))
+        self.assertEqual(self.stock.history(start, end, "day"),
+                         [(datetime(2011, 7, 1), 7), (datetime(2011, 7, 2), 8)])
+
+    def testMatchTheRawLatestDatetimesWithTheLoadedOnes(self):
+        from stockandflow.sql import stored_datetime, utc
+        field = StockRecord._meta.get_field("timestamp")
+        self.assertEqual(stored_datetime(field, "2011-07-01 02:00:00"), datetime(2011, 7, 1, 2))
+        if utc is not None:
+            with patch("stockandflow.sql.settings", Mock(USE_TZ=True)):
+                self.assertEqual(stored_datetime(field, "2011-07-01 02:00:00"),
+                                 datetime(2011, 7, 1, 2, tzinfo=utc))
+                loaded = datetime(2011, 7, 1, 2, tzinfo=utc)
+                self.assertEqual(stored_datetime(field, loaded), loaded)
+
+    def testAggregateEachBucket(self):
+        start, end = datetime(2011, 7, 1), datetime(2011, 7, 3)
+        self.assertEqual([v for b, v in self.stock.history(start, end, "day", "max")], [9, 4])
+        self.assertEqual([v for b, v in self.stock.history(start, end, "day", "min")], [5, 4])
+        self.assertEqual([float(v) for b, v in self.stock.history(start, end, "day", "avg")],
+                         [7.0, 4.0])
+        self.assertRaises(ValueError, self.stock.history, start, end, "day", "median")
+
+    def testPickTheResolutionFromTheSpan(self):
+        history = self.stock.history(datetime(2011, 7, 1), datetime(2011, 7, 3), max_points=10)
+        self.assertEqual(len(history), 2)
+        history = self.stock.history(datetime(2011, 7, 1), datetime(2011, 7, 3))
+        self.assertEqual(len(history), 4)
+
+
+class CompactionShould(TestCase):
+    def setUp(self):
+        self.now = datetime(2011, 7, 10)
+        self.stock = Stock("compact", "Compact", User.objects.all(),
+                           compaction=CompactionPolicy(full_days=1, hourly_days=3))
+        # Records every 20 minutes from the 5th to the 10th
+        ts = datetime(2011, 7, 5)
+        while ts < self.now:
+            sr = StockRecord.objects.create(stock="compact", count=1, timestamp=ts)
+            StockFacetRecord.objects.create(stock_record=sr, facet="f", value="v", count=1)
+            ts += timedelta(minutes=20)
+
+    def testKeepOneRecordPerBucketOfEachTier(self):
+        deleted = compact_stock(self.stock, now=self.now, chunk_size=50)
+        records = StockRecord.objects.filter(stock="compact")
+        self.assertEqual(records.filter(timestamp__gte=datetime(2011, 7, 9)).count(), 72)
+        self.assertEqual(records.filter(timestamp__gte=datetime(2011, 7, 7),
+                                        timestamp__lt=datetime(2011, 7, 9)).count(), 48)
+        self.assertEqual(records.filter(timestamp__lt=datetime(2011, 7, 7)).count(), 2)
+        self.assertEqual(deleted, 360 - 72 - 48 - 2)
+        self.assertEqual(StockFacetRecord.objects.count(), 72 + 48 + 2)
+        self.assertEqual(compact_stock(self.stock, now=self.now), 0)
+
+    def testKeepTheLastRecordOfABucketByTime(self):
+        StockRecord.objects.create(stock="compact", count=2, timestamp=datetime(2011, 7, 5, 9))
+        compact_stock(self.stock, now=self.now)
+        kept = StockRecord.objects.filter(stock="compact", timestamp__lt=datetime(2011, 7, 6))
+        self.assertEqual([(r.timestamp, r.count) for r in kept],
+                         [(datetime(2011, 7, 5, 23, 40), 1)])
+
+    def testSkipStocksWithoutAPolicy(self):
+        self.stock.compaction = None
+        self.assertEqual(compact_stock_records([self.stock]), "There are no stocks to compact.")
+        self.assertEqual(StockRecord.objects.filter(stock="compact").count(), 360)
+
+
+class ExportShould(TestCase):
+    def setUp(self):
+        self.records = []
+        for day in range(1, 6):
+            self.records.append(StockRecord.objects.create(stock="exported", count=day,
+                                                           timestamp=datetime(2011, 7, day)))
+        StockRecord.objects.create(stock="other", count=1, timestamp=datetime(2011, 7, 1))
+
+    def testExportRowsInChunksAfterAPrimaryKey(self):
+        qs, columns = export_queryset("stock_records", "exported")
+        rows = list(export_rows(qs, columns, chunk_size=2))
+        self.assertEqual([r[0] for r in rows], [sr.id for sr in self.records])
+        rows = list(export_rows(qs, columns, after=self.records[2].id, chunk_size=2))
+        self.assertEqual([r[0] for r in rows], [sr.id for sr in self.records[3:]])
+
+    def testReadFromTheReadDatabase(self):
+        qs, columns = export_queryset("stock_records", "exported")
+        self.assertEqual(qs.db, "default")
+        qs, columns = export_queryset("facet_records", "exported", using="replica")
+        self.assertEqual(qs.db, "replica")
+        Flow("exported_flow", "Exported", UserFlowEvent, using="replica")
+        qs, columns = export_queryset("flow_events", "exported_flow")
+        self.assertEqual(qs.db, "replica")
+
+    def testFilterByTime(self):
+        lines = list(export_lines("stock_records", "ndjson", "exported",
+                                  datetime(2011, 7, 2), datetime(2011, 7, 4)))
+        self.assertEqual([json.loads(l)["count"] for l in lines], [2, 3])
+
+    def testWriteACsvHeader(self):
+        StockFacetRecord.objects.create(stock_record=self.records[0], facet="f", value="v",
+                                        count=1)
+        lines = list(export_lines("facet_records", "csv", "exported"))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("id,stock_record,stock_record__stock"))
+
+    def testRejectUnknownKindsAndFlows(self):
+        self.assertRaises(ValueError, export_lines, "users")
+        self.assertRaises(ValueError, export_lines, "flow_events", slug="no_such_flow")
+        self.assertRaises(ValueError, parse_datetime, "July 1st")
+
+
+class MembershipShould(TestCase):
+    def testRoundTripThePrimaryKeys(self):
+        pks = [0, 1, 1, 5, 300, 2 ** 40]
+        self.assertEqual(decode_members(encode_members(pks)), [0, 1, 5, 300, 2 ** 40])
+        self.assertEqual(decode_members(encode_members(iter(pks))), [0, 1, 5, 300, 2 ** 40])
+        self.assertEqual(decode_members(encode_members([])), [])
+        self.assertRaises(ValueError, encode_members, ["a"])
+        self.assertRaises(ValueError, encode_members, [5, 1])
+
+    def testEncodeManyKeysInPieces(self):
+        pks = xrange(0, 3000000, 3)
+        self.assertEqual(decode_members(encode_members(pks)), list(pks))
+
+    def testRefuseStocksWithoutIntegerPrimaryKeys(self):
+        qs = Mock()
+        qs.model._meta.pk = models.CharField(max_length=40, primary_key=True)
+        self.assertRaises(ValueError, Stock, "keyed", "Keyed", qs, membership=True)
+        Stock("keyed", "Keyed", qs)
+        Stock("users", "Users", User.objects.all(), membership=True)
+
+    def testEncodeDenseKeysCompactly(self):
+        self.assertTrue(len(encode_members(range(1, 100001))) < 2000)
+
+    def testCompareSnapshots(self):
+        before = MembershipSnapshot([1, 2, 3])
+        after = MembershipSnapshot([2, 3, 4])
+        self.assertEqual(list(before - after), [1])
+        self.assertEqual(list(before & after), [2, 3])
+        self.assertEqual(list(before | after), [1, 2, 3, 4])
+        self.assertTrue(4 in after)
+        self.assertEqual(len(after), 3)
+
+    def testSnapshotTheMembersOfAStock(self):
+        stock = Stock("active", "Active", User.objects.filter(is_active=True), membership=True)
+        left = User.objects.create(username="left", is_active=True)
+        stayed = User.objects.create(username="stayed", is_active=True)
+        snapshot = StockSnapshot(datetime(2011, 7, 1))
+        stock.add_to_snapshot(snapshot)
+        snapshot.write()
+        User.objects.filter(pk=left.pk).update(is_active=False)
+        stock.save_count()
+        before = stock.membership_at(datetime(2011, 7, 2))
+        after = stock.membership_at()
+        self.assertEqual(list(before - after), [left.pk])
+        self.assertEqual(list(after), [stayed.pk])
+        self.assertEqual(before.timestamp, datetime(2011, 7, 1))
+
+
+class ExportViewShould(TestCase):
+    urls = "stockandflow.export_urls"
+
+    def setUp(self):
+        self.records = [StockRecord.objects.create(stock="exported", count=day,
+                                                   timestamp=datetime(2011, 7, day))
+                        for day in range(1, 4)]
+        staff = User.objects.create_user("staff", "staff@example.com", "secret")
+        staff.is_staff = True
+        staff.save()
+
+    def content(self, response):
+        if hasattr(response, "streaming_content"):
+            return b"".join(response.streaming_content)
+        return response.content
+
+    def testOnlyExportToStaff(self):
+        response = self.client.get("/stock_records/")
+        self.assertFalse(response.has_header("Content-Disposition"))
+        User.objects.create_user("member", "member@example.com", "secret")
+        self.client.login(username="member", password="secret")
+        response = self.client.get("/stock_records/")
+        self.assertFalse(response.has_header("Content-Disposition"))
+
+    def testStreamTheExport(self):
+        self.client.login(username="staff", password="secret")
+        response = self.client.get("/stock_records/", {"slug": "exported"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/csv"))
+        self.assertEqual(response["Content-Disposition"], "attachment; filename=exported.csv")
+        rows = list(csv.reader(self.content(response).splitlines()))
+        self.assertEqual(rows[0][:3], ["id", "stock", "timestamp"])
+        self.assertEqual([int(r[0]) for r in rows[1:]], [sr.id for sr in self.records])
+        response = self.client.get("/stock_records/", {"slug": "exported", "format": "ndjson",
+                                                       "after": self.records[0].id})
+        self.assertTrue(response["Content-Type"].startswith("application/x-ndjson"))
+        self.assertEqual([json.loads(l)["count"] for l in self.content(response).splitlines()],
+                         [2, 3])
+
+    def testRejectBadOptionsBeforeStreaming(self):
+        self.client.login(username="staff", password="secret")
+        for query in ({"after": "x"}, {"start": "July"}, {"format": "xml"}):
+            self.assertEqual(self.client.get("/stock_records/", query).status_code, 400)
+
+
+class ExportCommandShould(TestCase):
+    def setUp(self):
+        from StringIO import StringIO
+        from stockandflow.management.commands.export_stockandflow import Command
+        self.records = [StockRecord.objects.create(stock="exported", count=day,
+                                                   timestamp=datetime(2011, 7, day))
+                        for day in range(1, 6)]
+        self.command = Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+        self.options = {"format": "ndjson", "slug": "exported", "start": None, "end": None,
+                        "after": None, "chunk_size": 2, "output": None}
+
+    def testWriteToStdoutAndReportTheLastPrimaryKey(self):
+        self.command.handle("stock_records", **self.options)
+        lines = self.command.stdout.getvalue().splitlines()
+        self.assertEqual([json.loads(l)["count"] for l in lines], [1, 2, 3, 4, 5])
+        self.assertEqual(self.command.stderr.getvalue(),
+                         "Exported 5 rows up to primary key %s.\n" % self.records[-1].id)
+
+    def testResumeAfterAPrimaryKeyIntoAFile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "records.csv")
+            self.options.update(format="csv", after=self.records[2].id, output=path)
+            self.command.handle("stock_records", **self.options)
+            rows = list(csv.reader(open(path, "rb")))
+            self.assertEqual([int(r[0]) for r in rows[1:]],
+                             [sr.id for sr in self.records[3:]])
+            self.assertEqual(self.command.stdout.getvalue(), "")
+            self.assertEqual(self.command.stderr.getvalue(),
+                             "Exported 2 rows up to primary key %s.\n" % self.records[-1].id)
+        finally:
+            shutil.rmtree(directory)
+
+    def testRejectBadOptions(self):
+        from django.core.management.base import CommandError
+        self.assertRaises(CommandError, self.command.handle, **self.options)
+        self.options["start"] = "July"
+        self.assertRaises(CommandError, self.command.handle, "stock_records", **self.options)
+
+
+class StockReplayShould(TestCase):
+    def setUp(self):
+        self.stock = Stock("replayed", "Replayed", User.objects.all())
+        StockRecord.objects.create(stock="replayed", count=10, timestamp=datetime(2011, 7, 1))
+        StockRecord.objects.create(stock="replayed", count=99, timestamp=datetime(2011, 7, 1, 1),
+                                   strategy="sampled")
+        self.replay = StockReplay(self.stock)
+        self.nets = [(datetime(2011, 7, 1, 0, 2), 3), (datetime(2011, 7, 1, 0, 4), -1)]
+
+    def testCountFromTheClosestExactRecord(self):
+        self.replay.net_flow = Mock(return_value=4)
+        self.assertEqual(self.replay.count_at(datetime(2011, 7, 1, 2)), 14)
+        self.replay.net_flow.assert_called_with(datetime(2011, 7, 1), datetime(2011, 7, 1, 2))
+        self.assertEqual(self.replay.count_at(datetime(2011, 6, 30)), 6)
+        self.replay.net_flow.assert_called_with(datetime(2011, 6, 30), datetime(2011, 7, 1))
+
+    def testReplayASeries(self):
+        self.replay.net_flow = Mock(return_value=0)
+        self.replay.net_flow_series = Mock(return_value=self.nets)
+        series = self.replay.series(datetime(2011, 7, 1), datetime(2011, 7, 1, 0, 6))
+        self.assertEqual([count for ts, count in series], [10, 10, 10, 13, 13, 12])
+        self.assertEqual(series[-1][0], datetime(2011, 7, 1, 0, 5))
+
+    @patch.object(StockReplay, "net_flow", Mock(return_value=0))
+    def testFillTheGapsInTheRecords(self):
+        with patch.object(StockReplay, "net_flow_series", Mock(return_value=self.nets)):
+            records = self.replay.fill_gaps(datetime(2011, 7, 1), datetime(2011, 7, 1, 0, 6),
+                                            "minute")
+        self.assertEqual([(r.timestamp.minute, r.count) for r in records],
+                         [(1, 10), (2, 10), (3, 13), (4, 13), (5, 12)])
+        self.assertEqual(StockRecord.objects.filter(strategy="replayed").count(), 5)
+
+    def testFillTheGapsFromTheFlowEvents(self):
+        user = User.objects.create(username="flowed")
+        Flow("joining", "Joining", UserFlowEvent, sources=[None], sinks=[self.stock])
+        Flow("leaving", "Leaving", UserFlowEvent, sources=[self.stock], sinks=[None])
+        events = [(2, "joining", None, "replayed")] * 3 + [(4, "leaving", "replayed", None)] + \
+                 [(5, "leaving", "replayed", None)] * 13 + [(5, "joining", None, "other")]
+        for minute, flow, source, sink in events:
+            UserFlowEvent.objects.create(flow=flow, subject=user, source=source, sink=sink,
+                                         timestamp=datetime(2011, 7, 1, 0, minute))
+        # The gaps and counts are read from the database the records go to
+        self.stock.using = "replica"
+        self.replay = StockReplay(self.stock)
+        records = self.replay.fill_gaps(datetime(2011, 7, 1), datetime(2011, 7, 1, 0, 7),
+                                        "minute")
+        self.assertEqual([(r.timestamp.minute, r.count) for r in records],
+                         [(1, 10), (2, 10), (3, 13), (4, 13), (5, 12), (6, -1)])
+        self.assertEqual(self.replay.fill_gaps(datetime(2011, 7, 1), datetime(2011, 7, 1, 0, 7),
+                                               "minute"), [])
+
+    def testStepThroughMonths(self):
+        self.assertEqual(truncate_datetime(datetime(2011, 12, 5, 3, 4, 5), "month"),
+                         datetime(2011, 12, 1))
+        self.assertEqual(next_period(datetime(2011, 12, 1), "month"), datetime(2012, 1, 1))
+
+
+class AuditShould(TestCase):
+    def setUp(self):
+        self.stock = Stock("audited", "Audited", User.objects.all())
+        Flow("joining", "Joining", UserFlowEvent, sources=[None], sinks=[self.stock])
+        Flow("leaving", "Leaving", UserFlowEvent, sources=[self.stock], sinks=[None])
+        for ts, count in [((0, 0, 0), 10), ((1, 0, 30), 12), ((2, 0, 0), 15), ((3, 0, 0), 15)]:
+            StockRecord.objects.create(stock="audited", count=count,
+                                       timestamp=datetime(2011, 7, 1, *ts))
+        StockRecord.objects.create(stock="audited", count=50, strategy="sampled",
+                                   timestamp=datetime(2011, 7, 1, 2, 30))
+        user = User.objects.create(username="flowed")
+        # The event at 1:00:45 is in the minute of the record at 1:00:30 but
+        # after it, so it belongs to the interval from that record on.
+        events = [((0, 10, 0), "joining", None, "audited"),
+                  ((0, 20, 0), "joining", None, "audited"),
+                  ((1, 0, 45), "joining", None, "audited"),
+                  ((1, 30, 0), "joining", None, "audited"),
+                  ((1, 30, 0), "joining", None, "other"),
+                  ((2, 10, 0), "joining", None, "audited"),
+                  ((2, 20, 0), "leaving", "audited", None),
+                  ((2, 40, 0), "leaving", "audited", None),
+                  ((2, 50, 0), "leaving", "audited", None),
+                  ((3, 10, 0), "joining", None, "audited")]
+        for ts, flow, source, sink in events:
+            UserFlowEvent.objects.create(flow=flow, subject=user, source=source, sink=sink,
+                                         timestamp=datetime(2011, 7, 1, *ts))
+
+    def testReportTheDriftOfEachInterval(self):
+        self.assertEqual(audit_stock(self.stock), [
+            (datetime(2011, 7, 1, 1, 0, 30), datetime(2011, 7, 1, 2), 3, 2, 1),
+            (datetime(2011, 7, 1, 2), datetime(2011, 7, 1, 3), 0, -2, 2)])
+        self.assertEqual(audit_stock(self.stock, start=datetime(2011, 7, 1, 1)), [
+            (datetime(2011, 7, 1, 1, 0, 30), datetime(2011, 7, 1, 2), 3, 2, 1),
+            (datetime(2011, 7, 1, 2), datetime(2011, 7, 1, 3), 0, -2, 2)])
+        self.assertEqual(audit_stock(self.stock, end=datetime(2011, 7, 1, 2)), [])
+
+    def testCountTheEventsOfManyIntervals(self):
+        replay = StockReplay(self.stock)
+        bounds = [datetime(2011, 7, 1) + timedelta(seconds=15 * i) for i in range(1000)]
+        nets = replay.net_flows_between(bounds)
+        self.assertEqual(len(nets), 999)
+        self.assertEqual(sum(nets), 3)
+        self.assertEqual(nets[40], 1)
+        self.assertEqual(nets[243], 1)
+
+    def testAllowATolerance(self):
+        self.assertEqual(len(audit_stock(self.stock, tolerance=1)), 1)
+        message = audit_stocks([self.stock], tolerance=2)
+        self.assertEqual(message, "audited: no drift.")
+
+    @patch("stockandflow.management.commands.audit_stocks.audit_stocks")
+    def testAuditTheGivenStocksAsAManagementCommand(self, audit_mock):
+        from StringIO import StringIO
+        from django.core.management.base import CommandError
+        from stockandflow.management.commands.audit_stocks import Command
+        audit_mock.return_value = "audited: no drift."
+        command = Command()
+        command.stdout = StringIO()
+        command.handle("audited", start="2011-07-01", end="2011-07-01 02:00:00", tolerance=1)
+        self.assertEqual(command.stdout.getvalue(), "audited: no drift.\n")
+        stocks, start, end, tolerance = audit_mock.call_args[0]
+        self.assertEqual([s.slug for s in stocks], ["audited"])
+        self.assertEqual((start, end, tolerance),
+                         (datetime(2011, 7, 1), datetime(2011, 7, 1, 2), 1))
+        self.assertRaises(CommandError, command.handle, "missing", start=None, end=None,
+                          tolerance=0)
+        self.assertRaises(CommandError, command.handle, "audited", start="July", end=None,
+                          tolerance=0)
+
+
 class FlowTest(TestCase):
 
     def setUp(self):
@@ -210,6 +929,427 @@ class FlowTest(TestCase):
         self.assertEqual(((), {"sink": sink_mock.slug}), qs2_mock.filter.call_args)
 
 
+class BufferedFlowEventsShould(TestCase):
+    def setUp(self):
+        from stockandflow.counting import CacheCounterStore
+        self.mock_qs = Mock()
+        self.mock_qs.count.return_value = 10
+        store = CacheCounterStore(cache=FakeCache())
+        self.source = Stock("source", "Source", self.mock_qs, live_counter=store)
+        self.sink = Stock("sink", "Sink", self.mock_qs, live_counter=store)
+        self.callable = Mock()
+        self.flow = Flow("moving", "Moving", Mock(), sources=[self.source], sinks=[self.sink],
+                         event_callables=[self.callable])
+
+    @patch("stockandflow.events.bulk_insert")
+    def testWriteTheEventsInBulkWhenTheBlockEnds(self, bulk_mock):
+        from stockandflow.events import buffered_flow_events
+        with buffered_flow_events() as buffer:
+            fe = self.flow.add_event(Mock(), self.source, self.sink)
+            self.assertEqual(len(buffer), 1)
+            self.assertFalse(bulk_mock.called)
+        self.assertFalse(fe.save.called)
+        self.assertEqual(bulk_mock.call_args[0][1], [fe])
+
+    @patch("stockandflow.events.bulk_insert")
+    def testDiscardTheEventsWhenTheBlockFails(self, bulk_mock):
+        from stockandflow.events import buffered_flow_events
+        def fail():
+            with buffered_flow_events():
+                self.flow.add_event(Mock(), self.source, self.sink)
+                raise RuntimeError
+        self.assertRaises(RuntimeError, fail)
+        self.assertFalse(bulk_mock.called)
+
+    @patch("stockandflow.events.bulk_insert")
+    def testOnlyCountAndRunCallablesAfterTheBlockCommits(self, bulk_mock):
+        from stockandflow.events import buffered_flow_events
+        self.source.count()
+        obj = Mock()
+        def fail():
+            with buffered_flow_events():
+                self.flow.add_event(obj, self.source, self.sink)
+                raise RuntimeError
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(self.source.count(), 10)
+        self.assertFalse(self.callable.called)
+        with buffered_flow_events():
+            self.flow.add_event(obj, self.source, self.sink)
+            self.assertEqual(self.source.count(), 10)
+            self.assertFalse(self.callable.called)
+        self.assertEqual(self.source.count(), 9)
+        self.callable.assert_called_with(obj, self.source, self.sink)
+
+    @patch("stockandflow.events.bulk_insert")
+    def testRunTheCallablesOfANestedBlockWhenTheOutermostCommits(self, bulk_mock):
+        from stockandflow.events import buffered_flow_events
+        obj = Mock()
+        def fail():
+            with buffered_flow_events():
+                with buffered_flow_events():
+                    self.flow.add_event(obj, self.source, self.sink)
+                self.assertFalse(self.callable.called)
+                raise RuntimeError
+        self.assertRaises(RuntimeError, fail)
+        self.assertFalse(self.callable.called)
+        with buffered_flow_events():
+            with buffered_flow_events():
+                self.flow.add_event(obj, self.source, self.sink)
+            self.assertFalse(self.callable.called)
+        self.callable.assert_called_with(obj, self.source, self.sink)
+
+    @patch("stockandflow.events.bulk_insert")
+    def testSaveASyncEventImmediately(self, bulk_mock):
+        from stockandflow.events import buffered_flow_events
+        with buffered_flow_events() as buffer:
+            fe = self.flow.add_event(Mock(), self.source, self.sink, sync=True)
+            self.assertTrue(fe.save.called)
+            self.assertEqual(len(buffer), 0)
+
+
+class FlowExecutorShould(TestCase):
+    def setUp(self):
+        self.mock_qs = Mock()
+        self.source = Stock("source", "Source", self.mock_qs)
+        self.sink = Stock("sink", "Sink", self.mock_qs)
+
+    def flow(self, executor, *event_callables, **kwargs):
+        return Flow("moving", "Moving", kwargs.get("event_model") or Mock(),
+                    sources=[self.source], sinks=[self.sink],
+                    event_callables=list(event_callables), executor=executor)
+
+    def testRunCallablesInlineByDefault(self):
+        c = Mock()
+        f = self.flow(None, c)
+        obj = Mock()
+        f.add_event(obj, self.source, self.sink)
+        c.assert_called_with(obj, self.source, self.sink)
+
+    @patch("stockandflow.executors.close_connections")
+    def testRetryAFailingCallableOnTheThreadPool(self, close_mock):
+        from stockandflow.executors import ThreadPoolExecutor
+        c = Mock(side_effect=[RuntimeError, None])
+        executor = ThreadPoolExecutor(workers=1)
+        f = self.flow(executor, (c, {"retries": 1}))
+        f.add_event(Mock(), self.source, self.sink)
+        executor.wait()
+        self.assertEqual(c.call_count, 2)
+
+    def testQueueCallablesForTheWorkerCommand(self):
+        from stockandflow.executors import QueuedExecutor, run_queued_calls
+        from stockandflow.models import QueuedFlowCall
+        c = Mock()
+        f = self.flow(QueuedExecutor(), c, event_model=UserFlowEvent)
+        user = User.objects.create(username="flowed")
+        f.add_event(user, self.source, self.sink)
+        self.assertFalse(c.called)
+        self.assertEqual(QueuedFlowCall.objects.count(), 1)
+        self.assertEqual(run_queued_calls(), (1, 0))
+        obj, source, sink = c.call_args[0]
+        self.assertTrue(isinstance(obj, User))
+        self.assertEqual((obj.pk, source, sink), (user.pk, self.source, self.sink))
+        self.assertEqual(QueuedFlowCall.objects.count(), 0)
+
+    def testRetryAQueuedCallAfterABackoffUntilItHasNoRetriesLeft(self):
+        from stockandflow.executors import QueuedExecutor, run_queued_calls
+        from stockandflow.models import QueuedFlowCall
+        c = Mock(side_effect=RuntimeError)
+        f = self.flow(QueuedExecutor(retries=1), c, event_model=UserFlowEvent)
+        f.add_event(User.objects.create(username="flowed"), self.source, self.sink)
+        now = datetime.now()
+        self.assertEqual(run_queued_calls(now=now, backoff=60), (0, 1))
+        call = QueuedFlowCall.objects.get()
+        self.assertFalse(call.failed)
+        self.assertEqual(call.next_attempt_at, now + timedelta(seconds=60))
+        self.assertEqual(run_queued_calls(now=now + timedelta(seconds=30)), (0, 0))
+        self.assertEqual(run_queued_calls(now=now + timedelta(seconds=60)), (0, 1))
+        self.assertTrue(QueuedFlowCall.objects.get().failed)
+        self.assertEqual(c.call_count, 2)
+
+    def testNotRunACallThatAnotherWorkerClaimed(self):
+        from stockandflow.executors import QueuedExecutor, claim_queued_calls, run_queued_calls
+        c = Mock()
+        f = self.flow(QueuedExecutor(), c, event_model=UserFlowEvent)
+        f.add_event(User.objects.create(username="flowed"), self.source, self.sink)
+        now = datetime.now()
+        self.assertEqual(len(claim_queued_calls(now=now)), 1)
+        self.assertEqual(claim_queued_calls(now=now), [])
+        self.assertEqual(run_queued_calls(now=now), (0, 0))
+        self.assertFalse(c.called)
+        # The claim of a worker that died runs out
+        self.assertEqual(run_queued_calls(now=now + timedelta(seconds=601)), (1, 0))
+
+
+class FlowAddEventsShould(TestCase):
+    def setUp(self):
+        self.mock_qs = Mock()
+        self.source = Stock("source", "Source", self.mock_qs)
+        self.sink = Stock("sink", "Sink", self.mock_qs)
+        self.callable = Mock()
+        self.flow = Flow("moving", "Moving", Mock(), sources=[self.source],
+                         sinks=[self.sink], event_callables=[self.callable])
+        self.transitions = [(1, self.source, self.sink), (2, self.sink, self.source),
+                            (3, self.source, self.sink), (4, self.source, self.sink)]
+
+    @patch("stockandflow.models.bulk_insert")
+    def testWriteTheConnectedTransitionsInChunks(self, bulk_mock):
+        recorded = self.flow.add_events(self.transitions, chunk_size=2)
+        self.assertEqual(recorded, 3)
+        self.assertEqual([len(c[0][1]) for c in bulk_mock.call_args_list], [2, 1])
+        kwargs = self.flow.flow_event_model.call_args_list[0][1]
+        self.assertEqual(kwargs, {"flow": "moving", "subject_id": 1,
+                                  "source": "source", "sink": "sink"})
+
+    @patch("stockandflow.models.bulk_insert")
+    def testOnlyRunCallablesWhenAsked(self, bulk_mock):
+        self.flow.add_events(self.transitions)
+        self.assertFalse(self.callable.called)
+        objs = {1: Mock(), 4: Mock()} # 3 has been deleted
+        manager = self.flow.subject_model._default_manager
+        manager.in_bulk.return_value = objs
+        self.flow.add_events(self.transitions, run_callables=True)
+        manager.in_bulk.assert_called_with([1, 3, 4])
+        self.assertEqual([c[0] for c in self.callable.call_args_list],
+                         [(objs[1], self.source, self.sink), (objs[4], self.source, self.sink)])
+
+    def testGiveTheCallablesOfRealEventsTheObjects(self):
+        user = User.objects.create(username="flowed")
+        called = []
+        flow = Flow("joining", "Joining", UserFlowEvent, sources=[None], sinks=[self.sink],
+                    event_callables=[lambda obj, source, sink: called.append(obj)])
+        flow.add_events([(user.pk, None, self.sink), (user, None, self.sink)],
+                        run_callables=True)
+        self.assertEqual(called, [user, user])
+        self.assertTrue(isinstance(called[0], User))
+        self.assertEqual(UserFlowEvent.objects.filter(subject=user).count(), 2)
+
+
+class FlowRouterShould(TestCase):
+    def setUp(self):
+        self.mock_qs = Mock()
+        self.a = Stock("a", "A", self.mock_qs)
+        self.b = Stock("b", "B", self.mock_qs)
+        self.joining = Flow("joining", "Joining", Mock(), sources=[None], sinks=[self.a])
+        self.moving = Flow("moving", "Moving", Mock(), sources=[self.a], sinks=[self.b])
+
+    def testRouteEachPairToItsFlow(self):
+        router = FlowRouter([self.joining, self.moving])
+        self.assertTrue(router.route(None, self.a) is self.joining)
+        self.assertTrue(router.route(self.a, self.b) is self.moving)
+        self.assertTrue(router.route(self.b, self.a) is None)
+
+    def testWarnAboutThePairsThatATrackerCanNotTellApart(self):
+        other = Flow("other", "Other", Mock(), sources=[self.a], sinks=[self.b])
+        unrelated = Flow("unrelated", "Unrelated", Mock(), sources=[None], sinks=[self.a])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            router = FlowRouter([self.moving, other, self.joining, unrelated])
+            ModelTracker((), Mock(), stocks=[self.a, self.b], flows=[self.joining, self.moving])
+            self.assertEqual(len(caught), 0)
+            mt = ModelTracker((), Mock(), stocks=[self.a, self.b],
+                              flows=[self.joining, other, self.moving])
+        self.assertEqual(len(caught), 1)
+        self.assertTrue("It is recorded by moving." in str(caught[0].message))
+        self.assertTrue(mt.find_flow(self.a, self.b) is self.moving)
+        self.assertEqual(mt.ambiguous_pairs(), [(self.a, self.b, [self.moving, other])])
+        self.assertTrue(router.route(self.a, self.b) is self.moving)
+
+    def testListUnroutablePairs(self):
+        router = FlowRouter([self.joining, self.moving])
+        self.assertEqual(router.unroutable_pairs([self.a, self.b]),
+                         [(None, self.b), (self.a, None), (self.b, None), (self.b, self.a)])
+
+    def testIndexEveryFlowWhenItIsCreated(self):
+        from stockandflow.models import flow_router
+        self.assertTrue(flow_router.route(self.a, self.b) is self.moving)
+        replacement = Flow("moving", "Moving", Mock(), sources=[self.b], sinks=[self.a])
+        self.assertTrue(flow_router.route(self.a, self.b) is None)
+        self.assertTrue(flow_router.route(self.b, self.a) is replacement)
+
+    @patch("stockandflow.tracker.logger")
+    def testLogTheUnroutablePairsOfATrackerWhenItIsCreated(self, logger_mock):
+        mt = ModelTracker((), Mock(), stocks=[self.a, self.b], flows=[self.joining, self.moving])
+        self.assertTrue(mt.find_flow(self.a, self.b) is self.moving)
+        self.assertEqual(mt.unroutable_pairs(),
+                         [(None, self.b), (self.a, None), (self.b, None), (self.b, self.a)])
+        self.assertTrue(logger_mock.warning.called)
+
+
+class FlowRollupShould(TestCase):
+    def setUp(self):
+        self.flow = Flow("moving", "Moving", Mock())
+        self.source = Stock("a", "A", Mock())
+        start = datetime(2011, 7, 1, 10)
+        for hours, source, count in [(0, "a", 3), (0, "b", 2), (1, "a", 4), (5, "a", 1)]:
+            FlowRecord.objects.create(flow="moving", source=source, sink="c", period="hour",
+                                      start=start + timedelta(hours=hours), count=count)
+
+    def testTruncateDatetimesInTheDatabase(self):
+        from django.db import connection
+        sr = StockRecord.objects.create(stock="trunc", count=1,
+                                        timestamp=datetime(2011, 7, 1, 10, 35, 12))
+        column = connection.ops.quote_name("timestamp")
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s FROM %s WHERE id = %%s" % (
+                truncate_datetime_sql("default", column, "hour"),
+                StockRecord._meta.db_table), [sr.id])
+        self.assertEqual(parse_truncated(cursor.fetchone()[0]), datetime(2011, 7, 1, 10))
+
+    def testCountRowsPerBucket(self):
+        for day, hour in [(1, 1), (1, 23), (3, 5)]:
+            StockRecord.objects.create(stock="bucketed", count=1,
+                                       timestamp=datetime(2011, 7, day, hour))
+        StockRecord.objects.create(stock="other", count=1, timestamp=datetime(2011, 7, 2))
+        counts = bucketed_counts(StockRecord.objects.filter(stock="bucketed"), "timestamp", "day")
+        self.assertEqual(counts, [(datetime(2011, 7, 1), 2), (datetime(2011, 7, 3), 1)])
+
+    def testRejectUnknownPeriods(self):
+        self.assertRaises(ValueError, truncate_datetime_sql, "default", "timestamp", "fortnight")
+
+    def testReadRecordedRates(self):
+        rate = self.flow.recorded_rate(datetime(2011, 7, 1), datetime(2011, 7, 1, 12))
+        self.assertEqual(rate, [(datetime(2011, 7, 1, 10), 5), (datetime(2011, 7, 1, 11), 4)])
+        rate = self.flow.recorded_rate(datetime(2011, 7, 1), datetime(2011, 7, 2),
+                                       source=self.source)
+        self.assertEqual([count for start, count in rate], [3, 4, 1])
+
+
+class RollupFlowEventsShould(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="flowed")
+        self.flow = Flow("joining", "Joining", UserFlowEvent)
+        self.start = datetime(2011, 7, 1, 10)
+
+    def add_events(self, *events):
+        for minutes, sink in events:
+            UserFlowEvent.objects.create(flow="joining", subject=self.user, sink=sink,
+                                         timestamp=self.start + timedelta(minutes=minutes))
+
+    def recorded(self):
+        return dict(((r.start.hour, r.sink), r.count) for r in
+                    FlowRecord.objects.filter(flow="joining", period="hour"))
+
+    def testRollUpTheEventsOfEachHour(self):
+        from stockandflow.rollups import rollup_event_model
+        self.add_events((5, "a"), (50, "a"), (55, "b"), (70, "a"))
+        self.assertEqual(rollup_event_model(UserFlowEvent), (4, 3))
+        self.assertEqual(self.recorded(), {(10, "a"): 2, (10, "b"): 1, (11, "a"): 1})
+        mark = FlowRollupMark.objects.get(model="auth.UserFlowEvent", period="hour")
+        self.assertEqual(mark.last_id, UserFlowEvent.objects.latest("id").id)
+
+    def testOnlyAddTheNewEventsOnTheNextRun(self):
+        from stockandflow.rollups import rollup_flow_events
+        self.add_events((5, "a"), (70, "a"))
+        rollup_flow_events([self.flow])
+        self.add_events((80, "a"), (125, "b"))
+        message = rollup_flow_events([self.flow])
+        self.assertEqual(message, "Rolled up 2 auth.UserFlowEvent events into "
+                                  "2 hour records.")
+        self.assertEqual(self.recorded(), {(10, "a"): 1, (11, "a"): 2, (12, "b"): 1})
+        self.assertEqual(self.flow.recorded_rate(self.start, self.start + timedelta(hours=3)),
+                         [(datetime(2011, 7, 1, 10), 1), (datetime(2011, 7, 1, 11), 2),
+                          (datetime(2011, 7, 1, 12), 1)])
+
+    def testCountTheEventsPerBucket(self):
+        self.add_events((5, "a"), (50, "b"), (70, "a"), (185, "a"))
+        UserFlowEvent.objects.create(flow="leaving", subject=self.user, source="a",
+                                     timestamp=self.start)
+        end = self.start + timedelta(hours=3)
+        self.assertEqual(self.flow.rate(self.start, end),
+                         [(datetime(2011, 7, 1, 10), 2), (datetime(2011, 7, 1, 11), 1)])
+        self.assertEqual(self.flow.rate(self.start, end, sink=Stock("a", "A", Mock())),
+                         [(datetime(2011, 7, 1, 10), 1), (datetime(2011, 7, 1, 11), 1)])
+        self.assertEqual(self.flow.rate(self.start, end + timedelta(hours=1), "day"),
+                         [(datetime(2011, 7, 1), 4)])
+
+    def testNotCountAnEventTwice(self):
+        from stockandflow.rollups import rollup_event_model
+        self.add_events((5, "a"), (50, "b"))
+        rollup_event_model(UserFlowEvent)
+        self.assertEqual(rollup_event_model(UserFlowEvent), (0, 0))
+        self.assertEqual(self.recorded(), {(10, "a"): 1, (10, "b"): 1})
+        rollup_event_model(UserFlowEvent, "day")
+        self.assertEqual(FlowRecord.objects.get(period="day").count, 2)
+        self.assertEqual(self.recorded(), {(10, "a"): 1, (10, "b"): 1})
+
+
+class ArchiveFlowEventsShould(TestCase):
+    def setUp(self):
+        self.flow = Mock()
+        self.flow.slug = "logging_in"
+        self.flow.retention_days = 30
+        self.flow.flow_event_model._meta.app_label = "app"
+        self.flow.flow_event_model._meta.object_name = "Event"
+        self.flow.queryset.using.return_value.filter.return_value.aggregate.return_value = \
+                {"last_id": 10}
+
+    def testRefuseFlowsWithoutRetention(self):
+        self.flow.retention_days = None
+        self.assertRaises(ArchiveError, archive_flow_events, self.flow, "/tmp")
+
+    @patch("stockandflow.archive.unrolled_events", Mock(return_value=0))
+    def testRefuseEventsThatAreNotRolledUp(self):
+        self.assertRaises(ArchiveError, check_rolled_up, self.flow, datetime.now(), "default")
+        hour = FlowRollupMark.objects.create(model="app.Event", period="hour", last_id=9)
+        self.assertRaises(ArchiveError, check_rolled_up, self.flow, datetime.now(), "default")
+        FlowRollupMark.objects.create(model="app.Event", period="day", last_id=10)
+        self.assertRaises(ArchiveError, check_rolled_up, self.flow, datetime.now(), "default")
+        check_rolled_up(self.flow, datetime.now(), "default", periods=["day"])
+        hour.last_id = 10
+        hour.save()
+        check_rolled_up(self.flow, datetime.now(), "default")
+        self.assertRaises(ArchiveError, check_rolled_up, self.flow, datetime.now(), "default",
+                          periods=["hour", "month"])
+
+    def testWriteTheOldEventsToAFileAndThenDeleteThem(self):
+        from stockandflow.rollups import rollup_event_model
+        user = User.objects.create(username="flowed")
+        flow = Flow("joining", "Joining", UserFlowEvent, retention_days=30)
+        now = datetime(2011, 7, 1, 12)
+        for days in (40, 39, 38, 35, 31, 10):
+            UserFlowEvent.objects.create(flow="joining", subject=user, sink="members",
+                                         timestamp=now - timedelta(days=days))
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertRaises(ArchiveError, archive_flow_events, flow, directory, now=now)
+            self.assertEqual(UserFlowEvent.objects.count(), 6)
+            rollup_event_model(UserFlowEvent)
+            archived, path = archive_flow_events(flow, directory, now=now, chunk_size=2)
+            self.assertEqual(archived, 5)
+            self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+            rows = list(csv.reader(gzip.open(path)))
+            self.assertEqual(rows[0], ["id", "flow", "timestamp", "source", "sink",
+                                       "subject_id"])
+            self.assertEqual([row[2][:10] for row in rows[1:]],
+                             ["2011-05-22", "2011-05-23", "2011-05-24", "2011-05-27",
+                              "2011-05-31"])
+            self.assertEqual([e.timestamp for e in UserFlowEvent.objects.all()],
+                             [now - timedelta(days=10)])
+            self.assertEqual(archive_flow_events(flow, directory, now=now), (0, None))
+        finally:
+            shutil.rmtree(directory)
+
+    def testRefuseEventsThatCommittedAfterTheRollupPassedThem(self):
+        from stockandflow.rollups import rollup_event_model
+        user = User.objects.create(username="flowed")
+        flow = Flow("joining", "Joining", UserFlowEvent, retention_days=30)
+        now = datetime(2011, 7, 1, 12)
+        events = [UserFlowEvent.objects.create(flow="joining", subject=user, sink="members",
+                                               timestamp=now - timedelta(days=40, hours=i))
+                  for i in range(3)]
+        late_pk = events[0].pk
+        events[0].delete()
+        rollup_event_model(UserFlowEvent)
+        before = now - timedelta(days=30)
+        check_rolled_up(flow, before, "default")
+        # An event that was in a transaction while the rollup ran
+        UserFlowEvent.objects.create(pk=late_pk, flow="joining", subject=user, sink="members",
+                                     timestamp=now - timedelta(days=40))
+        self.assertRaises(ArchiveError, check_rolled_up, flow, before, "default")
+        self.assertRaises(ArchiveError, archive_flow_events, flow, "/tmp", now=now)
+        self.assertEqual(UserFlowEvent.objects.count(), 3)
+
+
 class ModelTrackerTest(TestCase):
     def setUp(self):
         self.staff_stock = Stock(slug="staff", name="Staff members",
@@ -284,6 +1424,154 @@ class ModelTrackerTest(TestCase):
         u.save()
         self.assertTrue(self.creating_flow.flow_event_model.return_value.save.called)
 
+    def testSnapshotShouldBeOneTupleOfTheTrackedValues(self):
+        mt = ModelTracker(**self.args)
+        u = User(username="test1", is_staff=True, is_active=False)
+        self.assertEqual(mt.dispatcher.snapshot_of(u), (True, False))
+
+    def testSnapshotShouldSkipDeferredFields(self):
+        mt = ModelTracker(**self.args)
+        User.objects.create(username="test1", is_active=True)
+        u = User.objects.only("username", "is_staff").get(username="test1")
+        self.assertTrue(mt.dispatcher.snapshot_of(u)[1] is NOT_LOADED)
+        cfe_mock = Mock()
+        mt.create_flow_event = cfe_mock
+        u.save()
+        self.assertFalse(cfe_mock.called)
+
+    def testUntrackedObjectsShouldNotCreateFlowEvents(self):
+        mt = ModelTracker(**self.args)
+        User.objects.create(username="test1", is_active=True)
+        cfe_mock = Mock()
+        mt.create_flow_event = cfe_mock
+        for u in untracked(User.objects.all()):
+            self.assertFalse(mt.snapshot_attname in u.__dict__)
+            u.is_active = False
+            u.save()
+        self.assertFalse(cfe_mock.called)
+        self.assertFalse(tracking_suspended())
+
+    def testRelationsShouldBeGivenToTheStatesFunctionAsObjects(self):
+        func = Mock(return_value=((), ()))
+        mt = ModelTracker(("subject",), func,
+                          stocks=[Stock("events", "Events", UserFlowEvent.objects.all())])
+        first = User.objects.create(username="first")
+        second = User.objects.create(username="second")
+        fe = UserFlowEvent.objects.create(flow="moving", subject=first)
+        self.assertEqual(func.call_args[0], (None, [first]))
+        fe = UserFlowEvent.objects.get(pk=fe.pk)
+        self.assertEqual(mt.dispatcher.snapshot_of(fe), (first.pk,))
+        fe.subject = second
+        fe.save()
+        self.assertEqual(func.call_args[0], ([first], [second]))
+        self.assertTrue(func.call_args[0][1][0] is second)
+
+    def testAttributesThatAreNotFieldsShouldBeReadWithGetattr(self):
+        func = Mock(return_value=((), ()))
+        mt = ModelTracker(("is_member",), func,
+                          stocks=[Stock("members", "Members", MemberUser.objects.all())])
+        u = MemberUser.objects.create(username="member", is_active=True)
+        u = MemberUser.objects.get(pk=u.pk)
+        self.assertEqual(mt.dispatcher.snapshot_of(u), (True,))
+        u.is_active = False
+        u.save()
+        self.assertEqual(func.call_args[0], ([True], [False]))
+        self.assertRaises(ValueError, mt.update, MemberUser.objects.all(), is_active=True)
+
+    def testTrackersOfAModelShouldShareADispatcher(self):
+        mt = ModelTracker(**self.args)
+        self.args["fields_to_track"] = ("is_active", "is_superuser")
+        self.args["states_to_stocks_func"] = Mock(return_value=((), ()))
+        mt2 = ModelTracker(**self.args)
+        self.assertTrue(mt.dispatcher is mt2.dispatcher)
+        self.assertEqual(mt.dispatcher.attnames, ("is_staff", "is_active", "is_superuser"))
+        u = User.objects.create(username="test1", is_active=True)
+        u = User.objects.get(pk=u.pk)
+        u.is_superuser = True
+        u.save()
+        self.assertEqual(mt2.states_to_stocks_func.call_args_list[-1][0],
+                         ([True, False], [True, True]))
+
+    def testSnapshotsShouldOutliveChangesToTheTrackers(self):
+        mt = ModelTracker(**self.args)
+        User.objects.create(username="test1", is_active=True)
+        u = User.objects.get(username="test1")
+        self.args["fields_to_track"] = ("is_superuser",)
+        self.args["states_to_stocks_func"] = Mock(return_value=((), ()))
+        mt2 = ModelTracker(**self.args)
+        self.assertEqual(mt.dispatcher.snapshot_of(u), (False, True, NOT_LOADED))
+        del mt2 # The dispatcher drops the tracker when it is collected
+        self.assertEqual(mt.dispatcher.attnames, ("is_staff", "is_active"))
+        cfe_mock = Mock()
+        mt.create_flow_event = cfe_mock
+        u.is_active = False
+        u.save()
+        self.assertEqual(cfe_mock.call_args[0][:2], (self.active_stock, self.inactive_stock))
+
+    def testTrackedInstancesShouldSurvivePickling(self):
+        mt = ModelTracker(**self.args)
+        User.objects.create(username="test1", is_active=True)
+        u = pickle.loads(pickle.dumps(User.objects.only("username", "is_active")
+                                                  .get(username="test1")))
+        self.assertEqual(mt.dispatcher.snapshot_of(u), (NOT_LOADED, True))
+        self.assertTrue(mt.dispatcher.snapshot_of(u)[0] is NOT_LOADED)
+        cfe_mock = Mock()
+        mt.create_flow_event = cfe_mock
+        u.is_active = False
+        u.save()
+        self.assertEqual(cfe_mock.call_args[0][:2], (self.active_stock, self.inactive_stock))
+
+    def testMemoizeShouldOnlyCallTheStatesFunctionOncePerChange(self):
+        self.args["states_to_stocks_func"] = Mock(return_value=((None,), (None,)))
+        self.args["memo_size"] = 1
+        mt = ModelTracker(memoize=True, **self.args)
+        mt.transitions([False, True], [False, False])
+        mt.transitions([False, True], [False, False])
+        self.assertEqual(mt.states_to_stocks_func.call_count, 1)
+        mt.transitions([False, False], [False, True])
+        mt.transitions([False, True], [False, False])
+        self.assertEqual(mt.states_to_stocks_func.call_count, 3)
+
+    @patch("stockandflow.models.bulk_insert")
+    def testUpdateShouldCreateEventsForTheChangedRows(self, bulk_mock):
+        mt = ModelTracker(**self.args)
+        active = User.objects.create(username="active", is_active=True)
+        User.objects.create(username="inactive", is_active=False)
+        updated = mt.update(User.objects.all(), is_active=False)
+        self.assertEqual(updated, 2)
+        self.assertEqual(User.objects.filter(is_active=True).count(), 0)
+        self.assertEqual(bulk_mock.call_count, 1)
+        kwargs = self.deactivating_flow.flow_event_model.call_args[1]
+        self.assertEqual(kwargs, {"flow": "deactivating", "subject_id": active.pk,
+                                  "source": "active", "sink": "inactive"})
+
+    @patch("stockandflow.models.bulk_insert")
+    def testUpdateShouldReadTheStoredValuesBack(self, bulk_mock):
+        from django.db.models import F
+        mt = ModelTracker(**self.args)
+        User.objects.create(username="staff", is_active=True, is_staff=True)
+        active = User.objects.create(username="active", is_active=True)
+        mt.update(User.objects.all(), is_active=F("is_staff"))
+        kwargs = self.deactivating_flow.flow_event_model.call_args[1]
+        self.assertEqual(kwargs, {"flow": "deactivating", "subject_id": active.pk,
+                                  "source": "active", "sink": "inactive"})
+        # The string "0" is truthy but the field stores it as False
+        User.objects.filter(pk=active.pk).update(is_active=True)
+        mt.update(User.objects.filter(pk=active.pk), is_active="0")
+        self.assertEqual(self.deactivating_flow.flow_event_model.call_count, 2)
+
+    def testUpdateShouldWriteTheEventsInItsOwnTransaction(self):
+        mt = ModelTracker(**self.args)
+        User.objects.create(username="active", is_active=True)
+        with patch.object(Flow, "add_events") as add_events_mock:
+            mt.update(User.objects.all(), is_active=False)
+        self.assertEqual(add_events_mock.call_args[1], {"transactional": False})
+
+    def testUpdateShouldRejectRelationFields(self):
+        self.args["fields_to_track"] = ("groups",)
+        mt = ModelTracker(**self.args)
+        self.assertRaises(ValueError, mt.update, User.objects.all(), is_active=False)
+
 
 class PeriodicScheduleShould(TestCase):
     def testHaveADefaultSchedule(self):
@@ -541,6 +1829,39 @@ class FacetShould(TestCase):
         f.values()
         vqs.iterator.assert_called()
 
+    def cached_facet(self):
+        from stockandflow.models import Facet
+        from django.db.models.query import ValuesQuerySet
+        vqs = ValuesQuerySet(model=User)
+        vqs.iterator = Mock(side_effect=lambda: iter(["a", "b"]))
+        return Facet("test_slug", "test_name", "test_field", vqs, cache_ttl=60), vqs
+
+    def testEvaluateAValuesQuerySetOnceWithinTheTTL(self):
+        f, vqs = self.cached_facet()
+        self.assertEqual(f.values, ["a", "b"])
+        self.assertTrue(f.has_value("b"))
+        self.assertFalse(f.has_value("c"))
+        self.assertEqual(vqs.iterator.call_count, 1)
+
+    def testKeepTheValuesThatWereReadWhenTheyAreInvalidatedMeanwhile(self):
+        from stockandflow.models import Facet
+        f, vqs = self.cached_facet()
+        refresh = Facet._refresh_cache
+        def refresh_then_invalidate(facet):
+            result = refresh(facet)
+            facet.invalidate() # As a post_save from another thread would
+            return result
+        with patch.object(Facet, "_refresh_cache", refresh_then_invalidate):
+            self.assertTrue(f.has_value("a"))
+            self.assertEqual(f.values, ["a", "b"])
+
+    def testReevaluateTheValuesWhenTheValuesModelIsSaved(self):
+        f, vqs = self.cached_facet()
+        f.values
+        User.objects.create(username="new_value")
+        f.values
+        self.assertEqual(vqs.iterator.call_count, 2)
+
     def testCreateAQObjectBasedOnAValue(self):
         from stockandflow.models import Facet
         f = Facet("test_slug", "test name", "test_field", [1,2])
@@ -575,6 +1896,33 @@ class FacetShould(TestCase):
         self.assertEqual(rv[0], 2)
         self.assertEqual(str(rv[1]), "(AND: ('yada__test_field', 2))")
 
+    def testCountEachValueWithItsOwnQueryInPerValueMode(self):
+        from stockandflow.models import Facet
+        f = Facet("test_slug", "test name", "test_field", [1,2])
+        qs = Mock()
+        qs.filter.return_value.count.return_value = 7
+        self.assertEqual(f.count_in(qs), [(1, 7), (2, 7)])
+        self.assertEqual(qs.filter.call_count, 2)
+
+    def testCountAllValuesWithOneGroupedQueryInGroupedMode(self):
+        from stockandflow.models import Facet, GROUPED, OTHER_FACET_VALUE
+        f = Facet("test_slug", "test name", "test_field", [1,2], count_mode=GROUPED)
+        qs = Mock()
+        qs.order_by.return_value.values.return_value.annotate.return_value = [
+            {"yada__test_field": 1, "facet_count": 3},
+            {"yada__test_field": 9, "facet_count": 2},
+            {"yada__test_field": None, "facet_count": 1},
+        ]
+        rv = f.count_in(qs, "yada")
+        self.assertEqual(rv, [(1, 3), (2, 0), (OTHER_FACET_VALUE, 3)])
+        qs.order_by.return_value.values.assert_called_with("yada__test_field")
+        self.assertFalse(qs.filter.called)
+
+    def testRaiseErrorWithAnInvalidCountMode(self):
+        from stockandflow.models import Facet
+        self.assertRaises(ValueError, Facet, "test_slug", "test name", "test_field",
+                          [1,2], count_mode="wrong")
+
 
 class StockFacetQuerysetShould(TestCase):
     def testunitFindTheFacetGivenAFacetSlug(self):
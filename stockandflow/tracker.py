@@ -1,4 +1,208 @@
+import logging
+import threading
+import warnings
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+
+from stockandflow.compat import atomic
+from stockandflow.models import flow_router, snapshot_stocks
+
+
+logger = logging.getLogger("stockandflow")
+
+class _NotLoaded(object):
+    """
+    Stands in for the value of a field that was not loaded, like a deferred
+    field. It pickles as a reference to NOT_LOADED, so a snapshot is still
+    understood after a round trip through pickle.
+    """
+    def __reduce__(self):
+        return "NOT_LOADED"
+
+    def __repr__(self):
+        return "NOT_LOADED"
+
+NOT_LOADED = _NotLoaded()
+
+_local = threading.local()
+
+
+def tracking_suspended():
+    return getattr(_local, "suspended", 0) > 0
+
+
+@contextmanager
+def suspended():
+    """
+    Do not snapshot the model instances that are created in the block.
+
+    An instance without a snapshot creates no flow events when it is saved,
+    except when it is created. Use this for code that loads a lot of tracked
+    objects that will not be saved, such as reports and exports.
+    """
+    _local.suspended = getattr(_local, "suspended", 0) + 1
+    try:
+        yield
+    finally:
+        _local.suspended -= 1
+
+
+def untracked(queryset):
+    """
+    Iterate over the queryset without snapshotting the objects, as if each
+    object were loaded inside suspended(). Tracking is only suspended while
+    the objects are loaded, not in the body of the loop.
+    """
+    iterator = queryset.iterator()
+    while True:
+        with suspended():
+            try:
+                obj = next(iterator)
+            except StopIteration:
+                return
+        yield obj
+
+
+class SnapshotLayout(object):
+    """
+    The attributes in the snapshots that a dispatcher takes and where each
+    of its trackers finds its own attributes in them. A layout is never
+    changed, a new one replaces it when the trackers change.
+    """
+    def __init__(self, attnames=(), attribute_indexes=(), trackers=()):
+        self.attnames = attnames
+        self.attribute_indexes = attribute_indexes
+        self.trackers = trackers # (weak reference, indexes) tuples
+
+
+class ModelDispatcher(object):
+    """
+    Receive the post_init and post_save signals of a model once and fan them
+    out to all the trackers of the model.
+
+    The snapshot of an instance is one tuple of the attribute names of the
+    layout it was taken with followed by the values of the union of the
+    fields that the trackers track. It only holds plain values, so tracked
+    instances can be pickled. A snapshot taken before the trackers changed is
+    still used for the fields that it has. The trackers are held by weak
+    reference, like signal receivers, so a tracker that is no longer used
+    stops tracking.
+    """
+    snapshot_attname = "_modeltracker_snapshot"
+
+    def __init__(self, model):
+        self.model = model
+        self.trackers = []
+        self.layout = SnapshotLayout()
+        uid = "stockandflow_dispatcher_%s" % id(self)
+        models.signals.post_init.connect(self.save_initial, sender=model, weak=False,
+                                         dispatch_uid=uid)
+        models.signals.post_save.connect(self.check_for_change, sender=model, weak=False,
+                                         dispatch_uid=uid)
+
+    @property
+    def attnames(self):
+        return self.layout.attnames
+
+    def add(self, tracker):
+        self.trackers = self.trackers + [weakref.ref(tracker, self._remove)]
+        self._update_layout()
+
+    def _remove(self, ref):
+        # This is called by the garbage collector at any time, so the list is
+        # replaced rather than changed under a loop that is using it.
+        self.trackers = [r for r in self.trackers if r is not ref]
+        self._update_layout()
+
+    def _update_layout(self):
+        """
+        Work out the union of the tracked fields and where each tracker finds
+        its fields in the snapshot.
+        """
+        refs = [(ref, ref()) for ref in self.trackers]
+        refs = [(ref, tracker) for ref, tracker in refs if tracker is not None]
+        attnames = []
+        attributes = set()
+        for ref, tracker in refs:
+            attributes.update(tracker.attributes)
+            for attname in tracker.attnames:
+                if attname not in attnames:
+                    attnames.append(attname)
+        self.layout = SnapshotLayout(
+                tuple(attnames),
+                tuple(i for i, a in enumerate(attnames) if a in attributes),
+                tuple((ref, tuple(attnames.index(a) for a in tracker.attnames))
+                      for ref, tracker in refs))
+
+    def save_initial(self, sender, instance, **kwargs):
+        """
+        Receives the post_init signal.
+
+        This runs for every instance of the model that is created, so the
+        snapshot is a single tuple read straight from the instance __dict__.
+        Deferred fields are not loaded, they are stored as NOT_LOADED. Only
+        the tracked attributes that are not fields, like properties, are read
+        with getattr.
+        """
+        if tracking_suspended():
+            return
+        layout = self.layout
+        values = instance.__dict__
+        snapshot = [layout.attnames] + [values.get(a, NOT_LOADED) for a in layout.attnames]
+        for i in layout.attribute_indexes:
+            snapshot[i + 1] = getattr(instance, layout.attnames[i])
+        values[self.snapshot_attname] = tuple(snapshot)
+
+    def snapshot_of(self, instance, layout=None):
+        """
+        Return the snapshot values of the instance in the order of the
+        layout, or None if the instance has no snapshot. The fields that the
+        snapshot was taken without are NOT_LOADED.
+        """
+        snapshot = instance.__dict__.get(self.snapshot_attname)
+        if snapshot is None:
+            return None
+        layout = layout or self.layout
+        taken = snapshot[0]
+        if taken is layout.attnames or taken == layout.attnames:
+            return snapshot[1:]
+        taken_values = dict(zip(taken, snapshot[1:]))
+        return tuple([taken_values.get(a, NOT_LOADED) for a in layout.attnames])
+
+    def check_for_change(self, sender, instance, created, **kwargs):
+        """
+        Receives the post_save signal. Instances without a snapshot are
+        skipped unless they were just created.
+        """
+        layout = self.layout
+        snapshot = self.snapshot_of(instance, layout)
+        if snapshot is None and not created:
+            return
+        values = instance.__dict__
+        current = [values[a] if a in values else getattr(instance, a)
+                   for a in layout.attnames]
+        for ref, indexes in layout.trackers:
+            tracker = ref()
+            if tracker is not None:
+                previous = None if snapshot is None else [snapshot[i] for i in indexes]
+                tracker.check_for_change(instance, created, previous,
+                                         [current[i] for i in indexes])
+
+
+# The dispatcher of each tracked model
+dispatchers = {}
+
+
+def get_dispatcher(model):
+    try:
+        return dispatchers[model]
+    except KeyError:
+        dispatcher = dispatchers[model] = ModelDispatcher(model)
+        return dispatcher
 
 
 class ModelTracker(object):
@@ -16,10 +220,27 @@ class ModelTracker(object):
     composed of any number of sub-states/stocks. The resulting previous and
     current state tuples are then compared element by element.
 
+    A foreign key is tracked by the value of its key, and the related objects
+    are only loaded for the states_to_stocks_func when the key changes. The
+    fields_to_track can also name attributes that are not fields, such as
+    properties, which are read with getattr.
+
+    The transitions are routed to the flows with the flow_router registry. A
+    flow that has been replaced by a later flow with the same slug is no
+    longer routed. When more than one flow of the tracker connects the same
+    pair, the one created first records the transition and a warning names
+    it.
+
+    If the states_to_stocks_func always returns the same stocks for the same
+    field values, set memoize to True to remember the transitions of the last
+    memo_size distinct changes rather than calling the function again. The
+    field values must then be hashable.
+
     Thanks to carljm for the monitor in django-model-utils on which the
     change tracking is based.
     """
-    def __init__(self, fields_to_track, states_to_stocks_func, stocks=[], flows=[]):
+    def __init__(self, fields_to_track, states_to_stocks_func, stocks=[], flows=[],
+                 pre_record_callable=None, memoize=False, memo_size=1024):
         try:
             self.model = stocks[0].subject_model
         except IndexError:
@@ -31,68 +252,249 @@ class ModelTracker(object):
         self.states_to_stocks_func = states_to_stocks_func
         self.stocks = stocks
         self.flows = flows
-        # cache the flow lookup table
-        self.flow_lookup = {}
-        # property names to store initial state-defining field values
-        self.tracker_attnames = map(lambda f: '_modeltracker_%s' % f, fields_to_track)
-        # Establish signals to get change notifications
-        models.signals.post_init.connect(self._save_initial, sender=self.model)
-        models.signals.post_save.connect(self._check_for_change, sender=self.model)
+        self.pre_record_callable = pre_record_callable
+        # the flows are routed through the flow_router registry
+        self._flow_set = frozenset(flows)
+        # the instance attribute names of the tracked fields, the tracked
+        # attributes that are not fields and the foreign keys by position
+        attnames = []
+        self.attributes = set()
+        self.relations = []
+        for i, name in enumerate(fields_to_track):
+            try:
+                field = self.model._meta.get_field(name)
+            except (AttributeError, FieldDoesNotExist): # No model or not a field
+                attnames.append(name)
+                self.attributes.add(name)
+                continue
+            attnames.append(field.attname)
+            if isinstance(field, models.ForeignKey):
+                self.relations.append((i, field))
+        self.attnames = tuple(attnames)
+        # a bounded cache of the transitions of previous changes
+        self.memoize = memoize
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+        # Get change notifications from the model's dispatcher
+        self.dispatcher = get_dispatcher(self.model)
+        self.dispatcher.add(self)
+        unroutable = self.unroutable_pairs()
+        if unroutable:
+            logger.warning("%s records no flow events for the transitions %s.", self,
+                           ", ".join("from %s to %s" % pair for pair in unroutable))
+        for source, sink, flows in self.ambiguous_pairs():
+            warnings.warn("In %s the transition from %s to %s is connected by the flows %s. "
+                          "It is recorded by %s." % (self, source, sink,
+                          ", ".join(f.slug for f in flows), flows[0].slug))
 
     def __str__(self):
         return "ModelTracker for %s" % self.model
 
     def get_tracked_value(self, instance, idx):
-        return getattr(instance, self.fields_to_track[idx])
-
-    def _save_initial(self, sender, instance, **kwargs):
         """
-        Receives the post_init signal.
+        Return the value of a tracked field. A relation is tracked by the value
+        of its key rather than the related object.
         """
-        for i, f in enumerate(self.fields_to_track):
-            setattr(instance, self.tracker_attnames[i],
-                    self.get_tracked_value(instance, i))
+        try:
+            return instance.__dict__[self.attnames[idx]]
+        except KeyError: # Not loaded, so load it
+            return getattr(instance, self.attnames[idx])
 
-    def _check_for_change(self, sender, instance, created, **kwargs):
+    @property
+    def snapshot_attname(self):
+        return self.dispatcher.snapshot_attname
+
+    def check_for_change(self, instance, created, previous, current):
         """
-        Receives the post_save signal.
+        Called by the dispatcher when an instance is saved, with the snapshot
+        and current values of the fields of this tracker.
+
+        The previous value of a field that was not loaded is unknown, so it is
+        taken to be unchanged.
         """
-        previous = []
-        current = []
-        for i, f in enumerate(self.fields_to_track):
-            previous.append(getattr(instance, self.tracker_attnames[i], None))
-            current.append(self.get_tracked_value(instance, i))
         if created:
             previous = None
-        if previous != current: # short circuit if nothing has changed
-            sources, sinks = self.states_to_stocks_func(previous, current)
-            for source, sink in zip(sources, sinks):
-                if source is not sink: # short circuit if no change in state/stock
-                    self.create_flow_event(source, sink, instance)
+        else:
+            previous = [c if p is NOT_LOADED else p for p, c in zip(previous, current)]
+        for source, sink in self.transitions(previous, current, instance):
+            self.create_flow_event(source, sink, instance)
+
+    def transitions(self, previous, current, instance=None):
+        """
+        Return a list of the (source, sink) pairs for a change of the tracked
+        field values. The current related objects are taken from the instance
+        when it is given.
+        """
+        if previous == current: # short circuit if nothing has changed
+            return []
+        if not self.memoize:
+            return self._transitions(previous, current, instance)
+        key = (previous if previous is None else tuple(previous), tuple(current))
+        with self._memo_lock:
+            try:
+                # Move the hit to the end, so the least recently used is first
+                result = self._memo[key] = self._memo.pop(key)
+                return result
+            except KeyError:
+                pass
+        result = self._transitions(previous, current, instance)
+        with self._memo_lock:
+            self._memo[key] = result
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return result
+
+    def _transitions(self, previous, current, instance=None):
+        if self.relations:
+            previous = self.related_values(previous)
+            current = self.related_values(current, instance)
+        sources, sinks = self.states_to_stocks_func(previous, current)
+        # skip the elements where there is no change in state/stock
+        return [(source, sink) for source, sink in zip(sources, sinks) if source is not sink]
+
+    def related_values(self, values, instance=None):
+        """
+        Return the values with the keys of the tracked foreign keys replaced
+        by the related objects. An object that the instance has already
+        loaded is not loaded again.
+        """
+        if values is None:
+            return None
+        values = list(values)
+        for i, field in self.relations:
+            key = values[i]
+            if key is None:
+                continue
+            cached = instance.__dict__.get(field.get_cache_name()) if instance else None
+            if cached is not None and \
+                    getattr(cached, field.rel.get_related_field().attname) == key:
+                values[i] = cached
+            else:
+                try:
+                    values[i] = field.rel.to._default_manager.get(
+                            **{field.rel.field_name: key})
+                except field.rel.to.DoesNotExist: # Deleted since, so leave the key
+                    pass
+        return values
+
+    def find_flow(self, source, sink):
+        """
+        Return the flow of this tracker that connects the source and sink, or
+        None.
+        """
+        for flow in flow_router.flows_for(source, sink):
+            if flow in self._flow_set:
+                return flow
+        return None
+
+    def unroutable_pairs(self):
+        """
+        Return a list of the (source, sink) pairs of this tracker's stocks,
+        including the None stock outside of the system, that none of its
+        flows records, so their transitions create no flow events. These are
+        logged when the tracker is created.
+        """
+        stocks = [None] + list(self.stocks)
+        return [(source, sink) for source in stocks for sink in stocks
+                if source is not sink and self.find_flow(source, sink) is None]
+
+    def ambiguous_pairs(self):
+        """
+        Return a list of (source, sink, flows) tuples for the pairs that more
+        than one flow of this tracker connects. The first of the flows is the
+        one that find_flow picks.
+        """
+        pairs = []
+        for flow in self.flows:
+            for source in flow.sources:
+                for sink in flow.sinks:
+                    if source is not sink and (source, sink) not in pairs:
+                        pairs.append((source, sink))
+        ambiguous = []
+        for source, sink in pairs:
+            flows = [f for f in flow_router.flows_for(source, sink) if f in self._flow_set]
+            if len(flows) > 1:
+                ambiguous.append((source, sink, flows))
+        return ambiguous
 
     def create_flow_event(self, source, sink, instance):
         """
         Find a flow to create the event based on the source and sink.
+        """
+        flow = self.find_flow(source, sink)
+        if flow:
+            flow.add_event(instance, source, sink)
+
+    def update(self, queryset, run_callables=False, **kwargs):
+        """
+        Run queryset.update(**kwargs) and record the flow events for the
+        resulting transitions, which a plain QuerySet.update would skip.
+
+        The previous values of the tracked fields are read in one query, the
+        update is applied, the current values are read back so that they are
+        the ones the database stored, and the events are written with
+        Flow.add_events. It all happens in one transaction.
 
-        First try a cache of previous matches. Then try to add the event
-        with all the flows in this tracker. If an event is created update
-        the cache for next time.
-        """
-        try: # Check the cache
-            flow = self.flow_lookup[(source, sink)]
-            if flow:
-                flow.add_event(instance, source, sink)
-        except KeyError:
-            for flow in self.flows:
-                if flow.add_event(instance, source, sink): break
+        The event callables only run if run_callables is True, once the
+        transaction has committed. Only concrete fields that are not relations
+        can be tracked this way. Returns the number of rows updated.
+        """
+        for field_name in self.fields_to_track:
+            if field_name in self.attributes:
+                raise ValueError("The tracked attribute '%s' is not a field, so it can "
+                                 "not be tracked in a bulk update." % field_name)
+            if getattr(self.model._meta.get_field(field_name), "rel", None):
+                raise ValueError("The tracked field '%s' is a relation, which can not "
+                                 "be tracked in a bulk update." % field_name)
+        transitions_by_flow = {}
+        with atomic():
+            if hasattr(queryset, "select_for_update"):
+                locked = queryset.select_for_update()
             else:
-                flow = None
-            # Cache the result
-            self.flow_lookup[(source, sink)] = flow
+                locked = queryset
+            previous = dict((row[0], list(row[1:])) for row in
+                            locked.values_list("pk", *self.fields_to_track).iterator())
+            updated = queryset.update(**kwargs)
+            current = self._updated_values(previous)
+            for pk, prev in previous.items():
+                for source, sink in self.transitions(prev, current[pk]):
+                    flow = self.find_flow(source, sink)
+                    if flow:
+                        transitions_by_flow.setdefault(flow, []).append((pk, source, sink))
+            # The chunks are written in this transaction, because a nested one
+            # would commit it before Django 1.6
+            for flow, transitions in transitions_by_flow.items():
+                flow.add_events(transitions, transactional=False)
+        if run_callables and transitions_by_flow: # Given the objects, not the pks
+            objs = self.model._default_manager.in_bulk(list(previous))
+            for flow, transitions in transitions_by_flow.items():
+                for pk, source, sink in transitions:
+                    if pk in objs:
+                        flow.run_callables(objs[pk], source, sink)
+        return updated
+
+    def _updated_values(self, previous):
+        """
+        Return a dict of the tracked values after an update, keyed by pk, as
+        the database stored them. Expressions such as F objects and values
+        that the fields convert are only known to the database.
+        """
+        pks = list(previous)
+        current = {}
+        for start in range(0, len(pks), 1000):
+            rows = self.model._default_manager.filter(pk__in=pks[start:start + 1000]) \
+                                              .values_list("pk", *self.fields_to_track)
+            for row in rows:
+                current[row[0]] = list(row[1:])
+        return current
 
     def record_count(self):
+        """
+        Save a record of the count of all the stocks in this tracker. Stocks
+        that share a table are counted in a single scan.
+        """
         if self.pre_record_callable:
             self.pre_record_callable()
-        for stock in self.stocks:
-            stock.save_count()
+        return snapshot_stocks(self.stocks)
 
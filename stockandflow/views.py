@@ -6,9 +6,13 @@ from django.views.generic.list_detail import object_detail
 from django.core.urlresolvers import reverse
 from django.template import loader
 from django import forms
-from django.http import QueryDict
+from django.http import QueryDict, HttpResponseBadRequest
+from django.contrib.admin.views.decorators import staff_member_required
 
-from stockandflow.models import StockRecord, StockFacetQuerySet
+from stockandflow.models import StockRecord, StockFacetQuerySet, reading_queryset
+from stockandflow.counting import EXACT
+from stockandflow.compat import StreamingHttpResponse
+from stockandflow.export import export_lines, parse_datetime
 
 class FacetForm(forms.Form):
     def __init__(self, facet_selection, *args, **kwargs):
@@ -312,6 +316,35 @@ class Process(object):
             url += "?%s" % query_str
         return redirect(url)
 
+@staff_member_required
+def export(request, kind):
+    """
+    Stream an export of the stock_records, facet_records or flow_events. The
+    options that can be set in a GET query are format (csv or ndjson), slug,
+    start, end and after, as for the export_stockandflow management command.
+    """
+    format = request.GET.get("format", "csv")
+    slug = request.GET.get("slug") or None
+    try:
+        start, end = [parse_datetime(request.GET[k]) if request.GET.get(k) else None
+                      for k in ("start", "end")]
+        after = request.GET.get("after") or None
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                raise ValueError("The after must be a primary key, not '%s'." % after)
+        lines = export_lines(kind, format, slug, start, end, after)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if format == "csv":
+        content_type = "text/csv"
+    else:
+        content_type = "application/x-ndjson"
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response["Content-Disposition"] = "attachment; filename=%s.%s" % (slug or kind, format)
+    return response
+
 # Wrap all the geckoboard views to catch an import error
 # in case the django-geckoboard app is not installed.
 try:
@@ -322,13 +355,26 @@ try:
         """
         Feed a geckoboard line chart. The options that can be set in a GET
         query are points (integer), x_label (string), y_label (string), color
-        (string).
+        (string) and strategy (string).
+
+        Only the records of one counting strategy are charted so that exact
+        and estimated counts are never mixed. The strategy defaults to the
+        strategy of the most recent record, and the y label notes an
+        estimating strategy.
         """
         points = int(request.GET.get("points", 50))
         x_label = request.GET.get("x_label", "")
         y_label = request.GET.get("y_label", slug.capitalize())
         color = request.GET.get("color", None)
-        records = list(StockRecord.objects.filter(stock=slug).values_list('count', flat=True)[:points])
+        stock_records = reading_queryset(StockRecord.objects.filter(stock=slug))
+        strategy = request.GET.get("strategy", None)
+        if strategy is None:
+            latest = list(stock_records.values_list('strategy', flat=True)[:1])
+            strategy = latest[0] if latest else EXACT
+        if strategy != EXACT:
+            y_label = "%s (%s)" % (y_label, strategy)
+        records = list(stock_records.filter(strategy=strategy)
+                                    .values_list('count', flat=True)[:points])
         records.reverse()
         if color: return ( records, x_label, y_label, color)
         return ( records, x_label, y_label)